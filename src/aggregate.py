@@ -0,0 +1,298 @@
+import pandas as pd
+
+from constants import TZ
+from loader import swap_collection
+from make_mappable import make_mappable
+from models import ACTIVE_HEALTH_STATS
+
+# resolved PSGC of the location names of cases stored without one
+LOCATIONS_COL = "cases.locations"
+LOC_COLS = ["regionRes", "provRes", "cityMunRes"]
+LOC_KEY_SEP = "|"
+# fields identifying a counter of each summary collection
+SUMMARY_KEYS = {
+    "cases.stats": ["provincePSGC", "healthStatus"],
+    "cases.summary": ["healthStatus"],
+}
+
+
+def summary_indexes(col_name):
+    """Get the indexes of a summary collection.
+
+    Args:
+        col_name (str): "cases.stats" or "cases.summary".
+
+    Returns:
+        list: `(keys, options)` pairs, see loader.swap_collection.
+    """
+    return [([(k, 1) for k in SUMMARY_KEYS[col_name]], dict(unique=True))]
+
+
+def _loc_key():
+    # location names of a case joined into a single lookup key
+    parts = []
+    for col_name in LOC_COLS:
+        parts += [{"$ifNull": ["$" + col_name, ""]}, LOC_KEY_SEP]
+    return {"$concat": parts[:-1]}
+
+
+def _with_totals(keys):
+    # stages adding each per status count grouped by `keys` to the derived
+    # "all" and "active" counters as well
+    targets = {
+        "$map": {
+            "input": ["status", "all", "active"],
+            "as": "t",
+            "in": {"$cond": [{"$eq": ["$$t", "status"]}, "$_id.healthStatus", "$$t"]},
+        }
+    }
+    is_counted = {
+        "$or": [
+            {"$ne": ["$$t", "active"]},
+            {"$in": ["$_id.healthStatus", ACTIVE_HEALTH_STATS]},
+        ]
+    }
+    return [
+        {
+            "$project": {
+                "count": 1,
+                "healthStatus": {
+                    "$filter": {"input": targets, "as": "t", "cond": is_counted}
+                },
+            }
+        },
+        {"$unwind": "$healthStatus"},
+        {
+            "$group": {
+                "_id": dict(
+                    {k: "$_id." + k for k in keys}, healthStatus="$healthStatus"
+                ),
+                "count": {"$sum": "$count"},
+            }
+        },
+    ]
+
+
+def province_stats_pipeline(new_date, into="cases.stats"):
+    """Build the pipeline counting the cases of each province by health status.
+
+    Cases are grouped before their missing PSGC is looked up, so the lookup
+    only runs once per distinct location.
+
+    Args:
+        new_date (pandas.Timestamp): Date of the snapshot.
+        into (str, optional): Collection the documents are merged into.
+
+    Returns:
+        list: The aggregation pipeline on the cases collection.
+    """
+    psgc = {"$ifNull": ["$cityMuniPSGC", ""]}
+    return [
+        {
+            "$group": {
+                "_id": {
+                    "psgc": psgc,
+                    "locKey": {"$cond": [{"$eq": [psgc, ""]}, _loc_key(), None]},
+                    "healthStatus": {"$ifNull": ["$healthStatus", ""]},
+                },
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$lookup": {
+                "from": LOCATIONS_COL,
+                "localField": "_id.locKey",
+                "foreignField": "_id",
+                "as": "loc",
+            }
+        },
+        {
+            "$project": {
+                "healthStatus": "$_id.healthStatus",
+                "count": 1,
+                "psgc": {
+                    "$cond": [
+                        {"$eq": ["$_id.psgc", ""]},
+                        {"$ifNull": [{"$arrayElemAt": ["$loc.psgc", 0]}, ""]},
+                        "$_id.psgc",
+                    ]
+                },
+            }
+        },
+        {"$match": {"psgc": {"$ne": ""}}},
+        {
+            "$group": {
+                "_id": {
+                    "provincePSGC": {
+                        "$concat": [{"$substrCP": ["$psgc", 0, 6]}, "00000"]
+                    },
+                    "healthStatus": "$healthStatus",
+                },
+                "count": {"$sum": "$count"},
+            }
+        },
+        *_with_totals(["provincePSGC"]),
+        {
+            "$project": {
+                "_id": 0,
+                "provincePSGC": "$_id.provincePSGC",
+                "healthStatus": "$_id.healthStatus",
+                "count": 1,
+                "createdAt": {"$literal": new_date},
+            }
+        },
+        {
+            "$merge": {
+                "into": into,
+                "on": SUMMARY_KEYS["cases.stats"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def national_summary_pipeline(new_date, into="cases.summary"):
+    """Build the pipeline counting all cases by health status.
+
+    Args:
+        new_date (pandas.Timestamp): Date of the snapshot.
+        into (str, optional): Collection the documents are merged into.
+
+    Returns:
+        list: The aggregation pipeline on the cases collection.
+    """
+    return [
+        {
+            "$group": {
+                "_id": {"healthStatus": {"$ifNull": ["$healthStatus", ""]}},
+                "count": {"$sum": 1},
+            }
+        },
+        *_with_totals([]),
+        {
+            "$project": {
+                "_id": 0,
+                "healthStatus": "$_id.healthStatus",
+                "count": 1,
+                "createdAt": {"$literal": new_date},
+            }
+        },
+        {
+            "$merge": {
+                "into": into,
+                "on": SUMMARY_KEYS["cases.summary"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def resolve_locations(mongo_db):
+    """Save the PSGC of the locations of cases stored without one.
+
+    Only the distinct location names leave the database.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+
+    Returns:
+        int: Number of distinct locations.
+    """
+    res = mongo_db["cases"].aggregate(
+        [
+            {"$match": {"cityMuniPSGC": {"$in": ["", None]}}},
+            {
+                "$group": {
+                    "_id": {
+                        col_name: {"$ifNull": ["$" + col_name, ""]}
+                        for col_name in LOC_COLS
+                    }
+                }
+            },
+        ]
+    )
+    loc_df = pd.DataFrame([doc["_id"] for doc in res], columns=LOC_COLS)
+    mongo_col = mongo_db[LOCATIONS_COL]
+    mongo_col.drop()
+    if loc_df.shape[0] == 0:
+        return 0
+    loc_df["cityMuniPSGC"] = ""
+    loc_df = make_mappable(loc_df)
+    loc_df["_id"] = loc_df[LOC_COLS].agg(LOC_KEY_SEP.join, axis=1)
+    loc_df = loc_df.rename(columns={"cityMuniPSGC": "psgc"})
+    mongo_col.insert_many(loc_df[["_id", "psgc"]].fillna("").to_dict("records"))
+    return loc_df.shape[0]
+
+
+def latest_date(mongo_col):
+    """Get the date of the latest snapshot written to the cases collection.
+
+    Args:
+        mongo_col (pymongo.Collection): The cases collection.
+
+    Returns:
+        pandas.Timestamp: The localized snapshot date.
+    """
+    res = list(
+        mongo_col.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": None,
+                        "createdAt": {"$max": "$createdAt"},
+                        "updatedAt": {"$max": "$updatedAt"},
+                    }
+                }
+            ]
+        )
+    )
+    dates = [res[0][k] for k in ["createdAt", "updatedAt"] if res and res[0].get(k)]
+    new_date = pd.Timestamp(max(dates))
+    if new_date.tzinfo is None:
+        new_date = new_date.tz_localize("UTC")
+    return new_date.tz_convert(TZ)
+
+
+def run_summaries(mongo_db, new_date=None):
+    """Recompute "cases.stats" and "cases.summary" inside the database.
+
+    No case data is transferred, only the distinct unresolved locations.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        new_date (pandas.Timestamp, optional): Date of the snapshot, the
+            latest createdAt or updatedAt of the cases if not set.
+
+    Returns:
+        pandas.Timestamp: Date of the snapshot.
+    """
+    mongo_col = mongo_db["cases"]
+    if new_date is None:
+        new_date = latest_date(mongo_col)
+    print("Date: {}".format(new_date))
+
+    print("Resolving locations...")
+    print("{} distinct locations without PSGC".format(resolve_locations(mongo_db)))
+
+    for col_name, pipeline in [
+        ("cases.stats", province_stats_pipeline),
+        ("cases.summary", national_summary_pipeline),
+    ]:
+        print("Aggregating '{}'...".format(col_name))
+        with swap_collection(mongo_db, col_name) as staging_col:
+            # $merge needs a unique index on its "on" fields
+            for keys, options in summary_indexes(col_name):
+                staging_col.create_index(keys, **options)
+            mongo_col.aggregate(pipeline(new_date, into=staging_col.name))
+            if col_name == "cases.summary":
+                # the national counters are kept even when nothing is counted
+                for health_status in ["all", "active"]:
+                    staging_col.update_one(
+                        {"healthStatus": health_status},
+                        {"$setOnInsert": {"count": 0, "createdAt": new_date}},
+                        upsert=True,
+                    )
+    mongo_db.drop_collection(LOCATIONS_COL)
+    return new_date
@@ -0,0 +1,261 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from constants import CASE_INFO_CSV_DIR
+from make_mappable import LOC_CITY_MUN_SAV
+from models import REGION_MAP, REGION_UNKNOWN
+
+HEALTH_STATUS = ["Asymptomatic", "Mild", "Moderate", "Severe", "Critical"]
+DRIFT_CHOICES = ["none", "extra-column", "missing-column", "date-format"]
+
+
+def _locations():
+    # real region/province/city combinations, from the lookup table
+    loc_df = pd.read_csv(LOC_CITY_MUN_SAV, dtype=str).dropna()
+    loc_df = loc_df.loc[~loc_df["regionResGeo"].isin(REGION_UNKNOWN)]
+    return loc_df.drop_duplicates(subset=["regionResGeo", "provRes", "cityMunRes"])
+
+
+def lookup_boundaries():
+    """Build boundary attribute tables from the location lookup table.
+
+    A stand-in for the shapefiles, every generated location is found in it
+    so make_mappable matches the names without fuzzy matching.
+
+    Returns:
+        dict: Level to its attribute table, see boundaries.use_boundaries.
+    """
+    loc_df = pd.read_csv(LOC_CITY_MUN_SAV, dtype=str).dropna()
+    return dict(
+        city_mun=pd.DataFrame(
+            {
+                "ADM3_EN": loc_df["cityMunRes"],
+                "ADM3_PCODE": loc_df["psgc"],
+                "ADM2_EN": loc_df["provRes"],
+                "ADM1_EN": loc_df["regionResGeo"],
+            }
+        ),
+        province=pd.DataFrame(
+            {
+                "ADM2_EN": loc_df["provRes"],
+                "ADM2_PCODE": loc_df["psgc"].str.slice(0, 6) + "00000",
+                "ADM1_EN": loc_df["regionResGeo"],
+            }
+        ),
+        region=pd.DataFrame(
+            {
+                "ADM1_EN": loc_df["regionResGeo"],
+                "ADM1_PCODE": loc_df["psgc"].str.slice(0, 4) + "0000000",
+            }
+        ),
+    )
+
+
+def _dirty_regions(region_geo, rng):
+    # pick one of the spellings REGION_MAP knows for each region
+    spellings = {}
+    for spelling, region in REGION_MAP.items():
+        spellings.setdefault(region, []).append(spelling)
+    return np.array(
+        [
+            spellings[r][rng.integers(len(spellings[r]))] if r in spellings else r
+            for r in region_geo
+        ],
+        dtype=object,
+    )
+
+
+def _choice(values, n, rng, p=None):
+    # object array so NaN is not turned into the string "nan"
+    return rng.choice(np.array(values, dtype=object), n, p=p)
+
+
+def _dates(start, days, n, rng, p_missing):
+    dates = pd.Timestamp(start) - pd.to_timedelta(rng.integers(0, days, n), unit="D")
+    dates = pd.Series(dates.strftime("%Y-%m-%d"), dtype=object)
+    dates[rng.random(n) < p_missing] = np.nan
+    return dates.to_numpy()
+
+
+def make_cases(n, start_id, snap_date, rng, loc_df, dirty=0.05):
+    """Generate DOH-shaped raw case rows.
+
+    Args:
+        n (int): Number of cases.
+        start_id (int): First case number, case codes are sequential.
+        snap_date (str): Date of the snapshot, cases are reported before it.
+        rng (numpy.random.Generator): Random generator.
+        loc_df (pandas.DataFrame): Locations to draw from, see _locations.
+        dirty (float, optional): Share of cases with a different region
+            spelling and no PSGC, which need make_mappable.
+
+    Returns:
+        pandas.DataFrame: The raw cases.
+    """
+    loc = loc_df.iloc[rng.integers(0, loc_df.shape[0], n)]
+    is_dirty = rng.random(n) < dirty
+    region = np.where(
+        is_dirty,
+        _dirty_regions(loc["regionResGeo"], rng),
+        loc["regionRes"].to_numpy(),
+    )
+    health = rng.choice(HEALTH_STATUS, n, p=[0.3, 0.5, 0.1, 0.06, 0.04])
+    age = rng.integers(0, 100, n).astype(float)
+    age[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame(
+        {
+            "CaseCode": ["C{:09d}".format(i) for i in range(start_id, start_id + n)],
+            "Age": age,
+            "AgeGroup": "",
+            "Sex": rng.choice(["MALE", "FEMALE", "Male ", "female"], n),
+            "DateSpecimen": _dates(snap_date, 400, n, rng, 0.2),
+            "DateResultRelease": _dates(snap_date, 400, n, rng, 0.3),
+            "DateRepConf": _dates(snap_date, 400, n, rng, 0.0),
+            # filled with strings by _apply_churn
+            "DateDied": np.full(n, np.nan, dtype=object),
+            "DateRecover": np.full(n, np.nan, dtype=object),
+            "RemovalType": np.full(n, np.nan, dtype=object),
+            "Admitted": _choice(["YES", "NO", np.nan], n, rng),
+            "RegionRes": region,
+            "ProvRes": loc["provRes"].to_numpy(),
+            "CityMunRes": loc["cityMunRes"].to_numpy(),
+            "CityMuniPSGC": np.where(is_dirty, np.nan, loc["psgc"].to_numpy()),
+            "BarangayRes": np.nan,
+            "BarangayPSGC": np.nan,
+            "HealthStatus": health,
+            "Quarantined": _choice(["YES", "NO", np.nan], n, rng),
+            "DateOnset": _dates(snap_date, 400, n, rng, 0.5),
+            "Pregnanttab": _choice(["YES", "NO", np.nan], n, rng, p=[0.01, 0.5, 0.49]),
+            "ValidationStatus": "",
+        }
+    )
+
+
+def _apply_churn(df, snap_date, rng, churn):
+    # move a share of the active cases to recovered or died
+    active = np.flatnonzero(df["HealthStatus"].isin(HEALTH_STATUS).to_numpy())
+    idx = rng.choice(active, min(int(churn * df.shape[0]), active.size), replace=False)
+    died = rng.random(idx.size) < 0.05
+    df.loc[df.index[idx], "HealthStatus"] = np.where(died, "Died", "Recovered")
+    df.loc[df.index[idx], "RemovalType"] = np.where(died, "DIED", "RECOVERED")
+    df.loc[df.index[idx[died]], "DateDied"] = snap_date
+    df.loc[df.index[idx[~died]], "DateRecover"] = snap_date
+
+
+def _apply_drift(df, drift):
+    if drift == "extra-column":
+        df["Remarks"] = ""
+    elif drift == "missing-column":
+        df.drop(columns=["Pregnanttab"], inplace=True)
+    elif drift == "date-format":
+        for col_name in df.columns:
+            if col_name.startswith("Date"):
+                df[col_name] = pd.to_datetime(df[col_name]).dt.strftime("%m/%d/%Y")
+
+
+def write_snapshot(df, csv_dir, snap_date, parts=1):
+    """Write a snapshot the way the DOH drop is laid out.
+
+    Args:
+        df (pandas.DataFrame): The raw cases.
+        csv_dir (pathlib.Path): Snapshot directory, like CASE_INFO_CSV_DIR.
+        snap_date (str): Date of the snapshot.
+        parts (int, optional): Split the snapshot into this many csv files
+            under `<date>_case_info/`.
+    """
+    name = "{}_case_info".format(pd.Timestamp(snap_date).strftime("%Y%m%d"))
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    if parts <= 1:
+        df.to_csv(csv_dir / "{}.csv".format(name), index=False)
+        return
+    (csv_dir / "{}.csv".format(name)).write_text("")
+    (csv_dir / name).mkdir(exist_ok=True)
+    for i, part_df in enumerate(np.array_split(df, parts)):
+        part_df.to_csv(csv_dir / name / "{}_{:02d}.csv".format(name, i), index=False)
+
+
+def generate(
+    out_dir,
+    rows,
+    days=2,
+    churn=0.02,
+    new_rate=0.01,
+    delete_rate=0.001,
+    parts=1,
+    dirty=0.05,
+    drift="none",
+    start="2021-06-01",
+    seed=0,
+):
+    """Generate consecutive synthetic case_info snapshots.
+
+    Args:
+        out_dir (pathlib.Path): Root directory, the snapshots are written to
+            `out_dir / CASE_INFO_CSV_DIR`.
+        rows (int): Number of cases on the first day.
+        days (int, optional): Number of snapshots.
+        churn (float, optional): Share of cases that change each day.
+        new_rate (float, optional): Share of new cases each day.
+        delete_rate (float, optional): Share of cases removed each day.
+        parts (int, optional): Split each snapshot into this many files.
+        dirty (float, optional): Share of cases needing make_mappable.
+        drift (str, optional): Schema drift applied to the last day, one of
+            DRIFT_CHOICES.
+        start (str, optional): Date of the first snapshot.
+        seed (int, optional): Random seed.
+
+    Returns:
+        list: Paths of the written snapshots.
+    """
+    rng = np.random.default_rng(seed)
+    loc_df = _locations()
+    csv_dir = Path(out_dir) / CASE_INFO_CSV_DIR
+    snap_dates = pd.date_range(start, periods=days).strftime("%Y-%m-%d")
+    df = make_cases(rows, 0, snap_dates[0], rng, loc_df, dirty)
+    next_id = rows
+    for i, snap_date in enumerate(snap_dates):
+        if i > 0:
+            _apply_churn(df, snap_date, rng, churn)
+            keep = rng.random(df.shape[0]) >= delete_rate
+            n_new = int(new_rate * df.shape[0])
+            df = pd.concat(
+                [
+                    df.loc[keep],
+                    make_cases(n_new, next_id, snap_date, rng, loc_df, dirty),
+                ],
+                ignore_index=True,
+            )
+            next_id += n_new
+        out_df = df
+        if i == days - 1 and drift != "none":
+            out_df = df.copy()
+            _apply_drift(out_df, drift)
+        print("Writing {} ({} cases)...".format(snap_date, out_df.shape[0]))
+        write_snapshot(out_df, csv_dir, snap_date, parts)
+    return sorted(csv_dir.glob("*case_info.csv"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic DOH case_info snapshots."
+    )
+    parser.add_argument("out_dir", type=Path, help="root of the generated tree")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--churn", type=float, default=0.02)
+    parser.add_argument("--new-rate", type=float, default=0.01)
+    parser.add_argument("--delete-rate", type=float, default=0.001)
+    parser.add_argument("--parts", type=int, default=1)
+    parser.add_argument("--dirty", type=float, default=0.05)
+    parser.add_argument("--drift", choices=DRIFT_CHOICES, default="none")
+    parser.add_argument("--start", default="2021-06-01")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = vars(parse_args())
+    generate(args.pop("out_dir"), **args)
@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from pathlib import Path
+
+import bson
+from pymongo import MongoClient, UpdateOne
+
+from aggregate import summary_indexes
+from benchmarks.generate_case_info import DRIFT_CHOICES, generate, lookup_boundaries
+from boundaries import BOUNDARY_SHP, use_boundaries
+from constants import BATCH_SIZE, CHUNK_SIZE
+from create_summary import map_cases, national_summary, province_stats
+from diff import diff_chunks, fingerprint_cols, index_snapshot
+from encoder import iter_raw_batches
+from instrument import stage, start_run
+from loader import load_collection, swap_collection
+from make_mappable import LOC_CITY_MUN_SAV
+from snapshot import (
+    iter_snapshot,
+    list_snapshots,
+    read_snapshot,
+    snapshot_columns,
+    snapshot_date,
+)
+from writer import delete_cases, upsert_cases
+
+BENCH_COLS = ["cases", "cases.deleted", "cases.stats", "cases.summary"]
+
+
+def run_stage(name, func):
+    """Run and measure a benchmark stage, see instrument.Run.stage.
+
+    Args:
+        name (str): Stage name.
+        func (callable): Runs the stage and returns the number of rows it
+            processed.
+
+    Returns:
+        dict: The stage metrics.
+    """
+    with stage(name) as metrics:
+        metrics["rows"] = func()
+    return metrics
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def connect(mongo_url=None, mongod=None):
+    """Connect to the database used by the benchmark.
+
+    Args:
+        mongo_url (str, optional): Use this server.
+        mongod (str, optional): Spawn this mongod binary on a temporary
+            database instead.
+
+    Returns:
+        tuple: The client and a cleanup function.
+    """
+    if mongo_url is None and mongod is None:
+        # in-process stand-in, round trips are not counted
+        import mongomock
+
+        return mongomock.MongoClient(), lambda: None
+
+    cleanup = []
+    if mongo_url is None:
+        db_dir = tempfile.mkdtemp(prefix="bench_mongod_")
+        port = _free_port()
+        proc = subprocess.Popen(
+            [mongod, "--dbpath", db_dir, "--port", str(port), "--bind_ip", "127.0.0.1"],
+            stdout=subprocess.DEVNULL,
+        )
+        mongo_url = "mongodb://127.0.0.1:{}".format(port)
+        cleanup = [proc.terminate, proc.wait, lambda: shutil.rmtree(db_dir, True)]
+    mongo_client = MongoClient(mongo_url, serverSelectionTimeoutMS=30000)
+    mongo_client.admin.command("ping")
+
+    def _cleanup():
+        mongo_client.close()
+        for func in cleanup:
+            func()
+
+    return mongo_client, _cleanup
+
+
+def _count(chunks):
+    return sum(chunk.shape[0] for chunk in chunks)
+
+
+def _decoded(docs):
+    # mongomock only takes dicts, not the raw documents of the encoder
+    return [bson.decode(doc.raw) for doc in docs]
+
+
+def _mock_upsert(mongo_col, df, stamp_date, is_update, batch_size):
+    # the upserts of writer.upsert_cases, built from decoded documents
+    extra = {"updatedAt": stamp_date} if is_update else None
+    for docs in iter_raw_batches(df, batch_size, extra=extra):
+        mongo_col.bulk_write(
+            [
+                UpdateOne(
+                    {"caseCode": doc["caseCode"]},
+                    {"$set": doc, "$setOnInsert": {"createdAt": stamp_date}},
+                    upsert=True,
+                )
+                for doc in _decoded(docs)
+            ],
+            ordered=False,
+        )
+
+
+def _mock_load(mongo_db, col_name, df, indexes=(), batch_size=BATCH_SIZE):
+    # loader.load_collection, inserting decoded documents
+    with swap_collection(mongo_db, col_name, indexes) as staging_col:
+        for docs in iter_raw_batches(df, batch_size):
+            staging_col.insert_many(_decoded(docs), ordered=False)
+
+
+def run(args):
+    bench = start_run("benchmark")
+    mongo_client, cleanup = connect(args.mongo_url, args.mongod)
+    is_mock = args.mongo_url is None and args.mongod is None
+    write = _mock_upsert if is_mock else upsert_cases
+    load = _mock_load if is_mock else load_collection
+    mongo_db = mongo_client["benchDb"]
+    for col_name in BENCH_COLS:
+        mongo_db.drop_collection(col_name)
+    mongo_col = mongo_db["cases"]
+    mongo_col.create_index([("caseCode", 1)], unique=True)
+    chunk_size = args.chunk_size or None
+    try:
+        in_csvs = list_snapshots()
+        in_csv0, in_csv = in_csvs[-2], in_csvs[-1]
+        common_cols = fingerprint_cols(
+            snapshot_columns(in_csv0), snapshot_columns(in_csv)
+        )
+
+        for label, f in [("prev", in_csv0), ("curr", in_csv)]:
+            run_stage(
+                "read_prep_" + label,
+                lambda f=f: _count(
+                    iter_snapshot(f, chunk_size, use_cache=True, workers=args.workers)
+                ),
+            )
+        run_stage(
+            "read_cache",
+            lambda: _count(iter_snapshot(in_csv, chunk_size, use_cache=True)),
+        )
+
+        snap_diff = []
+
+        def _diff():
+            prev_index = index_snapshot(
+                iter_snapshot(in_csv0, chunk_size, use_cache=True), common_cols
+            )
+            snap_diff.append(
+                diff_chunks(
+                    prev_index,
+                    iter_snapshot(in_csv, chunk_size, use_cache=True),
+                    common_cols,
+                )
+            )
+            return prev_index.shape[0]
+
+        run_stage("diff", _diff)
+        snap_diff = snap_diff[0]
+
+        def _load():
+            prev_df = read_snapshot(in_csv0, use_cache=True)
+            prev_df["createdAt"] = snapshot_date(in_csv0)
+            for docs in iter_raw_batches(prev_df, args.batch_size):
+                mongo_col.insert_many(_decoded(docs) if is_mock else docs)
+            return prev_df.shape[0]
+
+        run_stage("initial_load", _load)
+        new_date = snapshot_date(in_csv)
+        run_stage("delete", lambda: delete_cases(mongo_db, snap_diff.deleted, new_date))
+
+        def _write():
+            for df, is_update in [(snap_diff.changed, True), (snap_diff.new, False)]:
+                if df.shape[0] > 0:
+                    write(mongo_col, df, new_date, is_update, args.batch_size)
+            return snap_diff.changed.shape[0] + snap_diff.new.shape[0]
+
+        run_stage("write", _write)
+
+        curr_df = read_snapshot(in_csv, use_cache=True)
+        mapped_df = []
+
+        def _match():
+            mapped_df.append(map_cases(curr_df))
+            return curr_df.shape[0]
+
+        run_stage("location_match", _match)
+        summary_dfs = {}
+
+        def _summary():
+            summary_dfs["cases.stats"] = province_stats(mapped_df[0], new_date)
+            summary_dfs["cases.summary"] = national_summary(curr_df, new_date)
+            return curr_df.shape[0]
+
+        run_stage("summary", _summary)
+
+        def _summary_write():
+            for col_name, df in summary_dfs.items():
+                load(
+                    mongo_db,
+                    col_name,
+                    df,
+                    indexes=summary_indexes(col_name),
+                    batch_size=args.batch_size,
+                )
+            return sum(df.shape[0] for df in summary_dfs.values())
+
+        run_stage("summary_write", _summary_write)
+    finally:
+        for col_name in BENCH_COLS:
+            mongo_db.drop_collection(col_name)
+        cleanup()
+    return bench.report()["stages"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline.")
+    parser.add_argument("--work-dir", type=Path, help="defaults to a temporary dir")
+    parser.add_argument("--keep", action="store_true", help="keep the work dir")
+    parser.add_argument("--output", type=Path, help="write the results as json")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--churn", type=float, default=0.02)
+    parser.add_argument("--new-rate", type=float, default=0.01)
+    parser.add_argument("--delete-rate", type=float, default=0.001)
+    parser.add_argument("--parts", type=int, default=1)
+    parser.add_argument("--dirty", type=float, default=0.05)
+    parser.add_argument("--drift", choices=DRIFT_CHOICES, default="none")
+    parser.add_argument(
+        "--cold-lookup",
+        action="store_true",
+        help="start with empty location lookups so every name is fuzzy matched",
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None)
+    mongo = parser.add_mutually_exclusive_group()
+    mongo.add_argument("--mongo-url", help="benchmark against this server")
+    mongo.add_argument(
+        "--mongod", help="spawn this mongod binary, mongomock is used by default"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    repo_dir = Path.cwd()
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="bench_"))
+    output = args.output.resolve() if args.output else None
+    generate(
+        work_dir,
+        args.rows,
+        days=2,
+        churn=args.churn,
+        new_rate=args.new_rate,
+        delete_rate=args.delete_rate,
+        parts=args.parts,
+        dirty=args.dirty,
+        drift=args.drift,
+    )
+    # every pipeline path is relative to the working directory
+    if not args.cold_lookup:
+        shutil.copytree(
+            LOC_CITY_MUN_SAV.parent,
+            work_dir / LOC_CITY_MUN_SAV.parent,
+            dirs_exist_ok=True,
+        )
+    if (repo_dir / "input/shp").is_dir() and not (work_dir / "input/shp").exists():
+        (work_dir / "input/shp").symlink_to(repo_dir / "input/shp")
+    if not all((repo_dir / shp).is_file() for shp in BOUNDARY_SHP.values()):
+        print("Boundary shapefiles not found, using the location lookup instead")
+        use_boundaries(lookup_boundaries())
+    os.chdir(work_dir)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(repo_dir)
+        if args.work_dir is None and not args.keep:
+            shutil.rmtree(work_dir, True)
+    report = dict(params=vars(args), stages=results)
+    if output is not None:
+        output.write_text(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
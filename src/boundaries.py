@@ -0,0 +1,97 @@
+import hashlib
+
+import pandas as pd
+
+from constants import BOUNDARY_CACHE_DIR
+
+BOUNDARY_SHP = dict(
+    city_mun="input/shp/Municipalities/Municipalities.shp",
+    province="input/shp/Provinces/Provinces.shp",
+    region="input/shp/Regions/Regions.shp",
+)
+BOUNDARY_COLS = dict(
+    city_mun=["ADM3_EN", "ADM3_PCODE", "ADM2_EN", "ADM1_EN"],
+    province=["ADM2_EN", "ADM2_PCODE", "ADM1_EN"],
+    region=["ADM1_EN", "ADM1_PCODE"],
+)
+
+# attribute tables already loaded by this process, by level
+_BOUNDARIES = {}
+
+
+def boundary_cache_file(level):
+    """Get the cached attribute table of a boundary level.
+
+    The file is keyed by the checksum of the shapefile's .dbf, where its
+    attributes are stored.
+
+    Args:
+        level (str): One of BOUNDARY_SHP.
+
+    Returns:
+        pathlib.Path: The csv file, which may not exist yet.
+    """
+    key = hashlib.sha1()
+    with open(BOUNDARY_SHP[level][:-4] + ".dbf", "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            key.update(block)
+    return BOUNDARY_CACHE_DIR / "{}.{}.csv".format(level, key.hexdigest()[:16])
+
+
+def build_boundaries(level):
+    """Extract the attribute table of a boundary shapefile into the cache.
+
+    Args:
+        level (str): One of BOUNDARY_SHP.
+
+    Returns:
+        pandas.DataFrame: The name and PCODE columns of the level.
+    """
+    import geopandas as gpd
+
+    cache_file = boundary_cache_file(level)
+    print("Building {} boundary attributes...".format(level))
+    attr_df = pd.DataFrame(
+        gpd.read_file(BOUNDARY_SHP[level], ignore_geometry=True)[BOUNDARY_COLS[level]]
+    )
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    attr_df.to_csv(cache_file, index=False)
+    for stale_file in cache_file.parent.glob("{}.*.csv".format(level)):
+        if stale_file != cache_file:
+            stale_file.unlink()
+    return attr_df
+
+
+def load_boundaries(level):
+    """Load the attribute table of a boundary level.
+
+    Reads the cached table, building it from the shapefile on first use.
+    Geometry is never read.
+
+    Args:
+        level (str): One of BOUNDARY_SHP.
+
+    Returns:
+        pandas.DataFrame: The name and PCODE columns of the level.
+    """
+    if level not in _BOUNDARIES:
+        cache_file = boundary_cache_file(level)
+        if cache_file.is_file():
+            _BOUNDARIES[level] = pd.read_csv(cache_file, dtype=str)
+        else:
+            _BOUNDARIES[level] = build_boundaries(level)
+    return _BOUNDARIES[level].copy()
+
+
+def use_boundaries(attr_dfs):
+    """Use these attribute tables instead of loading the shapefiles.
+
+    Args:
+        attr_dfs (dict): Level to its attribute table, with the BOUNDARY_COLS.
+    """
+    _BOUNDARIES.update(attr_dfs)
+
+
+if __name__ == "__main__":
+    for level in BOUNDARY_SHP:
+        build_boundaries(level)
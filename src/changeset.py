@@ -0,0 +1,262 @@
+import json
+import shutil
+
+import pandas as pd
+
+from constants import CHANGESET_DIR
+from diff import (
+    SnapshotDiff,
+    changed_columns,
+    diff_chunks,
+    fingerprint_cols,
+    index_snapshot,
+)
+from instrument import stage
+from models import print_timings
+from snapshot import (
+    decode_frame,
+    encode_frame,
+    iter_snapshot,
+    snapshot_columns,
+    snapshot_date,
+)
+
+# files of a changeset, one per class of change
+CHANGESET_FILES = dict(
+    new="new.parquet", changed="changed.parquet", deleted="deleted.parquet"
+)
+SUMMARY_FILE = "summary.json"
+
+
+def changeset_dir(new_date, root=CHANGESET_DIR):
+    """Get the directory of a day's changeset.
+
+    Args:
+        new_date (pandas.Timestamp): Date of the current snapshot.
+        root (pathlib.Path, optional): Directory of the changesets.
+
+    Returns:
+        pathlib.Path: `<root>/<date>`, which may not exist yet.
+    """
+    return root / new_date.strftime("%Y%m%d")
+
+
+def diff_files(
+    in_csv0, in_csv, chunk_size=None, use_cache=True, workers=1, compact=False
+):
+    """Classify the rows of a snapshot against the previous one.
+
+    Args:
+        in_csv0 (pathlib.Path): The previous snapshot.
+        in_csv (pathlib.Path): The current snapshot.
+        chunk_size (int, optional): See snapshot.iter_snapshot.
+        use_cache (bool, optional): See snapshot.iter_snapshot.
+        workers (int, optional): See snapshot.iter_snapshot.
+        compact (bool, optional): See snapshot.iter_snapshot.
+
+    Returns:
+        tuple: The SnapshotDiff and the compared columns.
+    """
+    cols = fingerprint_cols(snapshot_columns(in_csv0), snapshot_columns(in_csv))
+    timings = {}
+    prev_unparsed, unparsed = {}, {}
+    print("Indexing previous snapshot...")
+    with stage("index_prev") as metrics:
+        prev_index = index_snapshot(
+            iter_snapshot(
+                in_csv0,
+                chunk_size,
+                use_cache=use_cache,
+                timings=timings,
+                workers=workers,
+                compact=compact,
+                unparsed=prev_unparsed,
+            ),
+            cols,
+        )
+        metrics["rows"] = prev_index.shape[0]
+        metrics["prep_s"] = round(sum(timings.values()), 3)
+        metrics["unparsed_dates"] = sum(r["count"] for r in prev_unparsed.values())
+    print("Comparing current snapshot...")
+    with stage("diff") as metrics:
+        prep_s = sum(timings.values())
+        snap_diff = diff_chunks(
+            prev_index,
+            iter_snapshot(
+                in_csv,
+                chunk_size,
+                use_cache=use_cache,
+                timings=timings,
+                workers=workers,
+                compact=compact,
+                unparsed=unparsed,
+            ),
+            cols,
+        )
+        metrics["rows"] = (
+            snap_diff.new.shape[0] + snap_diff.changed.shape[0] + snap_diff.unchanged
+        )
+        metrics["prep_s"] = round(sum(timings.values()) - prep_s, 3)
+        metrics["unparsed_dates"] = sum(r["count"] for r in unparsed.values())
+    if len(timings) > 0:
+        print("Prep timings:")
+        print_timings(timings)
+    return snap_diff, cols
+
+
+def _prev_rows(in_csv0, case_codes, chunk_size, use_cache, workers, compact):
+    # previous version of the given cases, read back one chunk at a time
+    rows = [
+        chunk.loc[chunk["caseCode"].isin(case_codes)]
+        for chunk in iter_snapshot(
+            in_csv0, chunk_size, use_cache=use_cache, workers=workers, compact=compact
+        )
+    ]
+    return pd.concat(rows, ignore_index=True)
+
+
+def changeset_summary(
+    snap_diff, new_date, prev_date=None, snapshots=(), cols=(), col_counts=None
+):
+    """Summarize a changeset.
+
+    Args:
+        snap_diff (SnapshotDiff): The changes.
+        new_date (pandas.Timestamp): Date of the current snapshot.
+        prev_date (pandas.Timestamp, optional): Date of the previous snapshot,
+            None if the changeset loads a whole snapshot.
+        snapshots (list, optional): Names of the compared snapshot files.
+        cols (list, optional): The compared columns.
+        col_counts (pandas.Series, optional): Number of changed values per
+            column, see diff.changed_columns.
+
+    Returns:
+        dict: The summary saved with the changeset.
+    """
+    if col_counts is None:
+        col_counts = pd.Series(dtype="int64")
+    return dict(
+        date=new_date.isoformat(),
+        prevDate=prev_date.isoformat() if prev_date is not None else None,
+        snapshots=list(snapshots),
+        columns=list(cols),
+        counts=dict(
+            new=snap_diff.new.shape[0],
+            changed=snap_diff.changed.shape[0],
+            deleted=len(snap_diff.deleted),
+            unchanged=snap_diff.unchanged,
+        ),
+        changedColumns=col_counts.sort_values(ascending=False).to_dict(),
+    )
+
+
+def compute_changeset(
+    in_csv0, in_csv, chunk_size=None, use_cache=True, workers=1, compact=False
+):
+    """Compute the changes between two snapshots from the files alone.
+
+    Args:
+        in_csv0 (pathlib.Path): The previous snapshot.
+        in_csv (pathlib.Path): The current snapshot.
+        chunk_size (int, optional): See snapshot.iter_snapshot.
+        use_cache (bool, optional): See snapshot.iter_snapshot.
+        workers (int, optional): See snapshot.iter_snapshot.
+        compact (bool, optional): See snapshot.iter_snapshot.
+
+    Returns:
+        tuple: The SnapshotDiff and its summary, i.e. the dates, the counts
+            of each class of change and the number of changed values of
+            each column.
+    """
+    snap_diff, cols = diff_files(
+        in_csv0, in_csv, chunk_size, use_cache, workers, compact
+    )
+    with stage("changed_columns") as metrics:
+        prev_df = _prev_rows(
+            in_csv0,
+            set(snap_diff.changed["caseCode"]),
+            chunk_size,
+            use_cache,
+            workers,
+            compact,
+        )
+        col_counts = changed_columns(prev_df, snap_diff.changed, cols)
+        metrics["rows"] = snap_diff.changed.shape[0]
+    summary = changeset_summary(
+        snap_diff,
+        snapshot_date(in_csv),
+        snapshot_date(in_csv0),
+        [in_csv0.name, in_csv.name],
+        cols,
+        col_counts,
+    )
+    return snap_diff, summary
+
+
+def write_changeset(out_dir, snap_diff, summary):
+    """Save a changeset as parquet files and a json summary.
+
+    The files are written to a temporary directory first, an existing
+    changeset is only replaced once the new one is complete.
+
+    Args:
+        out_dir (pathlib.Path): The changeset directory, see changeset_dir.
+        snap_diff (SnapshotDiff): The changes.
+        summary (dict): See compute_changeset.
+
+    Returns:
+        pathlib.Path: The changeset directory.
+    """
+    tmp_dir = out_dir.with_name(out_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    try:
+        frames = dict(
+            new=snap_diff.new,
+            changed=snap_diff.changed,
+            deleted=pd.DataFrame({"caseCode": snap_diff.deleted}, dtype=object),
+        )
+        for name, df in frames.items():
+            encode_frame(df).to_parquet(tmp_dir / CHANGESET_FILES[name], index=False)
+        (tmp_dir / SUMMARY_FILE).write_text(json.dumps(summary, indent=2))
+        shutil.rmtree(out_dir, ignore_errors=True)
+        tmp_dir.rename(out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print("Changeset saved to {}".format(out_dir))
+    return out_dir
+
+
+def read_changeset(in_dir):
+    """Load a changeset saved by write_changeset.
+
+    Args:
+        in_dir (pathlib.Path): The changeset directory.
+
+    Returns:
+        tuple: The SnapshotDiff and its summary.
+    """
+    summary = json.loads((in_dir / SUMMARY_FILE).read_text())
+    frames = {}
+    for name, file_name in CHANGESET_FILES.items():
+        df = pd.read_parquet(in_dir / file_name)
+        # columns of an empty frame are stored untyped
+        frames[name] = decode_frame(df) if df.shape[0] > 0 else df
+    snap_diff = SnapshotDiff(
+        new=frames["new"],
+        changed=frames["changed"],
+        deleted=frames["deleted"]["caseCode"].to_list(),
+        unchanged=summary["counts"]["unchanged"],
+    )
+    return snap_diff, summary
+
+
+def print_changeset(summary):
+    """Print the counts of a changeset summary."""
+    print("Changes from {prevDate} to {date}:".format(**summary))
+    for name, count in summary["counts"].items():
+        print(f"  {name}: {count}")
+    if len(summary["changedColumns"]) > 0:
+        print("Changed values per column:")
+        for col_name, count in summary["changedColumns"].items():
+            print(f"  {col_name}: {count}")
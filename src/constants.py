@@ -2,3 +2,25 @@ from pathlib import Path
 
 CASE_INFO_CSV_DIR = Path("input/csv/case_info")
 TZ = "Asia/Manila"
+# number of csv rows read and prepared at a time when streaming a snapshot
+CHUNK_SIZE = 200000
+# number of cases sent per bulk write
+BATCH_SIZE = 20000
+# threads sending bulk writes concurrently
+WRITE_WORKERS = 4
+# bulk writes in flight at most, bounds the memory held by pending batches
+WRITE_QUEUE_DEPTH = 8
+# prepared snapshots, stored as parquet so each csv is only parsed once
+SNAPSHOT_CACHE_DIR = Path("input/cache/case_info")
+# processes parsing the parts of a split snapshot, None uses every core
+READ_WORKERS = None
+# attribute tables of the boundary shapefiles, without their geometry
+BOUNDARY_CACHE_DIR = Path("input/cache/boundaries")
+# json metrics of each pipeline run
+METRICS_DIR = Path("output/metrics")
+# peak memory (MB) a stage may use before the run warns, None to not check
+MEMORY_BUDGET_MB = None
+# day-to-day changes computed offline by update_db --dry-run
+CHANGESET_DIR = Path("output/changesets")
+# append-only log of the changes applied to the cases collection, see journal.py
+JOURNAL_DIR = Path("output/journal")
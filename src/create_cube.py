@@ -0,0 +1,430 @@
+import sys
+import argparse
+from pathlib import Path
+from dotenv import dotenv_values
+from pymongo import DeleteOne, MongoClient, ReplaceOne
+
+import numpy as np
+import pandas as pd
+
+from constants import (
+    BATCH_SIZE,
+    MEMORY_BUDGET_MB,
+    READ_WORKERS,
+    TZ,
+    WRITE_QUEUE_DEPTH,
+    WRITE_WORKERS,
+)
+from create_summary import SUMMARY_COLS, map_cases
+from instrument import finish_run, stage, start_run
+from loader import swap_collection
+from snapshot import list_snapshots, read_snapshot, snapshot_date
+from writer import iter_writes
+
+config = dotenv_values()
+
+# pre-aggregated case counts read by the dashboards instead of the cases
+CUBE_COL = "cases.cube"
+# case fields the cube is counted from
+CUBE_COLS = SUMMARY_COLS + ["sex", "age", "dateRepConf"]
+# fields identifying a document of the cube, i.e. a location and report date
+CUBE_KEYS = ["level", "psgc", "dateRepConf"]
+# fields of the counters within a document
+CUBE_DIMS = ["healthStatus", "sex", "ageBand"]
+# lower bound of each age band, the last band is open ended
+AGE_BANDS = [0, 10, 20, 30, 40, 50, 60, 70, 80]
+# PSGC levels of the cube, with the number of leading characters of the code
+# that identify a location of the level, e.g. "PH1374" for a province
+CUBE_LEVELS = dict(region=4, province=6, cityMun=8)
+PSGC_WIDTH = 11
+# documents read back per query when updating the cube
+CUBE_FETCH_SIZE = 1000
+
+# a dashboard reads a location over a range of report dates
+CUBE_INDEXES = [([(k, 1) for k in CUBE_KEYS], dict(unique=True))]
+
+
+def age_band(age):
+    """Get the age band of ages.
+
+    Args:
+        age (pandas.Series): Ages, -1 if missing.
+
+    Returns:
+        pandas.Series: The band of each age, e.g. "20-29" or "80+", "" if the
+            age is missing.
+    """
+    labels = [
+        "{}-{}".format(lo, hi - 1) for lo, hi in zip(AGE_BANDS[:-1], AGE_BANDS[1:])
+    ] + ["{}+".format(AGE_BANDS[-1])]
+    bands = pd.cut(age, AGE_BANDS + [np.inf], right=False, labels=labels)
+    return bands.astype(object).where(bands.notna(), "")
+
+
+def _date_key(col):
+    # report dates as int64 UTC nanoseconds, 0 if missing like in the cases;
+    # stored (naive UTC) and prepared (localized) dates give the same key
+    codes, uniques = pd.factorize(col)
+    values = pd.Series(list(uniques), dtype=object)
+    dates = pd.to_datetime(values.where(values.ne(0)), utc=True)
+    keys = dates.dt.tz_convert(None).to_numpy(dtype="datetime64[ns]").view("i8")
+    keys = np.append(np.where(dates.isna(), 0, keys), 0)
+    return keys[codes]
+
+
+def _key_date(keys):
+    # inverse of _date_key, localized dates and 0 for the missing ones
+    codes, uniques = pd.factorize(keys)
+    dates = pd.to_datetime(uniques, utc=True).tz_convert(TZ).astype(object)
+    values = np.where(uniques != 0, dates, 0)
+    return values[codes]
+
+
+def _level_psgc(psgc, width):
+    # PSGC of the location of a level containing each code, "" if the code
+    # only locates a higher level, e.g. the province part of a region code
+    prefix = pd.Series(psgc, dtype=object).str.slice(0, width)
+    is_level = prefix.str.len().eq(width) & ~prefix.str.endswith("00")
+    return prefix.str.pad(PSGC_WIDTH, "right", "0").where(is_level, "")
+
+
+def _empty_counts():
+    return pd.Series(
+        [],
+        index=pd.MultiIndex.from_arrays(
+            [[]] * len(CUBE_KEYS + CUBE_DIMS), names=CUBE_KEYS + CUBE_DIMS
+        ),
+        dtype="int64",
+    )
+
+
+def count_cube(df):
+    """Count cases by location, report date, health status, sex and age band.
+
+    Cases are counted at each level of CUBE_LEVELS. A case whose PSGC only
+    resolved to a region or a province is left out of the lower levels.
+
+    Args:
+        df (pandas.DataFrame): Case data with the CUBE_COLS, one row per case.
+
+    Returns:
+        pandas.Series: The counts, indexed by the CUBE_KEYS and CUBE_DIMS,
+            with the report date as int64 UTC nanoseconds, 0 if missing.
+    """
+    if df.shape[0] == 0:
+        return _empty_counts()
+    mapped_df = map_cases(df[CUBE_COLS].reset_index(drop=True))
+    # rows are reduced to their distinct values first, the keys are then
+    # derived once per group rather than once per case
+    raw = (
+        mapped_df.groupby(
+            ["cityMuniPSGC", "dateRepConf", "healthStatus", "sex", "age"],
+            sort=False,
+            observed=True,
+            dropna=False,
+        )
+        .size()
+        .reset_index(name="count")
+    )
+    raw["dateRepConf"] = _date_key(raw["dateRepConf"])
+    raw["ageBand"] = age_band(raw["age"])
+    for col_name in ["cityMuniPSGC", "healthStatus", "sex"]:
+        raw[col_name] = raw[col_name].astype(object).fillna("")
+    counts = []
+    for level, width in CUBE_LEVELS.items():
+        level_df = raw.assign(level=level, psgc=_level_psgc(raw["cityMuniPSGC"], width))
+        level_df = level_df.loc[level_df["psgc"] != ""]
+        counts.append(
+            level_df.groupby(CUBE_KEYS + CUBE_DIMS, sort=False)["count"].sum()
+        )
+    return pd.concat(counts)
+
+
+def cube_docs(counts, new_date):
+    """Group cube counts into the documents of the cube collection.
+
+    Each location and report date is a document holding its total and its
+    counters, so a dashboard reads one small document per date.
+
+    Args:
+        counts (pandas.Series): See count_cube, counters below 1 are left out.
+        new_date (pandas.Timestamp): Date of the snapshot.
+
+    Returns:
+        list: The documents, ordered by their CUBE_KEYS.
+    """
+    flat = counts.loc[counts > 0].sort_index().rename("count").reset_index()
+    if flat.shape[0] == 0:
+        return []
+    keys = flat[CUBE_KEYS]
+    is_start = keys.ne(keys.shift()).any(axis=1).to_numpy()
+    starts = np.flatnonzero(is_start).tolist() + [flat.shape[0]]
+    counters = [
+        dict(zip(CUBE_DIMS + ["count"], row))
+        for row in zip(*[flat[c].tolist() for c in CUBE_DIMS + ["count"]])
+    ]
+    totals = np.add.reduceat(flat["count"].to_numpy(), starts[:-1]).tolist()
+    heads = flat.iloc[starts[:-1]]
+    return [
+        dict(
+            level=level,
+            psgc=psgc,
+            dateRepConf=date,
+            count=total,
+            counts=counters[i:j],
+            updatedAt=new_date,
+        )
+        for level, psgc, date, total, i, j in zip(
+            heads["level"].tolist(),
+            heads["psgc"].tolist(),
+            _key_date(heads["dateRepConf"].to_numpy()).tolist(),
+            totals,
+            starts[:-1],
+            starts[1:],
+        )
+    ]
+
+
+def read_cube(mongo_col, query=None):
+    """Get stored cube counters.
+
+    Args:
+        mongo_col (pymongo.Collection): The cube collection.
+        query (dict, optional): Filter of the documents read.
+
+    Returns:
+        pandas.Series: See count_cube.
+    """
+    rows = [
+        [doc[k] for k in CUBE_KEYS] + [c[k] for k in CUBE_DIMS + ["count"]]
+        for doc in mongo_col.find(query or {}, CUBE_KEYS + ["counts"])
+        for c in doc["counts"]
+    ]
+    if len(rows) == 0:
+        return _empty_counts()
+    stored_df = pd.DataFrame(rows, columns=CUBE_KEYS + CUBE_DIMS + ["count"])
+    stored_df["dateRepConf"] = _date_key(stored_df["dateRepConf"])
+    return stored_df.set_index(CUBE_KEYS + CUBE_DIMS)["count"].astype("int64")
+
+
+def cube_deltas(old_df, new_df):
+    """Compute the cube counter changes of a set of changed cases.
+
+    Args:
+        old_df (pandas.DataFrame): Stored version of the updated, deleted and
+            new cases, with the CUBE_COLS.
+        new_df (pandas.DataFrame): Current version of the updated and new
+            cases, with the CUBE_COLS.
+
+    Returns:
+        pandas.Series: The non-zero counter deltas, see count_cube.
+    """
+    delta = count_cube(new_df).sub(count_cube(old_df), fill_value=0).astype("int64")
+    return delta.loc[delta != 0]
+
+
+def _cell_filters(cells):
+    # one filter per document, from (level, psgc, date key) tuples
+    dates = _key_date(np.array([c[2] for c in cells], dtype="int64")).tolist()
+    return [
+        dict(level=level, psgc=psgc, dateRepConf=date)
+        for (level, psgc, _), date in zip(cells, dates)
+    ]
+
+
+def update_cube(mongo_db, old_df, new_df, new_date):
+    """Apply a day's changed cases to the cube.
+
+    Only the documents of the locations and report dates the changes touch
+    are read and rewritten, a document left without cases is removed. Run
+    main for a full rebuild.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        old_df (pandas.DataFrame): See cube_deltas.
+        new_df (pandas.DataFrame): See cube_deltas.
+        new_date (pandas.Timestamp): Date of the snapshot.
+
+    Returns:
+        int: Number of documents rewritten or removed.
+    """
+    mongo_col = mongo_db[CUBE_COL]
+    delta = cube_deltas(old_df, new_df)
+    cells = delta.index.droplevel(CUBE_DIMS).unique().tolist()
+    filters = _cell_filters(cells)
+    print("Cube deltas: {} counters in {} documents".format(delta.shape[0], len(cells)))
+    stored = [
+        read_cube(mongo_col, {"$or": filters[i : i + CUBE_FETCH_SIZE]})
+        for i in range(0, len(filters), CUBE_FETCH_SIZE)
+    ]
+    counts = pd.concat([_empty_counts()] + stored).add(delta, fill_value=0)
+    counts = counts.astype("int64")
+    if (counts < 0).any():
+        print(
+            "Warning: {} cube counters went below zero, rebuild the cube with"
+            " create_cube".format((counts < 0).sum())
+        )
+    docs = cube_docs(counts, new_date)
+    written = {tuple(doc[k] for k in CUBE_KEYS) for doc in docs}
+    requests = [
+        ReplaceOne({k: doc[k] for k in CUBE_KEYS}, doc, upsert=True) for doc in docs
+    ]
+    requests += [
+        DeleteOne(cell_filter)
+        for cell_filter in filters
+        if tuple(cell_filter[k] for k in CUBE_KEYS) not in written
+    ]
+    if len(requests) > 0:
+        mongo_col.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def verify_cube(mongo_col, counts):
+    """Compare the stored cube counters with recomputed ones.
+
+    Args:
+        mongo_col (pymongo.Collection): The cube collection.
+        counts (pandas.Series): The recomputed counters, see count_cube.
+
+    Returns:
+        int: Number of counters that differ.
+    """
+    diff = counts.sub(read_cube(mongo_col), fill_value=0)
+    diff = diff.loc[diff != 0]
+    if diff.shape[0] > 0:
+        print("{} counters differ:".format(diff.shape[0]))
+        print(diff.head(20).to_string())
+    else:
+        print("All counters match.")
+    return diff.shape[0]
+
+
+def load_cube(
+    mongo_db,
+    docs,
+    batch_size=BATCH_SIZE,
+    workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+):
+    """Replace the cube documents without an empty window.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        docs (list): See cube_docs.
+        batch_size (int, optional): Number of documents per insert.
+        workers (int, optional): See writer.iter_writes.
+        queue_depth (int, optional): See writer.iter_writes.
+
+    Returns:
+        int: Number of documents loaded.
+    """
+    with swap_collection(mongo_db, CUBE_COL, CUBE_INDEXES) as staging_col:
+        for _ in iter_writes(
+            (docs[i : i + batch_size] for i in range(0, len(docs), batch_size)),
+            lambda batch: staging_col.insert_many(batch, ordered=False),
+            workers,
+            queue_depth,
+        ):
+            pass
+    print("Loaded {} documents into '{}'".format(len(docs), CUBE_COL))
+    return len(docs)
+
+
+def main(
+    workers=READ_WORKERS,
+    verify=False,
+    compact=False,
+    metrics_path=None,
+    profile_dir=None,
+    memory_budget_mb=MEMORY_BUDGET_MB,
+):
+    start_run("create_cube", profile_dir, memory_budget_mb)
+
+    in_csv = list_snapshots()[-1]
+    with stage("read") as metrics:
+        curr_df = read_snapshot(
+            in_csv, use_cache=True, workers=workers, compact=compact
+        )
+        metrics["rows"] = curr_df.shape[0]
+
+    new_date = snapshot_date(in_csv)
+    print("Date: {}".format(new_date))
+
+    with stage("cube") as metrics:
+        counts = count_cube(curr_df)
+        docs = cube_docs(counts, new_date)
+        metrics["rows"] = curr_df.shape[0]
+    print("{} counters in {} documents".format(counts.shape[0], len(docs)))
+
+    # region mongodb
+    print("Connecting to mongodb...")
+    mongo_client = MongoClient(config["MONGO_DB_URL"])
+    if "defaultDb" not in mongo_client.list_database_names():
+        print("Database 'defaultDb' not found... exiting...")
+        mongo_client.close()
+        sys.exit()
+    mongo_db = mongo_client["defaultDb"]
+    print("Connection successful...")
+
+    # rebuild in a staging collection so readers never see an empty one
+    with stage("write") as metrics:
+        if verify:
+            verify_cube(mongo_db[CUBE_COL], counts)
+        print("Adding new data...")
+        metrics["rows"] = load_cube(mongo_db, docs)
+
+    finish_run(metrics_path)
+    mongo_client.close()
+    print("Connection closed...")
+    # endregion mongodb
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the case counts cube from the latest snapshot."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(config.get("READ_WORKERS", 0)) or READ_WORKERS,
+        help="processes parsing the parts of a split snapshot, defaults to all cores",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="report counters that drifted from the recomputed ones",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold the snapshot in compact dtypes, e.g. categoricals",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="save the run metrics to this json file, defaults to METRICS_DIR",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help="save a cProfile dump of each stage to this directory",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=float(config.get("MEMORY_BUDGET_MB", 0)) or MEMORY_BUDGET_MB,
+        help="peak MB of memory each stage may use before a warning",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(
+        workers=args.workers,
+        verify=args.verify,
+        compact=args.compact,
+        metrics_path=args.metrics,
+        profile_dir=args.profile_dir,
+        memory_budget_mb=args.memory_budget,
+    )
@@ -0,0 +1,577 @@
+import argparse
+import heapq
+import json
+from pathlib import Path
+from bson import encode
+from dotenv import dotenv_values
+from pymongo import MongoClient
+
+import numpy as np
+import pandas as pd
+
+from boundaries import BOUNDARY_SHP
+from constants import MEMORY_BUDGET_MB, TZ
+from instrument import finish_run, stage, start_run
+
+config = dotenv_values()
+
+GEOMAP_COL = "geomaps"
+# source of each map layer, a GeoJSON file or a boundary shapefile
+GEOMAP_LAYERS = {
+    "ph-region": BOUNDARY_SHP["region"],
+    "ph-prov": "output/geojson/ph-prov.geojson",
+    "ph-citymun": BOUNDARY_SHP["city_mun"],
+}
+# resolutions stored for each layer, finest first, with the simplification
+# tolerance and the decimals kept, in degrees (0.001 is about 110 m)
+GEOMAP_RESOLUTIONS = dict(
+    high=dict(tolerance=0.0005, precision=5),
+    medium=dict(tolerance=0.002, precision=4),
+    low=dict(tolerance=0.01, precision=3),
+)
+# largest document MongoDB stores
+BSON_SIZE_LIMIT = 16 * 1024 * 1024
+
+# a client reads one resolution of a layer, the full resolution documents
+# from the init migration have no resolution
+GEOMAP_INDEXES = [([("name", 1), ("resolution", 1)], dict(unique=True))]
+
+
+def read_layer(source):
+    """Read a map layer as GeoJSON.
+
+    Args:
+        source (str): A GeoJSON file, or a shapefile, which needs geopandas.
+
+    Returns:
+        dict: The FeatureCollection, with coordinates in degrees.
+    """
+    if source.endswith(".shp"):
+        import geopandas as gpd
+
+        gdf = gpd.read_file(source)
+        if gdf.crs is not None:
+            gdf = gdf.to_crs(epsg=4326)
+        return json.loads(gdf.to_json())
+    with open(source) as f:
+        return json.load(f)
+
+
+def _polygons(geometry):
+    # the polygons of a geometry, each a list of rings, None if not areal
+    if geometry is None:
+        return None
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return None
+
+
+def _ring_area(coords):
+    # unsigned shoelace area of a ring, in square degrees
+    x, y = coords[:, 0], coords[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+class Topology:
+    """The borders of a layer, split into arcs shared by the features.
+
+    Every ring is cut where its neighbours change, i.e. at the points where
+    three or more features meet. The border of two features is then a
+    single arc, which both rings reference, so simplifying each arc once
+    moves both sides alike and no gap or overlap opens between neighbours.
+
+    Args:
+        collection (dict): A GeoJSON FeatureCollection.
+
+    Attributes:
+        arcs (list): Coordinates of each arc, as (n, 2) arrays.
+        uses (numpy.ndarray): Number of rings referencing each arc.
+        features (list): Per feature, None if not areal, else its polygons,
+            each a list of rings, each a list of arc references. A reference
+            `~i` follows arc `i` backwards.
+        areas (list): The area of each ring, laid out like features.
+        crossing (set): Arcs already crossing in the source, None until
+            first simplified.
+    """
+
+    def __init__(self, collection):
+        rings = []
+        shapes = []
+        for feature in collection["features"]:
+            polygons = _polygons(feature.get("geometry"))
+            if polygons is None:
+                shapes.append(None)
+                continue
+            shape = []
+            for polygon in polygons:
+                shape.append([])
+                for ring in polygon:
+                    # drop the closing point and any repeated point
+                    ring = [tuple(p[:2]) for p in ring]
+                    ring = [p for i, p in enumerate(ring) if p != ring[i - 1]]
+                    if len(ring) >= 3:
+                        shape[-1].append(len(rings))
+                        rings.append(ring)
+            shapes.append(shape)
+
+        junctions = self._junctions(rings)
+        self.arcs = []
+        self._ids = {}
+        ring_arcs = [self._cut(ring, junctions) for ring in rings]
+        self.uses = np.zeros(len(self.arcs), dtype="int64")
+        for refs in ring_arcs:
+            for ref in refs:
+                self.uses[ref if ref >= 0 else ~ref] += 1
+        self.arcs = [np.array(arc, dtype="float64") for arc in self.arcs]
+        del self._ids
+
+        self.features = [
+            None if shape is None else [[ring_arcs[r] for r in p] for p in shape]
+            for shape in shapes
+        ]
+        self.areas = [
+            (
+                None
+                if shape is None
+                else [
+                    [_ring_area(np.array(rings[r], dtype="float64")) for r in p]
+                    for p in shape
+                ]
+            )
+            for shape in shapes
+        ]
+        self.n_points = sum(len(ring) + 1 for ring in rings)
+        # arcs crossing in the source, set by simplify_arcs
+        self.crossing = None
+
+    @staticmethod
+    def _junctions(rings):
+        # points whose neighbours differ between the rings through them
+        neighbours = {}
+        junctions = set()
+        for ring in rings:
+            for i, p in enumerate(ring):
+                a, b = ring[i - 1], ring[(i + 1) % len(ring)]
+                pair = (a, b) if a <= b else (b, a)
+                if neighbours.setdefault(p, pair) != pair:
+                    junctions.add(p)
+        return junctions
+
+    def _arc_ref(self, arc):
+        # reference of an arc already seen in either direction, else a new one
+        key = tuple(arc)
+        if key in self._ids:
+            return self._ids[key]
+        key_back = key[::-1]
+        if key_back in self._ids:
+            return ~self._ids[key_back]
+        self._ids[key] = len(self.arcs)
+        self.arcs.append(key)
+        return self._ids[key]
+
+    def _cut(self, ring, junctions):
+        # arc references of a ring, cut at its junctions
+        cuts = [i for i, p in enumerate(ring) if p in junctions]
+        if len(cuts) == 0:
+            # a ring without neighbours changing, e.g. an island or an enclave,
+            # starts at its lowest point so a shared one is found either way
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            ring_back = ring[:1] + ring[:0:-1]
+            if tuple(ring_back + ring_back[:1]) in self._ids:
+                return [~self._ids[tuple(ring_back + ring_back[:1])]]
+            return [self._arc_ref(ring + ring[:1])]
+        ring = ring[cuts[0] :] + ring[: cuts[0] + 1]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring) - 1]
+        return [self._arc_ref(ring[i : j + 1]) for i, j in zip(cuts[:-1], cuts[1:])]
+
+
+def simplify_arc(coords, tolerance, min_points=2):
+    """Simplify a line with Douglas-Peucker, keeping its end points.
+
+    The segment furthest from the simplified line is split first, so the
+    points kept for min_points are the most significant ones.
+
+    Args:
+        coords (numpy.ndarray): The (n, 2) points of the line.
+        tolerance (float): Largest distance a removed point may lie from the
+            simplified line.
+        min_points (int, optional): Points to keep even if within tolerance,
+            4 keeps a closed ring from collapsing.
+
+    Returns:
+        numpy.ndarray: The kept points.
+    """
+    n = coords.shape[0]
+    if n <= 2:
+        return coords
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    kept = 2
+    heap = []
+
+    def push(i, j):
+        if j - i < 2:
+            return
+        a, b = coords[i], coords[j]
+        points = coords[i + 1 : j] - a
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            dist = np.hypot(points[:, 0], points[:, 1])
+        else:
+            dist = np.abs(points[:, 0] * ab[1] - points[:, 1] * ab[0]) / length
+        k = int(np.argmax(dist))
+        heapq.heappush(heap, (-dist[k], i, i + 1 + k, j))
+
+    push(0, n - 1)
+    while len(heap) > 0:
+        dist, i, k, j = heapq.heappop(heap)
+        if -dist <= tolerance and kept >= min_points:
+            break
+        keep[k] = True
+        kept += 1
+        push(i, k)
+        push(k, j)
+    return coords[keep]
+
+
+def _drop_repeats(coords):
+    # points equal to the previous one are left out
+    is_new = np.ones(coords.shape[0], dtype=bool)
+    is_new[1:] = (coords[1:] != coords[:-1]).any(axis=1)
+    return coords[is_new]
+
+
+def quantize(coords, precision):
+    """Round points to a number of decimals, dropping the repeated ones.
+
+    Args:
+        coords (numpy.ndarray): The (n, 2) points of a line.
+        precision (int): Decimals kept.
+
+    Returns:
+        numpy.ndarray: The rounded points.
+    """
+    return _drop_repeats(np.round(coords, precision))
+
+
+def _join_ring(refs, arcs):
+    # closed ring of an arc reference list, as a GeoJSON coordinate list
+    parts = [arcs[ref] if ref >= 0 else arcs[~ref][::-1] for ref in refs]
+    coords = np.concatenate([parts[0]] + [p[1:] for p in parts[1:]])
+    coords = _drop_repeats(coords)
+    if coords.shape[0] < 4 or _ring_area(coords) == 0:
+        return None
+    return coords.tolist()
+
+
+def crossing_arcs(arcs):
+    """Find the arcs with a segment crossing another segment.
+
+    Segments are bucketed into a grid about one segment wide, only the
+    segments sharing a cell are tested. Segments sharing an end point,
+    touching ones and collinear overlaps are not reported.
+
+    Args:
+        arcs (list): Coordinates of each arc, as (n, 2) arrays.
+
+    Returns:
+        numpy.ndarray: Indices of the crossing arcs.
+    """
+    lengths = np.array([max(arc.shape[0] - 1, 0) for arc in arcs])
+    if lengths.sum() == 0:
+        return np.array([], dtype="int64")
+    starts = np.concatenate([arc[:-1] for arc in arcs])
+    ends = np.concatenate([arc[1:] for arc in arcs])
+    arc_ids = np.repeat(np.arange(len(arcs)), lengths)
+
+    size = np.median(np.abs(ends - starts).max(axis=1))
+    size = size if size > 0 else 1.0
+    lo = np.floor(np.minimum(starts, ends) / size).astype("int64")
+    hi = np.floor(np.maximum(starts, ends) / size).astype("int64")
+    nx, ny = (hi - lo + 1).T
+    n_cells = nx * ny
+    seg = np.repeat(np.arange(starts.shape[0]), n_cells)
+    k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    cells_df = pd.DataFrame(
+        dict(cx=lo[seg, 0] + k % nx[seg], cy=lo[seg, 1] + k // nx[seg], seg=seg)
+    )
+    pairs = cells_df.merge(cells_df, on=["cx", "cy"])
+    pairs = pairs.loc[pairs["seg_x"] < pairs["seg_y"], ["seg_x", "seg_y"]]
+    pairs = pairs.drop_duplicates()
+    a, b = pairs["seg_x"].to_numpy(), pairs["seg_y"].to_numpy()
+    p1, p2, q1, q2 = starts[a], ends[a], starts[b], ends[b]
+
+    def orient(o, p, q):
+        return (p[:, 0] - o[:, 0]) * (q[:, 1] - o[:, 1]) - (p[:, 1] - o[:, 1]) * (
+            q[:, 0] - o[:, 0]
+        )
+
+    shared = np.zeros(a.shape[0], dtype=bool)
+    for p in [p1, p2]:
+        for q in [q1, q2]:
+            shared |= (p == q).all(axis=1)
+    is_crossing = (
+        (orient(q1, q2, p1) * orient(q1, q2, p2) < 0)
+        & (orient(p1, p2, q1) * orient(p1, p2, q2) < 0)
+        & ~shared
+    )
+    return np.unique(np.concatenate([arc_ids[a[is_crossing]], arc_ids[b[is_crossing]]]))
+
+
+def simplify_arcs(topology, tolerance, precision):
+    """Simplify and round the arcs of a layer.
+
+    An arc that crosses itself or another arc once simplified is kept at
+    full detail instead, unless it already crossed in the source. Touching
+    and overlapping borders are not checked, see crossing_arcs.
+
+    Args:
+        topology (Topology): The arcs of the layer.
+        tolerance (float): See simplify_arc, in degrees.
+        precision (int): See quantize.
+
+    Returns:
+        list: Coordinates of each arc, as (n, 2) arrays.
+    """
+    arcs = [
+        quantize(
+            simplify_arc(arc, tolerance, 4 if (arc[0] == arc[-1]).all() else 2),
+            precision,
+        )
+        for arc in topology.arcs
+    ]
+    if topology.crossing is None:
+        topology.crossing = set(crossing_arcs(topology.arcs).tolist())
+    reverted = set()
+    while True:
+        crossing = set(crossing_arcs(arcs).tolist()) - reverted - topology.crossing
+        if len(crossing) == 0:
+            break
+        for i in crossing:
+            arcs[i] = topology.arcs[i]
+        reverted |= crossing
+    if len(reverted) > 0:
+        print("{} arcs kept at full detail to avoid crossings".format(len(reverted)))
+    return arcs
+
+
+def simplify_layer(collection, topology, tolerance, precision):
+    """Build a simplified version of a layer.
+
+    The arcs are simplified by simplify_arcs. A ring of its own, i.e. not
+    bordering another feature, with an area under the square of tolerance
+    is left out unless it is the largest ring of its feature, as is a ring
+    that collapsed.
+
+    Args:
+        collection (dict): The GeoJSON FeatureCollection of the layer.
+        topology (Topology): The arcs of the collection.
+        tolerance (float): See simplify_arc, in degrees.
+        precision (int): See quantize.
+
+    Returns:
+        dict: The simplified FeatureCollection, features keep their
+            properties and order.
+    """
+    arcs = simplify_arcs(topology, tolerance, precision)
+    features = []
+    for feature, shape, areas in zip(
+        collection["features"], topology.features, topology.areas
+    ):
+        if shape is None:
+            features.append(feature)
+            continue
+        largest = max(
+            ((a, i) for i, p in enumerate(areas) for a in p[:1]), default=(0, -1)
+        )[1]
+        polygons = []
+        for i, (polygon, polygon_areas) in enumerate(zip(shape, areas)):
+            rings = []
+            for j, (refs, area) in enumerate(zip(polygon, polygon_areas)):
+                is_own = len(refs) == 1 and topology.uses[max(refs[0], ~refs[0])] == 1
+                if is_own and area < tolerance**2 and (i, j) != (largest, 0):
+                    ring = None
+                else:
+                    ring = _join_ring(refs, arcs)
+                if ring is None and j == 0:
+                    break
+                if ring is not None:
+                    rings.append(ring)
+            if len(rings) > 0:
+                polygons.append(rings)
+        if len(polygons) == 0 and largest >= 0:
+            # too small to survive the tolerance, kept at full detail
+            ring = _join_ring(shape[largest][0], topology.arcs)
+            polygons = [[ring]] if ring is not None else []
+        if len(polygons) == 1:
+            geometry = dict(type="Polygon", coordinates=polygons[0])
+        else:
+            geometry = dict(type="MultiPolygon", coordinates=polygons)
+        features.append(dict(feature, geometry=geometry))
+    return dict(collection, features=features)
+
+
+def count_points(collection):
+    """Count the points of the areal features of a layer.
+
+    Args:
+        collection (dict): A GeoJSON FeatureCollection.
+
+    Returns:
+        int: Number of points, closing points included.
+    """
+    return sum(
+        len(ring)
+        for feature in collection["features"]
+        for polygon in _polygons(feature.get("geometry")) or []
+        for ring in polygon
+    )
+
+
+def build_geomaps(name, collection, resolutions=GEOMAP_RESOLUTIONS):
+    """Build the simplified resolutions of a layer.
+
+    Args:
+        name (str): The layer, e.g. "ph-prov".
+        collection (dict): Its full resolution GeoJSON FeatureCollection.
+        resolutions (dict, optional): See GEOMAP_RESOLUTIONS.
+
+    Returns:
+        list: The geomaps documents, without updatedAt, see report_sizes.
+    """
+    with stage("topology") as metrics:
+        topology = Topology(collection)
+        metrics["rows"] = len(topology.arcs)
+    print(
+        "{}: {} features, {} points in {} arcs".format(
+            name, len(collection["features"]), topology.n_points, len(topology.arcs)
+        )
+    )
+    docs = []
+    for resolution, options in resolutions.items():
+        with stage("simplify.{}".format(resolution)) as metrics:
+            geo = simplify_layer(collection, topology, **options)
+            metrics["rows"] = count_points(geo)
+        docs.append(dict(name=name, resolution=resolution, **options, geo=geo))
+    return docs
+
+
+def report_sizes(name, collection, docs):
+    """Print the points and sizes of each resolution of a layer.
+
+    The BSON size is what the document takes in MongoDB, where rounding does
+    not shrink a coordinate, the JSON size is what a client downloads.
+
+    Args:
+        name (str): The layer.
+        collection (dict): Its full resolution GeoJSON FeatureCollection.
+        docs (list): Output of build_geomaps.
+
+    Returns:
+        pandas.DataFrame: The points, BSON and JSON bytes of each resolution
+            and their share of the full resolution, indexed by resolution.
+    """
+    rows = [
+        dict(
+            resolution=doc.get("resolution", "full"),
+            points=count_points(doc["geo"]),
+            bson_bytes=len(encode(doc)),
+            json_bytes=len(json.dumps(doc["geo"], separators=(",", ":"))),
+        )
+        for doc in [dict(name=name, geo=collection)] + docs
+    ]
+    size_df = pd.DataFrame(rows).set_index("resolution")
+    for col_name in ["bson", "json"]:
+        size_df["{}_ratio".format(col_name)] = (
+            size_df["{}_bytes".format(col_name)]
+            / size_df.loc["full", "{}_bytes".format(col_name)]
+        ).round(4)
+    print("Sizes of '{}':".format(name))
+    print(size_df.to_string())
+    return size_df
+
+
+def main(layers=None, metrics_path=None, profile_dir=None, memory_budget_mb=None):
+    start_run("create_geomaps", profile_dir, memory_budget_mb)
+    new_date = pd.Timestamp.now(tz=TZ)
+
+    # region mongodb
+    print("Connecting to mongodb...")
+    mongo_client = MongoClient(config["MONGO_DB_URL"])
+    mongo_db = mongo_client["defaultDb"]
+    mongo_col = mongo_db[GEOMAP_COL]
+    print("Connection successful...")
+    # endregion mongodb
+
+    for name in layers or GEOMAP_LAYERS:
+        source = GEOMAP_LAYERS[name]
+        if not Path(source).is_file():
+            print("{} not found, skipping '{}'".format(source, name))
+            continue
+        with stage("read") as metrics:
+            collection = read_layer(source)
+            metrics["rows"] = len(collection["features"])
+        docs = build_geomaps(name, collection)
+        size_df = report_sizes(name, collection, docs)
+
+        with stage("write") as metrics:
+            for doc in docs:
+                if size_df.loc[doc["resolution"], "bson_bytes"] > BSON_SIZE_LIMIT:
+                    print(
+                        "Warning: '{}' {} is over the BSON size limit, not"
+                        " stored".format(name, doc["resolution"])
+                    )
+                    continue
+                mongo_col.replace_one(
+                    {"name": name, "resolution": doc["resolution"]},
+                    dict(doc, updatedAt=new_date),
+                    upsert=True,
+                )
+            metrics["rows"] = len(docs)
+
+    finish_run(metrics_path)
+    mongo_client.close()
+    print("Connection closed...")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Store simplified resolutions of the map layers."
+    )
+    parser.add_argument(
+        "--layers",
+        nargs="+",
+        choices=list(GEOMAP_LAYERS),
+        help="layers to build, defaults to all",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="save the run metrics to this json file, defaults to METRICS_DIR",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help="save a cProfile dump of each stage to this directory",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=float(config.get("MEMORY_BUDGET_MB", 0)) or MEMORY_BUDGET_MB,
+        help="peak MB of memory each stage may use before a warning",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(
+        layers=args.layers,
+        metrics_path=args.metrics,
+        profile_dir=args.profile_dir,
+        memory_budget_mb=args.memory_budget,
+    )
@@ -1,37 +1,43 @@
 import sys
+import argparse
+from pathlib import Path
 from dotenv import dotenv_values
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
 import pandas as pd
 
-from constants import CASE_INFO_CSV_DIR, TZ
-from models import prep_cases_df
+from aggregate import SUMMARY_KEYS, run_summaries, summary_indexes
+from constants import MEMORY_BUDGET_MB, READ_WORKERS
+from history import append_history, history_dates, record_history
+from instrument import finish_run, stage, start_run
+from loader import load_collection
 from make_mappable import make_mappable
+from models import ACTIVE_HEALTH_STATS
+from snapshot import list_snapshots, read_snapshot, snapshot_date
 
 config = dotenv_values()
 
+# case fields the summaries are computed from
+SUMMARY_COLS = [
+    "caseCode",
+    "healthStatus",
+    "regionRes",
+    "provRes",
+    "cityMunRes",
+    "cityMuniPSGC",
+]
 
-def main():
-    in_csvs = list(CASE_INFO_CSV_DIR.glob("*case_info.csv"))
-    in_csvs.sort()
-    in_csv = in_csvs[-1]
 
-    if (CASE_INFO_CSV_DIR / in_csv.name.split(".")[0]).is_dir():
-        _in_csvs = list((CASE_INFO_CSV_DIR / in_csv.name.split(".")[0]).glob("*.csv"))
-        _in_csvs.sort()
-        curr_df = pd.concat(
-            [pd.read_csv(_in_csv, low_memory=False) for _in_csv in _in_csvs],
-            ignore_index=True,
-        )
-    else:
-        curr_df = pd.read_csv(in_csv, low_memory=False)
-    curr_df = prep_cases_df(curr_df)
-    curr_df.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
+def map_cases(curr_df):
+    """Resolve the PSGC of cases without one.
 
-    date_str = in_csv.name.split("_")[0]
-    new_date = pd.to_datetime(date_str).tz_localize(TZ)
-    print("Date: {}".format(new_date))
+    Args:
+        curr_df (pandas.DataFrame): Prepared case data.
 
+    Returns:
+        pandas.DataFrame: The cases with a known "cityMuniPSGC", unresolved
+            ones are left out.
+    """
     _curr_df = curr_df.loc[
         curr_df.cityMuniPSGC.isna() | (curr_df.cityMuniPSGC == "")
     ].copy()
@@ -40,7 +46,7 @@ def main():
         _curr_df.cityMuniPSGC.isna() | (_curr_df.cityMuniPSGC == "")
     ].copy()
     _curr_df = _curr_df.loc[~_curr_df.index.isin(_stats_df.index)].copy()
-    stats_df = pd.concat(
+    return pd.concat(
         [
             curr_df.loc[
                 ~(
@@ -52,28 +58,257 @@ def main():
             _curr_df,
         ]
     )
+
+
+def province_stats(stats_df, new_date):
+    """Count the cases of each province by health status.
+
+    Args:
+        stats_df (pandas.DataFrame): Output of map_cases.
+        new_date (pandas.Timestamp): Date of the snapshot.
+
+    Returns:
+        pandas.DataFrame: The "cases.stats" documents.
+    """
+    stats_df = stats_df[["cityMuniPSGC", "healthStatus", "caseCode"]].copy()
     stats_df["provincePSGC"] = stats_df.cityMuniPSGC.str.slice(0, 6) + "00000"
 
     stats_df = (
-        stats_df.groupby(["provincePSGC", "healthStatus"])["caseCode"]
+        stats_df.groupby(["provincePSGC", "healthStatus"], observed=True)["caseCode"]
         .nunique()
         .reset_index()
     )
-    activeHealthStats = ["asymptomatic", "mild", "moderate", "severe", "critical"]
     stats_active_df = (
-        stats_df.loc[stats_df.healthStatus.isin(activeHealthStats)]
-        .groupby(["provincePSGC"])
+        stats_df.loc[stats_df.healthStatus.isin(ACTIVE_HEALTH_STATS)]
+        .groupby(["provincePSGC"])["caseCode"]
         .sum()
         .reset_index()
     )
     stats_active_df["healthStatus"] = "active"
-    stats_all_df = stats_df.groupby(["provincePSGC"]).sum().reset_index()
+    stats_all_df = stats_df.groupby(["provincePSGC"])["caseCode"].sum().reset_index()
     stats_all_df["healthStatus"] = "all"
     stats_df = pd.concat([stats_all_df, stats_active_df, stats_df])
     stats_df["createdAt"] = new_date
-    stats_df = stats_df.rename(columns={"caseCode": "count"})
+    return stats_df.rename(columns={"caseCode": "count"})
 
-    # region mongodb
+
+def national_summary(curr_df, new_date):
+    """Count all cases by health status.
+
+    Args:
+        curr_df (pandas.DataFrame): Prepared case data.
+        new_date (pandas.Timestamp): Date of the snapshot.
+
+    Returns:
+        pandas.DataFrame: The "cases.summary" documents.
+    """
+    stats_df = (
+        curr_df.groupby(["healthStatus"], observed=True)["caseCode"]
+        .nunique()
+        .reset_index()
+    )
+    stats_active = stats_df.loc[
+        stats_df.healthStatus.isin(ACTIVE_HEALTH_STATS), "caseCode"
+    ].sum()
+    stats_all = stats_df["caseCode"].sum()
+    stats_df = pd.concat(
+        [
+            stats_df,
+            pd.DataFrame(
+                [
+                    {"healthStatus": "all", "caseCode": stats_all},
+                    {"healthStatus": "active", "caseCode": stats_active},
+                ]
+            ),
+        ],
+        ignore_index=True,
+    )
+    stats_df["createdAt"] = new_date
+    return stats_df.rename(columns={"caseCode": "count"})
+
+
+def _add_totals(counts):
+    # append the derived "active" and "all" counters to health status counts
+    status = counts.index.get_level_values("healthStatus")
+    keys = [name for name in counts.index.names if name != "healthStatus"]
+    totals = []
+    for total_status, is_counted in [
+        ("all", None),
+        ("active", status.isin(ACTIVE_HEALTH_STATS)),
+    ]:
+        _counts = counts if is_counted is None else counts.loc[is_counted]
+        if len(keys) > 0:
+            _counts = _counts.groupby(level=keys).sum()
+            _counts.index = pd.MultiIndex.from_arrays(
+                [_counts.index.get_level_values(k) for k in keys]
+                + [[total_status] * len(_counts)],
+                names=keys + ["healthStatus"],
+            )
+        else:
+            _counts = pd.Series(
+                [_counts.sum()], index=pd.Index([total_status], name="healthStatus")
+            )
+        totals.append(_counts)
+    return pd.concat([counts] + totals)
+
+
+def count_cases(df):
+    """Count cases by province and by health status.
+
+    Args:
+        df (pandas.DataFrame): Case data with the SUMMARY_COLS, one row per
+            case.
+
+    Returns:
+        tuple: The province counts indexed by ("provincePSGC", "healthStatus")
+            and the national counts indexed by "healthStatus", both with the
+            "active" and "all" counters.
+    """
+    if df.shape[0] == 0:
+        prov_counts = pd.Series(
+            [],
+            index=pd.MultiIndex.from_arrays(
+                [[], []], names=["provincePSGC", "healthStatus"]
+            ),
+            dtype="int64",
+        )
+        nat_counts = pd.Series([], index=pd.Index([], name="healthStatus"))
+        return prov_counts, nat_counts.astype("int64")
+    mapped_df = map_cases(df[SUMMARY_COLS].reset_index(drop=True))
+    prov_counts = mapped_df.groupby(
+        [mapped_df.cityMuniPSGC.str.slice(0, 6) + "00000", "healthStatus"],
+        observed=True,
+    ).size()
+    prov_counts.index.names = ["provincePSGC", "healthStatus"]
+    nat_counts = df.groupby("healthStatus", observed=True).size()
+    return _add_totals(prov_counts), _add_totals(nat_counts)
+
+
+def summary_deltas(old_df, new_df):
+    """Compute the summary counter changes of a set of changed cases.
+
+    Args:
+        old_df (pandas.DataFrame): Stored version of the updated, deleted and
+            new cases, with the SUMMARY_COLS.
+        new_df (pandas.DataFrame): Current version of the updated and new
+            cases, with the SUMMARY_COLS.
+
+    Returns:
+        tuple: The non-zero province and national counter deltas, see
+            count_cases.
+    """
+    deltas = []
+    for old_counts, new_counts in zip(count_cases(old_df), count_cases(new_df)):
+        delta = new_counts.sub(old_counts, fill_value=0).astype("int64")
+        deltas.append(delta.loc[delta != 0])
+    return tuple(deltas)
+
+
+def fetch_summary_rows(mongo_col, case_codes, cols=SUMMARY_COLS):
+    """Get the stored version of cases, restricted to the SUMMARY_COLS.
+
+    Args:
+        mongo_col (pymongo.Collection): The cases collection.
+        case_codes (list): Case codes to read.
+        cols (list, optional): Fields to read instead of the SUMMARY_COLS.
+
+    Returns:
+        pandas.DataFrame: The cases found in the collection.
+    """
+    projection = {col_name: 1 for col_name in cols}
+    projection["_id"] = 0
+    df = pd.DataFrame(
+        list(mongo_col.find({"caseCode": {"$in": list(case_codes)}}, projection)),
+        columns=cols,
+    )
+    return df.fillna({"healthStatus": "", "cityMuniPSGC": ""})
+
+
+def apply_deltas(mongo_col, delta, new_date, keep_zero=()):
+    """Increment summary counters in place.
+
+    Args:
+        mongo_col (pymongo.Collection): The "cases.stats" or "cases.summary"
+            collection.
+        delta (pandas.Series): Counter deltas, see summary_deltas.
+        new_date (pandas.Timestamp): Date of the snapshot.
+        keep_zero (tuple, optional): Health statuses kept at a zero count,
+            other counters are removed when they drop to zero.
+    """
+    requests = []
+    for keys, count in delta.items():
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        requests.append(
+            UpdateOne(
+                dict(zip(delta.index.names, keys)),
+                {"$inc": {"count": int(count)}},
+                upsert=True,
+            )
+        )
+    if len(requests) > 0:
+        mongo_col.bulk_write(requests, ordered=False)
+    mongo_col.update_many({}, {"$set": {"createdAt": new_date}})
+    mongo_col.delete_many(
+        {"count": {"$lte": 0}, "healthStatus": {"$nin": list(keep_zero)}}
+    )
+
+
+def update_summaries(mongo_db, old_df, new_df, new_date):
+    """Apply a day's changed cases to "cases.stats" and "cases.summary".
+
+    The cost is proportional to the number of changed cases, run main for a
+    full recompute.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        old_df (pandas.DataFrame): See summary_deltas.
+        new_df (pandas.DataFrame): See summary_deltas.
+        new_date (pandas.Timestamp): Date of the snapshot.
+    """
+    prov_delta, nat_delta = summary_deltas(old_df, new_df)
+    print(
+        "Summary deltas: {} province, {} national counters".format(
+            prov_delta.shape[0], nat_delta.shape[0]
+        )
+    )
+    apply_deltas(mongo_db["cases.stats"], prov_delta, new_date)
+    apply_deltas(
+        mongo_db["cases.summary"], nat_delta, new_date, keep_zero=("all", "active")
+    )
+    record_history(mongo_db, new_date)
+
+
+def verify_counts(mongo_col, stats_df, key_cols):
+    """Compare stored summary counters with recomputed ones.
+
+    Args:
+        mongo_col (pymongo.Collection): The summary collection.
+        stats_df (pandas.DataFrame): The recomputed documents.
+        key_cols (list): Columns identifying a counter.
+
+    Returns:
+        int: Number of counters that differ.
+    """
+    stored_df = pd.DataFrame(
+        list(mongo_col.find({}, {col_name: 1 for col_name in key_cols + ["count"]})),
+        columns=key_cols + ["count"],
+    )
+    cmp_df = stored_df.merge(
+        stats_df[key_cols + ["count"]],
+        how="outer",
+        on=key_cols,
+        suffixes=("Stored", "Expected"),
+    ).fillna({"countStored": 0, "countExpected": 0})
+    cmp_df = cmp_df.loc[cmp_df.countStored != cmp_df.countExpected]
+    if cmp_df.shape[0] > 0:
+        print("{} counters differ:".format(cmp_df.shape[0]))
+        print(cmp_df.head(20).to_string(index=False))
+    else:
+        print("All counters match.")
+    return cmp_df.shape[0]
+
+
+def _connect():
     print("Connecting to mongodb...")
     mongo_client = MongoClient(config["MONGO_DB_URL"])
     if "defaultDb" not in mongo_client.list_database_names():
@@ -81,59 +316,193 @@ def main():
         mongo_client.close()
         sys.exit()
     print("using 'defaultDb' database.")
-    mongo_db = mongo_client["defaultDb"]
+    return mongo_client, mongo_client["defaultDb"]
 
-    print("using 'cases.stats' collectiom.")
-    mongo_col = mongo_db["cases.stats"]
-    if "cases.stats" in mongo_db.list_collection_names():
-        # drop collection first
-        print("Removing old data...")
-        mongo_col.drop()
 
-    print("Connection successful...")
+def backfill_history(mongo_db, workers=READ_WORKERS, overwrite=False, compact=False):
+    """Save the summaries of every snapshot in CASE_INFO_CSV_DIR to history.
 
-    # add new data to database
-    print("Adding new data...")
-    data_dict = stats_df.to_dict("records")
-    mongo_col.insert_many(data_dict)
+    Args:
+        mongo_db (pymongo.Database): The database.
+        workers (int, optional): See snapshot.iter_snapshot.
+        overwrite (bool, optional): Also recompute dates already in history.
+        compact (bool, optional): See snapshot.iter_snapshot.
+    """
+    done = history_dates(mongo_db, "cases.stats").intersection(
+        history_dates(mongo_db, "cases.summary")
+    )
+    for in_csv in list_snapshots():
+        new_date = snapshot_date(in_csv)
+        if not overwrite and new_date.tz_convert("UTC") in done:
+            print("Skipping {}, already in history".format(in_csv.name))
+            continue
+        print("Date: {}".format(new_date))
+        # not cached, each snapshot is only read once
+        curr_df = read_snapshot(in_csv, workers=workers, compact=compact)
+        for col_name, stats_df in [
+            ("cases.stats", province_stats(map_cases(curr_df), new_date)),
+            ("cases.summary", national_summary(curr_df, new_date)),
+        ]:
+            append_history(mongo_db, col_name, stats_df.to_dict("records"), new_date)
 
-    stats_df = curr_df.copy()
 
-    stats_df = stats_df.groupby(["healthStatus"])["caseCode"].nunique().reset_index()
-    activeHealthStats = ["asymptomatic", "mild", "moderate", "severe", "critical"]
-    stats_active = (
-        stats_df.loc[stats_df.healthStatus.isin(activeHealthStats)].sum().to_numpy()[1]
-    )
-    stats_all = stats_df.sum().to_numpy()[1]
-    stats_df = stats_df.append(
-        [
-            {"healthStatus": "all", "caseCode": stats_all},
-            {"healthStatus": "active", "caseCode": stats_active},
-        ],
-        ignore_index=True,
-    )
+def main(
+    workers=READ_WORKERS,
+    verify=False,
+    engine="pandas",
+    backfill=False,
+    overwrite=True,
+    metrics_path=None,
+    profile_dir=None,
+    compact=False,
+    memory_budget_mb=MEMORY_BUDGET_MB,
+):
+    start_run("create_summary", profile_dir, memory_budget_mb)
 
-    stats_df["createdAt"] = new_date
-    stats_df = stats_df.rename(columns={"caseCode": "count"})
+    if backfill:
+        mongo_client, mongo_db = _connect()
+        with stage("backfill"):
+            backfill_history(
+                mongo_db, workers=workers, overwrite=overwrite, compact=compact
+            )
+        finish_run(metrics_path)
+        mongo_client.close()
+        print("Connection closed...")
+        return
 
-    print("using 'cases.summary' collectiom.")
-    mongo_col = mongo_db["cases.summary"]
-    if "cases.summary" in mongo_db.list_collection_names():
-        # drop collection first
-        print("Removing old data...")
-        mongo_col.drop()
+    if engine == "mongo":
+        mongo_client, mongo_db = _connect()
+        with stage("aggregate"):
+            new_date = run_summaries(mongo_db)
+        with stage("history"):
+            record_history(mongo_db, new_date)
+        finish_run(metrics_path)
+        mongo_client.close()
+        print("Connection closed...")
+        return
 
+    in_csv = list_snapshots()[-1]
+    with stage("read") as metrics:
+        curr_df = read_snapshot(
+            in_csv, use_cache=True, workers=workers, compact=compact
+        )
+        metrics["rows"] = curr_df.shape[0]
+
+    new_date = snapshot_date(in_csv)
+    print("Date: {}".format(new_date))
+
+    with stage("summary") as metrics:
+        stats_df = province_stats(map_cases(curr_df), new_date)
+        summary_df = national_summary(curr_df, new_date)
+        metrics["rows"] = curr_df.shape[0]
+
+    # region mongodb
+    mongo_client, mongo_db = _connect()
     print("Connection successful...")
 
-    # add new data to database
-    print("Adding new data...")
-    data_dict = stats_df.to_dict("records")
-    mongo_col.insert_many(data_dict)
+    # rebuild in a staging collection so readers never see an empty one
+    with stage("write") as metrics:
+        print("using 'cases.stats' collectiom.")
+        if verify:
+            verify_counts(
+                mongo_db["cases.stats"], stats_df, SUMMARY_KEYS["cases.stats"]
+            )
+        print("Adding new data...")
+        load_collection(
+            mongo_db,
+            "cases.stats",
+            stats_df,
+            indexes=summary_indexes("cases.stats"),
+        )
+
+        print("using 'cases.summary' collectiom.")
+        if verify:
+            verify_counts(
+                mongo_db["cases.summary"], summary_df, SUMMARY_KEYS["cases.summary"]
+            )
+        print("Adding new data...")
+        load_collection(
+            mongo_db,
+            "cases.summary",
+            summary_df,
+            indexes=summary_indexes("cases.summary"),
+        )
+        metrics["rows"] = stats_df.shape[0] + summary_df.shape[0]
 
+    with stage("history"):
+        record_history(mongo_db, new_date)
+
+    finish_run(metrics_path)
     mongo_client.close()
     print("Connection closed...")
     # endregion mongodb
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Update the case summaries.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(config.get("READ_WORKERS", 0)) or READ_WORKERS,
+        help="processes parsing the parts of a split snapshot, defaults to all cores",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="report counters that drifted from the recomputed ones",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["pandas", "mongo"],
+        default=config.get("SUMMARY_ENGINE", "pandas"),
+        help="compute the summaries from the latest csv in pandas, or from the"
+        " cases collection with an aggregation pipeline",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="save the summaries of every snapshot in CASE_INFO_CSV_DIR to history",
+    )
+    parser.add_argument(
+        "--skip-existing",
+        dest="overwrite",
+        action="store_false",
+        help="with --backfill, skip the dates already in history",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold the snapshot in compact dtypes, e.g. categoricals",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=float(config.get("MEMORY_BUDGET_MB", 0)) or MEMORY_BUDGET_MB,
+        help="peak MB of memory each stage may use before a warning",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="save the run metrics to this json file, defaults to METRICS_DIR",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help="save a cProfile dump of each stage to this directory",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(
+        workers=args.workers,
+        verify=args.verify,
+        engine=args.engine,
+        backfill=args.backfill,
+        overwrite=args.overwrite,
+        metrics_path=args.metrics,
+        profile_dir=args.profile_dir,
+        compact=args.compact,
+        memory_budget_mb=args.memory_budget,
+    )
@@ -0,0 +1,199 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from models import CASE_SCHEMA
+
+SnapshotDiff = namedtuple("SnapshotDiff", ["new", "changed", "deleted", "unchanged"])
+
+
+def fingerprint_cols(prev_cols, curr_cols):
+    """Pick the columns compared between two snapshots.
+
+    The CASE_SCHEMA columns come first in schema order, followed by any other
+    shared column in name order, so the fingerprint does not depend on the
+    column order of the csv.
+
+    Args:
+        prev_cols (list): Prepared columns of the previous snapshot.
+        curr_cols (list): Prepared columns of the current snapshot.
+
+    Returns:
+        list: The shared columns.
+    """
+    common_cols = set(prev_cols) & set(curr_cols)
+    schema_cols = [c for c in CASE_SCHEMA if c in common_cols]
+    return schema_cols + sorted(common_cols - set(schema_cols))
+
+
+def _canonical(col, col_name):
+    dtype = CASE_SCHEMA.get(col_name, {}).get("dtype")
+    if dtype == "Date":
+        col = pd.to_datetime(col.where(col.ne(0)), utc=True)
+        return col.dt.tz_localize(None).to_numpy(dtype="datetime64[ns]").view("i8")
+    if dtype == "Integer":
+        return pd.to_numeric(col, errors="coerce").fillna(-1).to_numpy(dtype="int64")
+    if dtype == "Bool":
+        return col.map({True: 1, False: 0}).fillna(-1).to_numpy(dtype="int8")
+    # categoricals are compared by value, not by their codes
+    return col.astype(object).fillna("").astype(str).to_numpy(dtype=object)
+
+
+def fingerprint(df, cols):
+    """Compute a stable per-row fingerprint.
+
+    Every column is first brought to a canonical dtype so the same values
+    hash alike whether a chunk inferred them as object, bool or int.
+
+    Args:
+        df (pandas.DataFrame): Prepared case data.
+        cols (list): Columns to fingerprint, see fingerprint_cols.
+
+    Returns:
+        numpy.ndarray: One uint64 fingerprint per row.
+    """
+    canon_df = pd.DataFrame(
+        {col_name: _canonical(df[col_name], col_name) for col_name in cols}
+    )
+    return pd.util.hash_pandas_object(canon_df, index=False).to_numpy()
+
+
+def _chunk_index(chunk, cols):
+    return pd.Series(fingerprint(chunk, cols), index=chunk["caseCode"].to_numpy())
+
+
+def merge_index(index):
+    """Merge the fingerprints of the chunks of a snapshot.
+
+    Args:
+        index (list): Fingerprints of each chunk, indexed by case code.
+
+    Returns:
+        pandas.Series: Fingerprints indexed by unique case code, the first
+            occurrence of a case code wins.
+    """
+    index = pd.concat(index)
+    return index.loc[~index.index.duplicated()]
+
+
+def index_snapshot(chunks, cols):
+    """Reduce a snapshot to one fingerprint per case code.
+
+    Args:
+        chunks (iterable): Prepared chunks of the snapshot.
+        cols (list): Columns to fingerprint.
+
+    Returns:
+        pandas.Series: See merge_index.
+    """
+    return merge_index([_chunk_index(chunk, cols) for chunk in chunks])
+
+
+def diff_chunks(prev_index, chunks, cols, curr_index=None):
+    """Classify the rows of a snapshot against the previous one.
+
+    Each chunk is hash-joined on case code with the previous snapshot's
+    fingerprints. Only the new and changed rows are kept in memory, so the
+    peak memory is set by the chunk size and the day's churn.
+
+    Args:
+        prev_index (pandas.Series): Output of index_snapshot for the previous
+            snapshot.
+        chunks (iterable): Prepared chunks of the current snapshot.
+        cols (list): Columns to fingerprint.
+        curr_index (list, optional): Receives the fingerprints of each chunk,
+            so the current snapshot is indexed in the same pass, see
+            merge_index.
+
+    Returns:
+        SnapshotDiff: The new rows, the changed rows, the deleted case codes
+            and the number of unchanged rows.
+    """
+    prev_hash = prev_index.to_numpy()
+    seen = np.zeros(prev_hash.shape[0], dtype=bool)
+    seen_new = set()
+    new_df = []
+    changed_df = []
+    unchanged = 0
+    for chunk in chunks:
+        chunk_index = _chunk_index(chunk, cols)
+        if curr_index is not None:
+            curr_index.append(chunk_index)
+        pos = prev_index.index.get_indexer(chunk_index.index)
+        is_old = pos >= 0
+        is_dup = np.zeros(chunk.shape[0], dtype=bool)
+        is_dup[is_old] = seen[pos[is_old]]
+        is_dup[~is_old] = chunk.loc[~is_old, "caseCode"].isin(seen_new).to_numpy()
+        seen[pos[is_old]] = True
+
+        is_changed = np.zeros(chunk.shape[0], dtype=bool)
+        is_changed[is_old] = prev_hash[pos[is_old]] != chunk_index.to_numpy()[is_old]
+        is_new = ~is_old & ~is_dup
+        is_changed &= ~is_dup
+        unchanged += int((is_old & ~is_dup & ~is_changed).sum())
+
+        seen_new.update(chunk.loc[is_new, "caseCode"])
+        if is_new.any():
+            new_df.append(chunk.loc[is_new])
+        if is_changed.any():
+            changed_df.append(chunk.loc[is_changed])
+    return SnapshotDiff(
+        new=_concat(new_df, cols),
+        changed=_concat(changed_df, cols),
+        deleted=prev_index.index[~seen].to_list(),
+        unchanged=unchanged,
+    )
+
+
+def diff_snapshots(prev_df, curr_df, cols=None):
+    """Classify the rows of two prepared snapshots held in memory.
+
+    Args:
+        prev_df (pandas.DataFrame): The previous snapshot.
+        curr_df (pandas.DataFrame): The current snapshot.
+        cols (list, optional): Columns to fingerprint. Defaults to the shared
+            columns.
+
+    Returns:
+        SnapshotDiff: See diff_chunks.
+    """
+    if cols is None:
+        cols = fingerprint_cols(prev_df.columns, curr_df.columns)
+    return diff_chunks(index_snapshot([prev_df], cols), [curr_df], cols)
+
+
+def changed_columns(prev_df, curr_df, cols):
+    """Count the changed values of each column between two versions of cases.
+
+    Args:
+        prev_df (pandas.DataFrame): The previous version of the cases.
+        curr_df (pandas.DataFrame): The current version, in any order.
+        cols (list): Columns to compare, see fingerprint_cols.
+
+    Returns:
+        pandas.Series: Number of cases whose value changed, indexed by column,
+            columns without changes are left out.
+    """
+    prev_df = prev_df.drop_duplicates(subset=["caseCode"]).set_index("caseCode")
+    prev_df = prev_df.reindex(curr_df["caseCode"].to_numpy())
+    counts = pd.Series(
+        {
+            col_name: int(
+                (
+                    _canonical(prev_df[col_name].reset_index(drop=True), col_name)
+                    != _canonical(curr_df[col_name].reset_index(drop=True), col_name)
+                ).sum()
+            )
+            for col_name in cols
+            if col_name != "caseCode"
+        },
+        dtype="int64",
+    )
+    return counts[counts > 0]
+
+
+def _concat(dfs, cols):
+    if len(dfs) > 0:
+        return pd.concat(dfs, ignore_index=True)
+    return pd.DataFrame(columns=cols)
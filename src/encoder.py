@@ -0,0 +1,119 @@
+import struct
+
+import bson
+import numpy as np
+from bson.raw_bson import RawBSONDocument
+from numpy import nan
+from pandas import factorize
+
+from constants import BATCH_SIZE
+
+_INT32 = struct.Struct("<i")
+# BSON element types
+_DOCUMENT = b"\x03"
+
+
+def encode_element(key, value):
+    """Encode a single BSON element.
+
+    Args:
+        key (str): Field name.
+        value: Field value, of any type the driver can encode.
+
+    Returns:
+        bytes: The element, i.e. type, name and value.
+    """
+    return bson.encode({key: value})[4:-1]
+
+
+def _encode_column(col):
+    # encode each distinct value once, rows then pick their element through
+    # the factorized codes; missing values pick NaN, or None if they were None
+    codes, uniques = factorize(col)
+    values = uniques.tolist() + [nan, None]
+    is_na = np.flatnonzero(codes == -1)
+    codes[is_na] = len(values) - 2
+    if col.dtype == object and len(is_na) > 0:
+        na_values = col.to_numpy()[is_na]
+        is_none = np.fromiter((v is None for v in na_values), bool, len(is_na))
+        codes[is_na[is_none]] = len(values) - 1
+    key = str(col.name)
+    table = np.empty(len(values), dtype=object)
+    table[:] = [encode_element(key, value) for value in values]
+    sizes = np.array([len(element) for element in table], dtype=np.int64)
+    return table, sizes, codes
+
+
+def iter_encoded(df, batch_size=BATCH_SIZE, extra=None):
+    """Encode the rows of a frame into BSON documents, one batch at a time.
+
+    The documents are built from the columns, without the intermediate dicts
+    and scalar objects of `to_dict("records")`. Each distinct value of a
+    column is encoded once, so low cardinality columns such as dates,
+    statuses and locations cost a lookup per row. Values are encoded as the
+    driver would encode the records, e.g. tz-aware dates as UTC datetimes,
+    the 0 date filler and small ints as int32, NaN as double. Only a batch
+    of documents exists at a time.
+
+    Args:
+        df (pandas.DataFrame): Prepared data.
+        batch_size (int, optional): Number of documents per batch.
+        extra (dict, optional): Fields appended to every document.
+
+    Yields:
+        list: The encoded documents of a batch, as bytes.
+    """
+    tail = b"".join(encode_element(k, v) for k, v in (extra or {}).items()) + b"\x00"
+    for i in range(0, df.shape[0], batch_size):
+        batch_df = df.iloc[i : i + batch_size]
+        elements = []
+        doc_sizes = np.full(batch_df.shape[0], 4 + len(tail))
+        for col_name in batch_df.columns:
+            table, sizes, codes = _encode_column(batch_df[col_name])
+            elements.append(table[codes])
+            doc_sizes += sizes[codes]
+        yield [
+            b"".join((_INT32.pack(size), *parts, tail))
+            for size, *parts in zip(doc_sizes.tolist(), *elements)
+        ]
+
+
+def iter_raw_batches(df, batch_size=BATCH_SIZE, extra=None):
+    """Encode the rows of a frame into documents the driver sends as is.
+
+    Args:
+        df (pandas.DataFrame): Prepared data.
+        batch_size (int, optional): Number of documents per batch.
+        extra (dict, optional): Fields appended to every document.
+
+    Yields:
+        list: The RawBSONDocument of each row of a batch.
+    """
+    for docs in iter_encoded(df, batch_size, extra):
+        yield [RawBSONDocument(doc) for doc in docs]
+
+
+def embed_document(key, doc):
+    """Encode an encoded document as an embedded document element.
+
+    Args:
+        key (str): Field name.
+        doc (bytes): The encoded document.
+
+    Returns:
+        bytes: The element.
+    """
+    return _DOCUMENT + key.encode() + b"\x00" + doc
+
+
+def raw_document(*elements):
+    """Build a document from encoded elements.
+
+    Args:
+        *elements (bytes): The elements, see encode_element.
+
+    Returns:
+        bson.raw_bson.RawBSONDocument: The document.
+    """
+    body = b"".join(elements)
+    return RawBSONDocument(_INT32.pack(len(body) + 5) + body + b"\x00")
@@ -0,0 +1,121 @@
+import pandas as pd
+from pymongo import UpdateOne
+
+from aggregate import SUMMARY_KEYS
+
+# daily copies of each summary collection, one document per counter and date
+HISTORY_COLS = {
+    "cases.stats": "cases.stats.history",
+    "cases.summary": "cases.summary.history",
+}
+
+
+def history_indexes(col_name):
+    """Get the indexes of the history of a summary collection.
+
+    Args:
+        col_name (str): "cases.stats" or "cases.summary".
+
+    Returns:
+        list: `(keys, options)` pairs, see loader.swap_collection.
+    """
+    keys = [(k, 1) for k in SUMMARY_KEYS[col_name] + ["createdAt"]]
+    return [(keys, dict(unique=True))]
+
+
+def append_history(mongo_db, col_name, docs, new_date):
+    """Save a day's counters to the history of a summary collection.
+
+    Counters are upserted on their key and date, so rerunning a date replaces
+    its counters instead of duplicating them.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        col_name (str): "cases.stats" or "cases.summary".
+        docs (list): The day's counter documents.
+        new_date (pandas.Timestamp): Date of the snapshot.
+
+    Returns:
+        int: Number of counters saved.
+    """
+    key_cols = SUMMARY_KEYS[col_name]
+    hist_col = mongo_db[HISTORY_COLS[col_name]]
+    for keys, options in history_indexes(col_name):
+        hist_col.create_index(keys, **options)
+
+    requests = [
+        UpdateOne(
+            dict({k: doc[k] for k in key_cols}, createdAt=new_date),
+            {"$set": {"count": int(doc["count"])}},
+            upsert=True,
+        )
+        for doc in docs
+    ]
+    if len(requests) > 0:
+        hist_col.bulk_write(requests, ordered=False)
+
+    # remove counters left by an earlier run of the same date
+    keys = {tuple(doc[k] for k in key_cols) for doc in docs}
+    stale_ids = [
+        doc["_id"]
+        for doc in hist_col.find({"createdAt": new_date}, key_cols)
+        if tuple(doc.get(k) for k in key_cols) not in keys
+    ]
+    if len(stale_ids) > 0:
+        hist_col.delete_many({"_id": {"$in": stale_ids}})
+    return len(requests)
+
+
+def record_history(mongo_db, new_date):
+    """Copy the current summary collections to their history.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        new_date (pandas.Timestamp): Date of the snapshot.
+    """
+    for col_name in HISTORY_COLS:
+        docs = list(mongo_db[col_name].find({}, {"_id": 0}))
+        n_docs = append_history(mongo_db, col_name, docs, new_date)
+        print("Saved {} counters to '{}'".format(n_docs, HISTORY_COLS[col_name]))
+
+
+def history_dates(mongo_db, col_name):
+    """List the dates saved to the history of a summary collection.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        col_name (str): "cases.stats" or "cases.summary".
+
+    Returns:
+        pandas.DatetimeIndex: The dates, in UTC.
+    """
+    dates = mongo_db[HISTORY_COLS[col_name]].distinct("createdAt")
+    return pd.DatetimeIndex(pd.to_datetime(dates, utc=True))
+
+
+def read_history(mongo_db, health_status="all", province_psgc=None, since=None):
+    """Read the daily counts of a health status.
+
+    Served by a single range scan of the (key, createdAt) index.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        health_status (str, optional): The counter, e.g. "active".
+        province_psgc (str, optional): Read this province instead of the
+            national counts.
+        since (pandas.Timestamp, optional): First date to read.
+
+    Returns:
+        pandas.DataFrame: The "createdAt" and "count" of each day, oldest first.
+    """
+    query = {"healthStatus": health_status}
+    col_name = "cases.summary"
+    if province_psgc is not None:
+        query["provincePSGC"] = province_psgc
+        col_name = "cases.stats"
+    if since is not None:
+        query["createdAt"] = {"$gte": since}
+    res = mongo_db[HISTORY_COLS[col_name]].find(
+        query, {"_id": 0, "createdAt": 1, "count": 1}
+    )
+    return pd.DataFrame(list(res.sort("createdAt", 1)), columns=["createdAt", "count"])
@@ -0,0 +1,294 @@
+import cProfile
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from pymongo import monitoring
+
+from constants import METRICS_DIR
+
+# the run being instrumented, see start_run
+_RUN = None
+
+
+def _raw_size(value, depth=0):
+    # bytes of the raw documents of a command or reply, e.g. the encoder's
+    # bulk writes; any other document would have to be encoded again to be
+    # measured, adding to the cost of the stage, so it is not counted
+    if hasattr(value, "raw"):
+        return len(value.raw)
+    if depth >= 3:
+        return 0
+    if isinstance(value, dict):
+        return sum(_raw_size(v, depth + 1) for v in value.values())
+    if isinstance(value, list):
+        return sum(_raw_size(v, depth + 1) for v in value)
+    return 0
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Count the commands sent to MongoDB and the size of their raw documents.
+
+    Only raw documents, e.g. the bulk writes of the encoder, are measured,
+    decoded ones would have to be encoded again. Commands are only counted
+    while a run is started.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if _RUN is None:
+            return
+        size = _raw_size(event.command)
+        with self._lock:
+            self.count += 1
+            self.bytes_sent += size
+
+    def succeeded(self, event):
+        if _RUN is None:
+            return
+        size = _raw_size(event.reply)
+        with self._lock:
+            self.bytes_received += size
+
+    def failed(self, event):
+        pass
+
+    def totals(self):
+        with self._lock:
+            return self.count, self.bytes_sent, self.bytes_received
+
+
+# registered once, counts the commands of every client created afterwards
+COMMANDS = CommandCounter()
+monitoring.register(COMMANDS)
+
+
+def _reset_peak_rss():
+    # Linux only, resets VmHWM so each stage reports its own peak
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Get the peak resident memory of the process.
+
+    Worker processes, e.g. the ProcessPool parsing split snapshots, are not
+    included, see worker_peak_rss_mb.
+
+    Returns:
+        float: The peak since the last reset, in MB.
+    """
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def worker_peak_rss_mb():
+    """Get the peak resident memory of the finished worker processes.
+
+    The peak cannot be reset, it is the largest worker of the run so far.
+
+    Returns:
+        float: The peak of the largest finished child process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class Run:
+    """Per-stage metrics of a pipeline run.
+
+    Args:
+        name (str): Name of the entry point, e.g. "update_db".
+        profile_dir (pathlib.Path, optional): Save a cProfile dump of each
+            top-level stage there.
+        memory_budget_mb (float, optional): Warn about and flag the stages
+            whose peak memory exceeds it.
+    """
+
+    def __init__(self, name, profile_dir=None, memory_budget_mb=None):
+        self.name = name
+        self.profile_dir = profile_dir
+        self.memory_budget_mb = memory_budget_mb
+        self.started_at = datetime.now().astimezone()
+        self.stages = []
+        self._stack = []
+        self._t_start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a named stage.
+
+        Example:
+            with run.stage("read") as metrics:
+                df = read_snapshot(in_csv)
+                metrics["rows"] = df.shape[0]
+
+        Args:
+            name (str): The stage, e.g. "read", "diff" or "write".
+
+        Yields:
+            dict: The stage metrics, set "rows" and any extra value on it.
+        """
+        metrics = dict(stage=".".join([s["stage"] for s in self._stack] + [name]))
+        metrics["rows"] = None
+        profiler = None
+        if self.profile_dir is not None and len(self._stack) == 0:
+            profiler = cProfile.Profile()
+        if len(self._stack) > 0:
+            # the parent's peak so far, lost by the reset
+            parent = self._stack[-1]
+            parent["_child_peak"] = max(parent.get("_child_peak", 0.0), peak_rss_mb())
+        self._stack.append(metrics)
+        _reset_peak_rss()
+        n_cmd, n_sent, n_received = COMMANDS.totals()
+        c_start = time.process_time()
+        t_start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield metrics
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - t_start
+            cmd_totals = COMMANDS.totals()
+            self._stack.pop()
+            peak = max(peak_rss_mb(), metrics.pop("_child_peak", 0.0))
+            if len(self._stack) > 0:
+                parent = self._stack[-1]
+                parent["_child_peak"] = max(parent.get("_child_peak", 0.0), peak)
+            rows = metrics["rows"]
+            metrics.update(
+                wall_s=round(wall, 3),
+                cpu_s=round(time.process_time() - c_start, 3),
+                rows_per_s=round(rows / wall, 1) if rows and wall > 0 else None,
+                peak_rss_mb=round(peak, 1),
+                worker_peak_rss_mb=round(worker_peak_rss_mb(), 1),
+                round_trips=cmd_totals[0] - n_cmd,
+                bytes_sent=cmd_totals[1] - n_sent,
+                bytes_received=cmd_totals[2] - n_received,
+            )
+            if profiler is not None:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(
+                    self.profile_dir / "{}.{}.prof".format(self.name, name)
+                )
+            if self.memory_budget_mb is not None:
+                metrics["over_budget"] = peak > self.memory_budget_mb
+            self.stages.append(metrics)
+            print(
+                "[{stage}] {rows} rows in {wall_s:.2f}s, {cpu_s:.2f}s cpu,"
+                " {peak_rss_mb:.0f} MB peak, {round_trips} round trips".format(
+                    **metrics
+                )
+            )
+            if metrics.get("over_budget"):
+                print(
+                    "Warning: [{}] peaked at {:.0f} MB, over the {} MB memory"
+                    " budget".format(metrics["stage"], peak, self.memory_budget_mb)
+                )
+
+    def report(self):
+        """Get the metrics of the run.
+
+        Returns:
+            dict: The run and its stages, in completion order.
+        """
+        return dict(
+            run=self.name,
+            startedAt=self.started_at.isoformat(),
+            wall_s=round(time.perf_counter() - self._t_start, 3),
+            peak_rss_mb=round(
+                max([peak_rss_mb()] + [s["peak_rss_mb"] for s in self.stages]), 1
+            ),
+            worker_peak_rss_mb=round(worker_peak_rss_mb(), 1),
+            memory_budget_mb=self.memory_budget_mb,
+            over_budget=[s["stage"] for s in self.stages if s.get("over_budget")],
+            stages=self.stages,
+        )
+
+    def write(self, path=None):
+        """Save the metrics as json.
+
+        Args:
+            path (pathlib.Path, optional): The file, defaults to
+                `METRICS_DIR/<run>_<start time>.json`.
+
+        Returns:
+            pathlib.Path: The file written.
+        """
+        if path is None:
+            path = METRICS_DIR / "{}_{}.json".format(
+                self.name, self.started_at.strftime("%Y%m%dT%H%M%S")
+            )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.report(), indent=2, default=str))
+        print("Metrics saved to {}".format(path))
+        return path
+
+
+def start_run(name, profile_dir=None, memory_budget_mb=None):
+    """Start instrumenting a pipeline run.
+
+    Args:
+        name (str): Name of the entry point.
+        profile_dir (pathlib.Path, optional): See Run.
+        memory_budget_mb (float, optional): See Run.
+
+    Returns:
+        Run: The run, also used by stage.
+    """
+    global _RUN
+    _RUN = Run(name, profile_dir, memory_budget_mb)
+    return _RUN
+
+
+@contextmanager
+def stage(name):
+    """Measure a stage of the current run, see Run.stage.
+
+    Without a started run the stage is not recorded.
+
+    Args:
+        name (str): The stage.
+
+    Yields:
+        dict: The stage metrics.
+    """
+    if _RUN is None:
+        yield {}
+        return
+    with _RUN.stage(name) as metrics:
+        yield metrics
+
+
+def finish_run(path=None):
+    """Save the metrics of the current run and stop instrumenting it.
+
+    Args:
+        path (pathlib.Path, optional): See Run.write.
+
+    Returns:
+        dict: The run metrics, None if no run was started.
+    """
+    global _RUN
+    if _RUN is None:
+        return None
+    run, _RUN = _RUN, None
+    run.write(path)
+    return run.report()
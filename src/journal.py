@@ -0,0 +1,251 @@
+import numpy as np
+import pandas as pd
+
+from changeset import changeset_dir, changeset_summary, read_changeset, write_changeset
+from constants import JOURNAL_DIR, TZ
+from diff import SnapshotDiff
+
+
+def _segment_date(date_str):
+    return pd.Timestamp(date_str).tz_convert(TZ)
+
+
+def list_segments(until=None, journal_dir=JOURNAL_DIR):
+    """List the segments of the journal, oldest first.
+
+    Args:
+        until (pandas.Timestamp, optional): Last date to list.
+        journal_dir (pathlib.Path, optional): The journal.
+
+    Returns:
+        list: The segment directories, one changeset per applied day.
+    """
+    segments = [
+        seg_dir
+        for seg_dir in journal_dir.glob("[0-9]" * 8)
+        if seg_dir.is_dir()
+        and (until is None or seg_dir.name <= until.strftime("%Y%m%d"))
+    ]
+    segments.sort()
+    return segments
+
+
+def check_segment(summary, journal_dir=JOURNAL_DIR):
+    """Check that a day's changes can be appended to the journal.
+
+    Run before writing the changes, so a refused day leaves the database
+    untouched rather than ahead of its journal.
+
+    Args:
+        summary (dict): See changeset.changeset_summary.
+        journal_dir (pathlib.Path, optional): The journal.
+
+    Returns:
+        pathlib.Path: The segment directory the day would be saved to.
+
+    Raises:
+        ValueError: If the journal already has a later day.
+    """
+    new_date = _segment_date(summary["date"])
+    seg_dir = changeset_dir(new_date, journal_dir)
+    segments = list_segments(journal_dir=journal_dir)
+    if len(segments) > 0 and seg_dir.name < segments[-1].name:
+        raise ValueError(
+            "Journal already has {}, cannot append {}".format(
+                segments[-1].name, seg_dir.name
+            )
+        )
+    prev_segments = [s for s in segments if s != seg_dir]
+    if len(prev_segments) > 0 and summary["prevDate"] is not None:
+        prev_name = _segment_date(summary["prevDate"]).strftime("%Y%m%d")
+        if prev_name != prev_segments[-1].name:
+            print(
+                "Warning: journal skips from {} to {}, replays past it will"
+                " fail".format(prev_segments[-1].name, prev_name)
+            )
+    return seg_dir
+
+
+def append_segment(snap_diff, summary, journal_dir=JOURNAL_DIR):
+    """Save a day's applied changes to the journal.
+
+    Segments are only ever appended. Rerunning the last day replaces its
+    segment, writing a day older than the last segment is refused, see
+    check_segment.
+
+    Args:
+        snap_diff (SnapshotDiff): The changes written to the cases collection.
+        summary (dict): See changeset.changeset_summary.
+        journal_dir (pathlib.Path, optional): The journal.
+
+    Returns:
+        pathlib.Path: The segment directory.
+    """
+    seg_dir = check_segment(summary, journal_dir)
+    return write_changeset(seg_dir, snap_diff, summary)
+
+
+def write_base(df, new_date, snapshots=(), journal_dir=JOURNAL_DIR):
+    """Start the journal with a whole snapshot.
+
+    Args:
+        df (pandas.DataFrame): The prepared snapshot loaded into cases.
+        new_date (pandas.Timestamp): Date of the snapshot.
+        snapshots (list, optional): Name of the snapshot file.
+        journal_dir (pathlib.Path, optional): The journal.
+
+    Returns:
+        pathlib.Path: The base segment directory.
+    """
+    if len(list_segments(journal_dir=journal_dir)) > 0:
+        raise ValueError("Journal {} is already started".format(journal_dir))
+    snap_diff = SnapshotDiff(new=df, changed=df.iloc[:0], deleted=[], unchanged=0)
+    summary = changeset_summary(snap_diff, new_date, None, snapshots, df.columns)
+    return write_changeset(changeset_dir(new_date, journal_dir), snap_diff, summary)
+
+
+class _CaseState:
+    """Cases as update_db leaves them, folded from journal segments.
+
+    Rows are never rewritten in place. Each segment appends its upserted
+    rows as a new block and marks the replaced and deleted rows dead, so a
+    day costs a lookup per changed case rather than a copy of every case.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.alive = []
+        self.starts = []
+        self.pos = {}
+        self.n_rows = 0
+        self.n_dead = 0
+
+    def _append(self, df):
+        df = df.reset_index(drop=True)
+        self.starts.append(self.n_rows)
+        self.blocks.append(df)
+        self.alive.append(np.ones(df.shape[0], dtype=bool))
+        self.pos.update(
+            zip(df["caseCode"].tolist(), range(self.n_rows, self.n_rows + df.shape[0]))
+        )
+        self.n_rows += df.shape[0]
+
+    def _take(self, case_codes):
+        # current rows of the given cases, marked dead
+        ids = np.array(
+            [self.pos.pop(c) for c in case_codes if c in self.pos], dtype=np.int64
+        )
+        block_ids = np.searchsorted(self.starts, ids, side="right") - 1
+        rows = []
+        for b in np.unique(block_ids):
+            local = ids[block_ids == b] - self.starts[b]
+            self.alive[b][local] = False
+            rows.append(self.blocks[b].iloc[local])
+        self.n_dead += ids.shape[0]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=["caseCode", "createdAt", "updatedAt"])
+        return pd.concat(rows, ignore_index=True)
+
+    def _upsert(self, df, new_date, is_update):
+        df = df.copy()
+        old_df = self._take(df["caseCode"]).set_index("caseCode")
+        if is_update:
+            df["updatedAt"] = new_date
+        # fields not in the update keep their stored value
+        for col_name in old_df.columns.difference(df.columns):
+            df[col_name] = df["caseCode"].map(old_df[col_name])
+        if "createdAt" not in df:
+            df["createdAt"] = np.nan
+        df["createdAt"] = df["createdAt"].where(df["createdAt"].notna(), new_date)
+        self._append(df)
+
+    def apply(self, snap_diff, new_date):
+        """Apply a segment the way update_db writes it.
+
+        Args:
+            snap_diff (SnapshotDiff): The segment's changes.
+            new_date (pandas.Timestamp): Date of the segment.
+
+        Returns:
+            pandas.DataFrame: The deleted cases, as saved to cases.deleted.
+        """
+        del_df = self._take(snap_diff.deleted)
+        del_df["deletedAt"] = new_date
+        if "updatedAt" in del_df:
+            if del_df["updatedAt"].notna().any():
+                del_df["updatedAt"] = del_df["updatedAt"].where(
+                    del_df["updatedAt"].notna(), 0
+                )
+            else:
+                del_df = del_df.drop(columns=["updatedAt"])
+        for df, is_update in [(snap_diff.changed, True), (snap_diff.new, False)]:
+            if df.shape[0] > 0:
+                self._upsert(df, new_date, is_update)
+        if self.n_dead > self.n_rows - self.n_dead:
+            self._compact()
+        return del_df
+
+    def _compact(self):
+        df = self.frame()
+        self.blocks, self.alive, self.starts, self.pos = [], [], [], {}
+        self.n_rows = self.n_dead = 0
+        self._append(df)
+
+    def frame(self):
+        """Get the live cases.
+
+        Returns:
+            pandas.DataFrame: One row per case.
+        """
+        return pd.concat(
+            [block.loc[alive] for block, alive in zip(self.blocks, self.alive)],
+            ignore_index=True,
+        )
+
+
+def replay_segments(segments):
+    """Fold journal segments into the cases and deleted cases.
+
+    Args:
+        segments (list): Segment directories, oldest first, starting with a
+            base segment, see list_segments.
+
+    Returns:
+        tuple: The cases and the deleted cases, each as a list of frames
+            whose documents share the same fields.
+    """
+    state = _CaseState()
+    deleted_dfs = []
+    prev_date = None
+    for seg_dir in segments:
+        snap_diff, summary = read_changeset(seg_dir)
+        new_date = _segment_date(summary["date"])
+        if prev_date is None and summary["prevDate"] is not None:
+            raise ValueError(
+                "Journal does not start with a base segment: {}".format(seg_dir)
+            )
+        if prev_date is not None and (
+            summary["prevDate"] is None
+            or _segment_date(summary["prevDate"]) != prev_date
+        ):
+            raise ValueError(
+                "Journal is missing the changes from {} to {}".format(
+                    prev_date.isoformat(), summary["prevDate"]
+                )
+            )
+        print("Replaying {}...".format(seg_dir.name))
+        del_df = state.apply(snap_diff, new_date)
+        if del_df.shape[0] > 0:
+            deleted_dfs.append(del_df)
+        prev_date = new_date
+
+    cases_df = state.frame()
+    if "updatedAt" not in cases_df:
+        return [cases_df], deleted_dfs
+    # cases never updated have no updatedAt field
+    is_updated = cases_df["updatedAt"].notna()
+    cases_dfs = [
+        cases_df.loc[is_updated],
+        cases_df.loc[~is_updated].drop(columns=["updatedAt"]),
+    ]
+    return [df for df in cases_dfs if df.shape[0] > 0], deleted_dfs
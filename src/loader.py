@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+
+from constants import BATCH_SIZE, WRITE_QUEUE_DEPTH, WRITE_WORKERS
+from encoder import iter_raw_batches
+from writer import iter_writes
+
+# suffix of the collection a rebuild is written to before it is swapped in
+STAGING_SUFFIX = ".staging"
+
+
+@contextmanager
+def swap_collection(mongo_db, col_name, indexes=(), validate=None):
+    """Rebuild a collection in a staging collection and swap it in atomically.
+
+    The live collection keeps serving reads until the rebuild is complete, it
+    is then replaced with a single `renameCollection(dropTarget=True)`. On any
+    failure the staging collection is dropped and the live one is left as is.
+
+    Example:
+        with swap_collection(mongo_db, "cases.stats") as staging_col:
+            staging_col.insert_many(docs)
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        col_name (str): Name of the live collection.
+        indexes (list, optional): `(keys, options)` pairs passed to
+            create_index, built on the staging collection after it is loaded.
+        validate (callable, optional): Called with the loaded staging
+            collection, the swap is aborted if it returns False.
+
+    Yields:
+        pymongo.Collection: The empty staging collection.
+    """
+    staging_name = col_name + STAGING_SUFFIX
+    mongo_db.drop_collection(staging_name)
+    staging_col = mongo_db[staging_name]
+    try:
+        yield staging_col
+        for keys, options in indexes:
+            staging_col.create_index(keys, **options)
+        if validate is not None and not validate(staging_col):
+            raise ValueError("Validation of '{}' failed".format(staging_name))
+        if staging_name not in mongo_db.list_collection_names():
+            # nothing was loaded, an empty rebuild still replaces the target
+            mongo_db.create_collection(staging_name)
+        staging_col.rename(col_name, dropTarget=True)
+    except BaseException:
+        print("Rebuild of '{}' failed, keeping the current data...".format(col_name))
+        mongo_db.drop_collection(staging_name)
+        raise
+
+
+def load_collection(
+    mongo_db,
+    col_name,
+    df,
+    indexes=(),
+    batch_size=BATCH_SIZE,
+    workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+):
+    """Replace the documents of a collection without an empty window.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        col_name (str): Name of the live collection.
+        df (pandas.DataFrame or list): The new documents, one per row. The
+            frames of a list are loaded one after the other, e.g. groups of
+            documents with different fields.
+        indexes (list, optional): See swap_collection.
+        batch_size (int, optional): Number of documents per insert.
+        workers (int, optional): See writer.iter_writes.
+        queue_depth (int, optional): See writer.iter_writes.
+
+    Returns:
+        int: Number of documents loaded.
+    """
+    dfs = df if isinstance(df, list) else [df]
+    n_docs = sum(_df.shape[0] for _df in dfs)
+    with swap_collection(mongo_db, col_name, indexes) as staging_col:
+        for _ in iter_writes(
+            (docs for _df in dfs for docs in iter_raw_batches(_df, batch_size)),
+            lambda docs: staging_col.insert_many(docs, ordered=False),
+            workers,
+            queue_depth,
+        ):
+            pass
+    print("Loaded {} documents into '{}'".format(n_docs, col_name))
+    return n_docs
@@ -0,0 +1,88 @@
+import pandas as pd
+
+# lookup stores already loaded by this process, by file
+_LOOKUPS = {}
+
+
+class LocLookup:
+    """Resolved location names, indexed by their key columns.
+
+    The csv is read once per process. Hits are resolved for a whole frame
+    with a single hash join, and new resolutions are appended to the csv
+    instead of rewriting it.
+
+    Args:
+        path (pathlib.Path): The lookup csv.
+        key_cols (list): Columns identifying a location.
+        columns (list): Columns saved to the csv, including key_cols and
+            "psgc".
+    """
+
+    def __init__(self, path, key_cols, columns):
+        self.path = path
+        self.key_cols = key_cols
+        self.columns = columns
+        lookup_df = pd.DataFrame(columns=columns)
+        if path.is_file():
+            lookup_df = pd.read_csv(path, dtype=str)
+            # keep the column order of the file when appending to it
+            self.columns = list(lookup_df.columns)
+        self.psgc = self._index(lookup_df.loc[lookup_df["psgc"].notna()])
+
+    def _keys(self, df):
+        # categorical keys are matched by value, missing ones as ""
+        return pd.MultiIndex.from_frame(df[self.key_cols].astype(object).fillna(""))
+
+    def _index(self, df):
+        psgc = pd.Series(
+            df["psgc"].to_numpy(),
+            index=self._keys(df),
+            dtype=object,
+        )
+        return psgc.loc[~psgc.index.duplicated()]
+
+    def resolve(self, df):
+        """Get the PSGC of each row.
+
+        Args:
+            df (pandas.DataFrame): Data with the key columns.
+
+        Returns:
+            pandas.Series: The PSGC of each row, NaN for unknown locations.
+        """
+        pos = self.psgc.index.get_indexer(self._keys(df))
+        psgc = pd.Series(None, index=df.index, dtype=object)
+        psgc[pos >= 0] = self.psgc.to_numpy()[pos[pos >= 0]]
+        return psgc
+
+    def add(self, df):
+        """Save new resolutions.
+
+        Args:
+            df (pandas.DataFrame): One row per location with the saved columns.
+                Rows with an empty PSGC or an already known key are skipped.
+        """
+        df = df.loc[df["psgc"].notna() & (df["psgc"] != ""), self.columns]
+        df = df.loc[self.resolve(df).isna().to_numpy()]
+        df = df.drop_duplicates(subset=self.key_cols)
+        if df.shape[0] == 0:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(self.path, mode="a", header=not self.path.is_file(), index=False)
+        self.psgc = pd.concat([self.psgc, self._index(df)])
+
+
+def get_lookup(path, key_cols, columns):
+    """Get the lookup store of a csv, loading it on first use.
+
+    Args:
+        path (pathlib.Path): The lookup csv.
+        key_cols (list): Columns identifying a location.
+        columns (list): Columns saved to the csv.
+
+    Returns:
+        LocLookup: The lookup store.
+    """
+    if path not in _LOOKUPS:
+        _LOOKUPS[path] = LocLookup(path, key_cols, columns)
+    return _LOOKUPS[path]
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+# rapidfuzz scores a whole batch at once, fall back to fuzzywuzzy
+try:
+    from rapidfuzz import fuzz, process
+    from rapidfuzz.utils import default_process as full_process
+
+    HAS_RAPIDFUZZ = True
+except ImportError:
+    from fuzzywuzzy import fuzz, process
+    from fuzzywuzzy.utils import full_process
+
+    HAS_RAPIDFUZZ = False
+
+
+def build_candidate_index(ref_df, name_col, code_col, group_col="region"):
+    """Build the normalized fuzzy-match candidates of each region.
+
+    Args:
+        ref_df (pandas.DataFrame): Reference locations, e.g. the boundary
+            attributes.
+        name_col (str): Column holding the names to match against.
+        code_col (str): Column holding the PSGC of each name.
+        group_col (str, optional): Column the candidates are grouped by.
+
+    Returns:
+        dict: Group value to a tuple of the processed names, the original
+            names and their codes.
+    """
+    index = {}
+    for group, grp_df in ref_df.groupby(group_col, sort=False):
+        grp_df = grp_df.drop_duplicates(subset=[name_col])
+        index[group] = (
+            [full_process(name) for name in grp_df[name_col]],
+            grp_df[name_col].to_list(),
+            grp_df[code_col].to_list(),
+        )
+    return index
+
+
+def _best_matches(queries, choices):
+    # returns the position and score of the best choice for each query
+    if not HAS_RAPIDFUZZ:
+        choices = dict(enumerate(choices))
+        best = [
+            (
+                process.extractOne(q, choices, processor=None, scorer=fuzz.WRatio)
+                if len(q) > 0
+                else None
+            )
+            for q in queries
+        ]
+        return (
+            np.array([0 if b is None else b[2] for b in best]),
+            np.array([0 if b is None else b[1] for b in best], dtype=float),
+        )
+    scores = process.cdist(queries, choices, scorer=fuzz.WRatio, workers=-1)
+    pos = scores.argmax(axis=1)
+    return pos, scores[np.arange(len(queries)), pos].astype(float)
+
+
+def match_locations(names, groups, index, threshold=0):
+    """Fuzzy-match location names against the candidates of their group.
+
+    Every distinct name is scored once, in batch, against the candidate list
+    of its group.
+
+    Args:
+        names (pandas.Series): Location names to resolve.
+        groups (pandas.Series): Group (region) of each name, same index.
+        index (dict): Output of build_candidate_index.
+        threshold (float, optional): Minimum score, from 0 to 100, of an
+            accepted match.
+
+    Returns:
+        pandas.DataFrame: The `match`, `score` and `code` of each name, same
+            index. Unresolved names get an empty match and code.
+    """
+    in_df = pd.DataFrame({"name": names, "group": groups})
+    res_dfs = []
+    for group, grp_df in in_df.drop_duplicates().groupby(
+        "group", sort=False, observed=True
+    ):
+        if group not in index:
+            continue
+        processed, choices, codes = index[group]
+        queries = [full_process(str(name)) for name in grp_df["name"]]
+        pos, scores = _best_matches(queries, processed)
+        is_match = scores >= threshold
+        res_dfs.append(
+            pd.DataFrame(
+                {
+                    "name": grp_df["name"].to_numpy(),
+                    "group": group,
+                    "match": np.where(
+                        is_match, np.array(choices, dtype=object)[pos], ""
+                    ),
+                    "score": scores,
+                    "code": np.where(is_match, np.array(codes, dtype=object)[pos], ""),
+                }
+            )
+        )
+    if len(res_dfs) == 0:
+        res_dfs = [pd.DataFrame(columns=["name", "group", "match", "score", "code"])]
+    out_df = in_df.merge(pd.concat(res_dfs), how="left", on=["name", "group"])
+    out_df = out_df.fillna({"match": "", "score": 0.0, "code": ""})
+    out_df.index = names.index
+    return out_df[["match", "score", "code"]]
@@ -6,7 +6,11 @@ from pymongo import MongoClient
 import pandas as pd
 
 from constants import CASE_INFO_CSV_DIR, MONGO_DB_URL, TZ
+from instrument import finish_run, stage, start_run
+from journal import list_segments, write_base
+from loader import load_collection
 from models import prep_cases_df
+from query_shapes import INDEXES
 
 
 def main():
@@ -15,35 +19,41 @@ def main():
     if not in_csv.is_file():
         print("Error: Input file missing")
         sys.exit()
-    in_df = pd.read_csv(in_csv, low_memory=False)
+    start_run("init_case_collection")
+    with stage("read") as metrics:
+        in_df = pd.read_csv(in_csv, low_memory=False)
+        metrics["rows"] = in_df.shape[0]
     # prep data
-    in_df = prep_cases_df(in_df)
+    with stage("prep") as metrics:
+        in_df = prep_cases_df(in_df)
+        metrics["rows"] = in_df.shape[0]
 
     date_str = in_csv.name.split("_")[0]
-    in_df["createdAt"] = pd.to_datetime(date_str).tz_localize(TZ)
+    new_date = pd.to_datetime(date_str).tz_localize(TZ)
+    in_df["createdAt"] = new_date
 
     # region mongodb
     print("Connecting to mongodb...")
     mongo_client = MongoClient(MONGO_DB_URL)
     mongo_db = mongo_client["defaultDb"]
-    mongo_col = mongo_db["cases"]
-    if "cases" in mongo_db.list_collection_names():
-        # drop collection first
-        print("Removing old data...")
-        mongo_col.drop()
-
     print("Connection successful...")
     # endregion mongodb
 
     # insert data
-    data_dict = in_df.to_dict("records")
-    mongo_col.create_index(
-        [
-            ("caseCode", 1),
-        ],
-        unique=True,
-    )
-    mongo_col.insert_many(data_dict)
+    with stage("write") as metrics:
+        metrics["rows"] = load_collection(
+            mongo_db,
+            "cases",
+            in_df,
+            indexes=INDEXES["cases"],
+        )
+
+    # base of the change journal, see replay_journal.py
+    if len(list_segments()) == 0:
+        write_base(in_df, new_date, [in_csv.name])
+    else:
+        print("Journal already started, base segment not written")
+    finish_run()
 
 
 if __name__ == "__main__":
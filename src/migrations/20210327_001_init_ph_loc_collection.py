@@ -6,6 +6,8 @@ import pandas as pd
 import geopandas as gpd
 
 from constants import MONGO_DB_URL
+from instrument import finish_run, stage, start_run
+from loader import load_collection
 
 
 def main():
@@ -14,7 +16,10 @@ def main():
     if not in_shp.is_file():
         print("Error: Input file missing")
         sys.exit()
-    in_gdf = gpd.read_file(in_shp)
+    start_run("init_ph_loc_collection")
+    with stage("read") as metrics:
+        in_gdf = gpd.read_file(in_shp)
+        metrics["rows"] = in_gdf.shape[0]
     # prep data
     in_df = in_gdf.loc[
         in_gdf["type"] != "Waterbody", ["region", "province", "name"]
@@ -38,17 +43,13 @@ def main():
     print("Connecting to mongodb...")
     mongo_client = MongoClient(MONGO_DB_URL)
     mongo_db = mongo_client["defaultDb"]
-    mongo_col = mongo_db["ph_loc"]
-    if "ph_loc" in mongo_db.list_collection_names():
-        # drop collection first
-        print("Removing old data...")
-        mongo_col.drop()
     print("Connection successful...")
     # endregion mongodb
 
     # insert data
-    data_dict = out_df.to_dict("records")
-    mongo_col.insert_many(data_dict)
+    with stage("write") as metrics:
+        metrics["rows"] = load_collection(mongo_db, "ph_loc", out_df)
+    finish_run()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@ from pymongo import MongoClient
 import pandas as pd
 
 from constants import CASE_INFO_CSV_DIR, MONGO_DB_URL
+from instrument import finish_run, stage, start_run
+from loader import load_collection
 from make_mappable import make_mappable
 
 
@@ -16,7 +18,10 @@ def main():
     if not in_csv.is_file():
         print("Error: Input file missing")
         sys.exit()
-    in_df = pd.read_csv(in_csv, low_memory=False)
+    start_run("init_quarantine_facilities_collection")
+    with stage("read") as metrics:
+        in_df = pd.read_csv(in_csv, low_memory=False)
+        metrics["rows"] = in_df.shape[0]
     in_df["isolbed"] = in_df["isolbed_o"] + in_df["isolbed_v"]
     in_df["beds_ward"] = in_df["beds_ward_o"] + in_df["beds_ward_v"]
 
@@ -58,18 +63,13 @@ def main():
     print("Connecting to mongodb...")
     mongo_client = MongoClient(MONGO_DB_URL)
     mongo_db = mongo_client["defaultDb"]
-    mongo_col = mongo_db["quarantineFacilities"]
-    if "quarantineFacilities" in mongo_db.list_collection_names():
-        # drop collection first
-        print("Removing old data...")
-        mongo_col.drop()
-
     print("Connection successful...")
     # endregion mongodb
 
     # insert data
-    data_dict = out_df.to_dict("records")
-    mongo_col.insert_many(data_dict)
+    with stage("write") as metrics:
+        metrics["rows"] = load_collection(mongo_db, "quarantineFacilities", out_df)
+    finish_run()
 
 
 if __name__ == "__main__":
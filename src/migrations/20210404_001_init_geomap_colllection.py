@@ -116,7 +116,8 @@ mongo_col = mongo_db["geomaps"]
 print("Connection successful...")
 # endregion mongodb
 
-mongo_col.delete_one({"name": "ph-prov"})
+# the simplified resolutions of the layer are kept, see create_geomaps.py
+mongo_col.delete_one({"name": "ph-prov", "resolution": None})
 with open(out_file) as file:
     geo_data = json.load(file)
 data_dict = dict(name="ph-prov", geo=geo_data)
@@ -0,0 +1,24 @@
+from dotenv import dotenv_values
+from pymongo import MongoClient
+
+from query_shapes import check_query_shapes, ensure_indexes
+
+config = dotenv_values()
+
+
+def main():
+    # region mongodb
+    print("Connecting to mongodb...")
+    mongo_client = MongoClient(config["MONGO_DB_URL"])
+    mongo_db = mongo_client["defaultDb"]
+    print("Connection successful...")
+    # endregion mongodb
+
+    ensure_indexes(mongo_db)
+    check_query_shapes(mongo_db)
+
+    mongo_client.close()
+
+
+if __name__ == "__main__":
+    main()
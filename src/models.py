@@ -1,6 +1,9 @@
-from numpy import nan
-from pandas import to_datetime
+from time import perf_counter
 
+from numpy import iinfo, nan
+from pandas import Series, factorize, to_datetime, to_numeric
+
+from constants import TZ
 from helpers import camel_case
 
 SEX_ENUM = ["male", "female"]
@@ -15,6 +18,7 @@ HEALTH_STATS_ENUM = [
     "severe",
     "critical",
 ]
+ACTIVE_HEALTH_STATS = ["asymptomatic", "mild", "moderate", "severe", "critical"]
 
 CASE_SCHEMA = dict(
     caseCode=dict(dtype="String"),
@@ -45,6 +49,8 @@ CASE_FIELD_MAP = dict(
 )
 CASE_FIELD_DROP = ["ageGroup", "validationStatus"]
 
+BOOL_LOOKUP = {"yes": True, "no": False}
+
 REGION_MAP = {
     "Region I: Ilocos Region": "Region I",
     "Region II: Cagayan Valley": "Region II",
@@ -106,60 +112,286 @@ REGION_MAP = {
 
 REGION_UNKNOWN = ["ROF", "Repatriate", ""]
 
+# formats of the Date columns, tried in order on the distinct values of each
+# column until one parses them all
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S"]
+# unparseable dates kept per column by record_unparsed, besides their count
+UNPARSED_SAMPLE = 10
+
+# dtypes of the compact frames by schema dtype, see compact_cases_df
+COMPACT_DTYPES = dict(String="category", Integer="int16", Bool="boolean")
+# distinct on nearly every row, a categorical would only add its codes
+COMPACT_SKIP = ["caseCode"]
+
+
+def prep_column_names(columns):
+    """Map raw DOH column names to the names used in the database.
+
+    Args:
+        columns (list): Column names as found in the case_info csv.
+
+    Returns:
+        list: The prepared column names, without the dropped fields.
+    """
+    columns = [camel_case(CASE_FIELD_MAP.get(c, c)) for c in columns]
+    return [c for c in columns if c not in CASE_FIELD_DROP]
+
+
+def raw_column_dtypes(columns):
+    """Build the read_csv dtypes that keep text fields as text in every chunk.
+
+    A chunk where a String or Bool column is entirely empty would otherwise
+    be inferred as float and break the `.str` calls in prep_cases_df.
+
+    Args:
+        columns (list): Column names as found in the case_info csv.
+
+    Returns:
+        dict: Raw column name to dtype.
+    """
+    dtypes = {}
+    for c in columns:
+        col_name = camel_case(CASE_FIELD_MAP.get(c, c))
+        if col_name in CASE_SCHEMA and CASE_SCHEMA[col_name]["dtype"] in [
+            "String",
+            "Bool",
+        ]:
+            dtypes[c] = object
+    return dtypes
+
+
+class SchemaError(ValueError):
+    """Raised when a column holds values outside of its schema choices."""
+
+    def __init__(self, col_name, values):
+        super().__init__(f"{col_name} has unmatched values: {values}")
+        self.col_name = col_name
+        self.values = values
+
+    def __reduce__(self):
+        # rebuilt from its fields when raised in a worker process
+        return SchemaError, (self.col_name, self.values)
+
+
+def _map_unique(col, func):
+    # apply func once per distinct value, then broadcast back through the
+    # factorized codes; code -1 (missing) picks the mapped NaN at the end
+    codes, uniques = factorize(col)
+    values = func(Series(list(uniques) + [nan], dtype=object))
+    # kept as object, like the column assignments of the original prep, so
+    # e.g. a Date column without a missing value is not inferred as datetime64
+    return Series(
+        values.to_numpy(dtype=object)[codes],
+        index=col.index,
+        name=col.name,
+        dtype=object,
+    )
+
+
+def _string_kernel(col_name, spec):
+    fill = spec.get("default", "")
+    choices = spec.get("choices")
+
+    def _prep(values):
+        if choices is not None:
+            values = values.str.strip().str.lower()
+            no_match = values.dropna().loc[~values.dropna().isin(choices)].unique()
+            if len(no_match) > 0:
+                raise SchemaError(col_name, no_match)
+        return values.fillna(fill).str.strip()
+
+    return lambda col: _map_unique(col, _prep)
+
+
+def _integer_kernel(col_name, spec):
+    fill = spec.get("default", -1)
+
+    def _kernel(col):
+        return to_numeric(col).fillna(fill).astype("int64")
+
+    return _kernel
+
+
+def _bool_kernel(col_name, spec):
+    def _prep(values):
+        return values.str.strip().str.lower().map(BOOL_LOOKUP)
+
+    return lambda col: _map_unique(col, _prep).infer_objects()
+
+
+def _parse_dates(values, formats):
+    # parse with the first format matching every value, or else with the one
+    # matching most, the values it misses are left to per-value inference
+    best, best_fmt = None, None
+    for fmt in formats:
+        parsed = to_datetime(values, format=fmt, errors="coerce")
+        if parsed.notna().all():
+            return parsed, fmt
+        if best is None or parsed.notna().sum() > best.notna().sum():
+            best, best_fmt = parsed, fmt
+    is_na = best.isna()
+    best.loc[is_na] = to_datetime(values.loc[is_na], format="mixed", errors="coerce")
+    return best, best_fmt
+
+
+def record_unparsed(unparsed, col_name, count, values):
+    """Add unparseable dates to a record accumulated over chunks.
 
-def prep_cases_df(df):
+    Args:
+        unparsed (dict): Column name to the row count and the first
+            UNPARSED_SAMPLE distinct values, updated in place.
+        col_name (str): The date column.
+        count (int): Number of rows holding the values.
+        values (list): The distinct values.
+    """
+    record = unparsed.setdefault(col_name, dict(count=0, values=[]))
+    record["count"] += count
+    new_values = [v for v in values if v not in record["values"]]
+    record["values"] = (record["values"] + new_values)[:UNPARSED_SAMPLE]
+
+
+def _date_kernel(col_name, spec):
+    fill = spec.get("default", 0)
+    # format detected on an earlier chunk, tried first
+    found = []
+
+    def _kernel(col, unparsed=None):
+        bad = []
+
+        def _prep(values):
+            text = values.dropna().astype(str).str.strip()
+            text = text.loc[text != ""]
+            parsed, fmt = _parse_dates(text, found + DATE_FORMATS)
+            if fmt is not None and len(text) > 0:
+                found[:] = [fmt]
+            bad.extend(values.loc[text.index[parsed.isna()]].tolist())
+            parsed = parsed.dt.tz_localize(TZ).astype(object)
+            return parsed.where(parsed.notna(), fill).reindex(
+                values.index, fill_value=fill
+            )
+
+        prepared = _map_unique(col, _prep)
+        if len(bad) > 0:
+            count = int(col.isin(bad).sum())
+            values = [str(v).strip() for v in bad]
+            print(
+                "Warning: {} has {} unparseable dates, saved as missing: {}".format(
+                    col_name, count, values[:UNPARSED_SAMPLE]
+                )
+            )
+            if unparsed is not None:
+                record_unparsed(unparsed, col_name, count, values)
+        return prepared
+
+    return _kernel
+
+
+def _unknown_kernel(col_name):
+    def _kernel(col):
+        print("Warning: Don't know how to format column: {}".format(col_name))
+        return _map_unique(col, lambda values: values.fillna("").str.strip())
+
+    return _kernel
+
+
+SCHEMA_KERNELS = dict(
+    String=_string_kernel,
+    Integer=_integer_kernel,
+    Bool=_bool_kernel,
+    Date=_date_kernel,
+)
+
+
+def compile_schema(schema):
+    """Compile a schema into one vectorized kernel per column.
+
+    Args:
+        schema (dict): Column name to field spec, see CASE_SCHEMA.
+
+    Returns:
+        dict: Column name to a function taking and returning a pandas.Series.
+    """
+    return {
+        col_name: SCHEMA_KERNELS[spec["dtype"]](col_name, spec)
+        for col_name, spec in schema.items()
+    }
+
+
+CASE_PLAN = compile_schema(CASE_SCHEMA)
+
+
+def compact_cases_df(df):
+    """Store prepared data in the smallest dtypes holding its values.
+
+    Text columns become categoricals, so the locations, PSGC codes and
+    statuses are kept as fixed-width integer codes into one copy of each
+    distinct value. Ages become int16, the Bool columns nullable booleans.
+    Values are unchanged, only their storage.
+
+    Args:
+        df (pandas.DataFrame): Data prepared by prep_cases_df.
+
+    Returns:
+        pandas.DataFrame: The compact data.
+    """
+    df = df.copy()
+    for col_name in df.columns:
+        dtype = COMPACT_DTYPES.get(CASE_SCHEMA.get(col_name, {}).get("dtype"))
+        if dtype is None or col_name in COMPACT_SKIP:
+            continue
+        col = df[col_name]
+        if dtype == "int16" and col.shape[0] > 0:
+            # out of range ages are kept as they are
+            if col.min() < iinfo("int16").min or col.max() > iinfo("int16").max:
+                continue
+        df[col_name] = col.astype(dtype)
+    return df
+
+
+def prep_cases_df(df, timings=None, compact=False, unparsed=None):
+    """Rename the DOH columns and format their values according to CASE_SCHEMA.
+
+    Args:
+        df (pandas.DataFrame): Raw case_info data.
+        timings (dict, optional): If given, the seconds spent on each column
+            are added to it, so timings can be accumulated over chunks.
+        compact (bool, optional): Return the data in compact dtypes, see
+            compact_cases_df.
+        unparsed (dict, optional): If given, the dates that match no format
+            and are saved as missing are added to it, see record_unparsed.
+
+    Returns:
+        pandas.DataFrame: The prepared data.
+
+    Raises:
+        SchemaError: If a column holds values outside of its choices, nothing
+            half prepared is returned.
+    """
     df = df.rename(columns=CASE_FIELD_MAP)
     df.columns = [camel_case(c) for c in df.columns]
     df = df.drop(columns=CASE_FIELD_DROP, errors="ignore")
-    valid = True
     for col_name in df.columns:
-        if col_name in CASE_SCHEMA:
-            if CASE_SCHEMA[col_name]["dtype"] == "String":
-                if "choices" in CASE_SCHEMA[col_name]:
-                    df[col_name] = df[col_name].str.strip().str.lower()
-                    no_match = (
-                        df.dropna()
-                        .loc[
-                            ~df[col_name].isin(CASE_SCHEMA[col_name]["choices"]),
-                            col_name,
-                        ]
-                        .unique()
-                    )
-                    if len(no_match) > 0:
-                        print(
-                            f"{col_name} has unmatched values: {no_match}!!! exiting..."
-                        )
-                        valid = False
-                        break
-                if "default" in CASE_SCHEMA[col_name]:
-                    df.loc[df[col_name].isna(), col_name] = CASE_SCHEMA[col_name][
-                        "default"
-                    ]
-                else:
-                    df.loc[df[col_name].isna(), col_name] = ""
-                df[col_name] = df[col_name].str.strip()
-            elif CASE_SCHEMA[col_name]["dtype"] == "Integer":
-                if "default" in CASE_SCHEMA[col_name]:
-                    df.loc[df[col_name].isna(), col_name] = CASE_SCHEMA[col_name][
-                        "default"
-                    ]
-                else:
-                    df.loc[df[col_name].isna(), col_name] = -1
-                df[col_name] = df[col_name].map(int, na_action="ignore")
-            elif CASE_SCHEMA[col_name]["dtype"] == "Bool":
-                df[col_name] = (
-                    df[col_name].str.strip().str.lower().map({"yes": True, "no": False})
+        t_start = perf_counter()
+        kernel = CASE_PLAN.get(col_name) or _unknown_kernel(col_name)
+        try:
+            if CASE_SCHEMA.get(col_name, {}).get("dtype") == "Date":
+                df[col_name] = kernel(df[col_name], unparsed)
+            else:
+                df[col_name] = kernel(df[col_name])
+        except SchemaError as e:
+            print(f"{e}!!! exiting...")
+            raise
+        finally:
+            if timings is not None:
+                timings[col_name] = (
+                    timings.get(col_name, 0.0) + perf_counter() - t_start
                 )
-            elif CASE_SCHEMA[col_name]["dtype"] == "Date":
-                df[col_name] = to_datetime(df[col_name]).dt.tz_localize("Asia/Manila")
-                if "default" in CASE_SCHEMA[col_name]:
-                    df.loc[df[col_name].isna(), col_name] = CASE_SCHEMA[col_name][
-                        "default"
-                    ]
-                else:
-                    df.loc[df[col_name].isna(), col_name] = 0
-        else:
-            print("Warning: Don't know how to format column: {}".format(col_name))
-            df.loc[df[col_name].isna(), col_name] = ""
-            df[col_name] = df[col_name].str.strip()
+    if compact:
+        return compact_cases_df(df)
     return df
+
+
+def print_timings(timings):
+    """Print the per-column timings collected by prep_cases_df."""
+    for col_name, t in sorted(timings.items(), key=lambda x: -x[1]):
+        print(f"  {col_name}: {t:.3f}s")
@@ -0,0 +1,201 @@
+from datetime import datetime
+
+from create_cube import CUBE_COL, CUBE_INDEXES
+from create_geomaps import GEOMAP_COL, GEOMAP_INDEXES
+from history import HISTORY_COLS, history_indexes
+
+# dates stored before it, i.e. the 0 filler of missing dates, are left out of
+# the partial indexes
+EPOCH = datetime(1970, 1, 1)
+
+# indexes of each collection, as `(keys, options)` pairs
+INDEXES = {
+    "cases": [
+        ([("caseCode", 1)], dict(unique=True)),
+        ([("healthStatus", 1), ("dateRepConf", 1)], {}),
+        ([("cityMuniPSGC", 1), ("healthStatus", 1)], {}),
+        ([("regionRes", 1), ("healthStatus", 1)], {}),
+        (
+            [("dateRepConf", 1)],
+            dict(partialFilterExpression={"dateRepConf": {"$gt": EPOCH}}),
+        ),
+        ([("createdAt", 1)], {}),
+        (
+            [("updatedAt", 1)],
+            dict(partialFilterExpression={"updatedAt": {"$gt": EPOCH}}),
+        ),
+    ],
+    "cases.deleted": [
+        ([("caseCode", 1)], {}),
+    ],
+    HISTORY_COLS["cases.stats"]: history_indexes("cases.stats"),
+    HISTORY_COLS["cases.summary"]: history_indexes("cases.summary"),
+    CUBE_COL: CUBE_INDEXES,
+    GEOMAP_COL: GEOMAP_INDEXES,
+}
+
+# queries the API runs, with a sample filter and the index expected to serve it
+QUERY_SHAPES = dict(
+    case_by_code=dict(
+        collection="cases",
+        filter={"caseCode": "C000000"},
+        index="caseCode_1",
+    ),
+    cases_by_health_status=dict(
+        collection="cases",
+        filter={"healthStatus": "mild"},
+        sort=[("dateRepConf", -1)],
+        index="healthStatus_1_dateRepConf_1",
+    ),
+    cases_by_city_mun=dict(
+        collection="cases",
+        filter={"cityMuniPSGC": "PH137401000"},
+        index="cityMuniPSGC_1_healthStatus_1",
+    ),
+    cases_by_city_mun_status=dict(
+        collection="cases",
+        filter={"cityMuniPSGC": "PH137401000", "healthStatus": "mild"},
+        index="cityMuniPSGC_1_healthStatus_1",
+    ),
+    cases_by_region_status=dict(
+        collection="cases",
+        filter={"regionRes": "NCR", "healthStatus": "mild"},
+        index="regionRes_1_healthStatus_1",
+    ),
+    cases_by_report_date=dict(
+        collection="cases",
+        filter={
+            "dateRepConf": {"$gte": datetime(2021, 1, 1), "$lt": datetime(2021, 2, 1)}
+        },
+        index="dateRepConf_1",
+    ),
+    cases_created_since=dict(
+        collection="cases",
+        filter={"createdAt": {"$gte": datetime(2021, 1, 1)}},
+        index="createdAt_1",
+    ),
+    cases_updated_since=dict(
+        collection="cases",
+        filter={"updatedAt": {"$gte": datetime(2021, 1, 1)}},
+        index="updatedAt_1",
+    ),
+    deleted_by_codes=dict(
+        collection="cases.deleted",
+        filter={"caseCode": {"$in": ["C000000", "C000001"]}},
+        index="caseCode_1",
+    ),
+    province_history=dict(
+        collection=HISTORY_COLS["cases.stats"],
+        filter={
+            "provincePSGC": "PH137400000",
+            "healthStatus": "all",
+            "createdAt": {"$gte": datetime(2021, 1, 1)},
+        },
+        sort=[("createdAt", 1)],
+        index="provincePSGC_1_healthStatus_1_createdAt_1",
+    ),
+    national_history=dict(
+        collection=HISTORY_COLS["cases.summary"],
+        filter={"healthStatus": "all", "createdAt": {"$gte": datetime(2021, 1, 1)}},
+        sort=[("createdAt", 1)],
+        index="healthStatus_1_createdAt_1",
+    ),
+    cube_by_location_dates=dict(
+        collection=CUBE_COL,
+        filter={
+            "level": "province",
+            "psgc": "PH137400000",
+            "dateRepConf": {"$gte": datetime(2021, 1, 1), "$lt": datetime(2021, 2, 1)},
+        },
+        index="level_1_psgc_1_dateRepConf_1",
+    ),
+    geomap_by_resolution=dict(
+        collection=GEOMAP_COL,
+        filter={"name": "ph-prov", "resolution": "medium"},
+        index="name_1_resolution_1",
+    ),
+)
+
+
+def index_name(keys):
+    """Get the default name MongoDB gives an index.
+
+    Args:
+        keys (list): `(field, direction)` pairs.
+
+    Returns:
+        str: The index name, e.g. "caseCode_1".
+    """
+    return "_".join("{}_{}".format(k, d) for k, d in keys)
+
+
+def ensure_indexes(mongo_db):
+    """Create the registered indexes that are missing.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+    """
+    for col_name, indexes in INDEXES.items():
+        mongo_col = mongo_db[col_name]
+        existing = mongo_col.index_information()
+        for keys, options in indexes:
+            if index_name(keys) in existing:
+                continue
+            print("Creating index {} on '{}'...".format(index_name(keys), col_name))
+            mongo_col.create_index(keys, **options)
+
+
+def _plan_stages(plan):
+    # stage names and index names found anywhere in an explain plan
+    stages, index_names = set(), set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        if "indexName" in plan:
+            index_names.add(plan["indexName"])
+        plan = list(plan.values())
+    if isinstance(plan, list):
+        for value in plan:
+            _stages, _index_names = _plan_stages(value)
+            stages |= _stages
+            index_names |= _index_names
+    return stages, index_names
+
+
+def check_query_shapes(mongo_db):
+    """Explain every registered query and report those not using their index.
+
+    Queries on collections that do not exist yet, e.g. the cube before its
+    first build, are skipped.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+
+    Returns:
+        list: Names of the query shapes not served by their index.
+    """
+    failed = []
+    existing = set(mongo_db.list_collection_names())
+    shapes = {
+        name: shape
+        for name, shape in QUERY_SHAPES.items()
+        if shape["collection"] in existing
+    }
+    for name, shape in shapes.items():
+        cursor = mongo_db[shape["collection"]].find(shape["filter"])
+        if "sort" in shape:
+            cursor = cursor.sort(shape["sort"])
+        stages, index_names = _plan_stages(
+            cursor.explain()["queryPlanner"]["winningPlan"]
+        )
+        if shape["index"] not in index_names:
+            used = ", ".join(sorted(index_names)) or "/".join(sorted(stages))
+            print(
+                "Warning: query '{}' on '{}' does not use index {} ({})".format(
+                    name, shape["collection"], shape["index"], used
+                )
+            )
+            failed.append(name)
+    if len(failed) == 0:
+        print("All {} query shapes use their index.".format(len(shapes)))
+    return failed
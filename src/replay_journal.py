@@ -0,0 +1,171 @@
+import sys
+import argparse
+from pathlib import Path
+from dotenv import dotenv_values
+from pymongo import MongoClient
+import pandas as pd
+
+from constants import (
+    BATCH_SIZE,
+    JOURNAL_DIR,
+    MEMORY_BUDGET_MB,
+    READ_WORKERS,
+    TZ,
+    WRITE_QUEUE_DEPTH,
+    WRITE_WORKERS,
+)
+from instrument import finish_run, stage, start_run
+from journal import list_segments, replay_segments, write_base
+from loader import load_collection
+from query_shapes import INDEXES
+from snapshot import pq, read_snapshot, snapshot_date
+
+config = dotenv_values()
+
+
+def init_journal(in_csv, use_cache=True, workers=READ_WORKERS):
+    """Start an empty journal with the snapshot currently in the database.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot last applied by update_db.
+        use_cache (bool, optional): See snapshot.iter_snapshot.
+        workers (int, optional): See snapshot.iter_snapshot.
+    """
+    with stage("init") as metrics:
+        df = read_snapshot(in_csv, use_cache=use_cache, workers=workers)
+        write_base(df, snapshot_date(in_csv), [in_csv.name])
+        metrics["rows"] = df.shape[0]
+
+
+def main(
+    until=None,
+    batch_size=BATCH_SIZE,
+    write_workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+    init=None,
+    workers=READ_WORKERS,
+    metrics_path=None,
+    profile_dir=None,
+    memory_budget_mb=MEMORY_BUDGET_MB,
+):
+    if pq is None:
+        print("pyarrow not installed, the journal cannot be read... exiting...")
+        sys.exit()
+    start_run("replay_journal", profile_dir, memory_budget_mb)
+
+    if init is not None:
+        init_journal(init, workers=workers)
+        finish_run(metrics_path)
+        return
+
+    segments = list_segments(until)
+    if len(segments) == 0:
+        print("No journal segments found in {}... exiting...".format(JOURNAL_DIR))
+        sys.exit()
+    print(
+        "Replaying {} segments, {} to {}...".format(
+            len(segments), segments[0].name, segments[-1].name
+        )
+    )
+    with stage("replay") as metrics:
+        cases_dfs, deleted_dfs = replay_segments(segments)
+        metrics["rows"] = sum(df.shape[0] for df in cases_dfs)
+
+    # region mongodb
+    print("Connecting to mongodb...")
+    mongo_client = MongoClient(config["MONGO_DB_URL"])
+    mongo_db = mongo_client["defaultDb"]
+    print("Connection successful...")
+    # endregion mongodb
+
+    # both collections are rebuilt in staging and swapped in, readers keep
+    # the current data until the replay is loaded
+    for col_name, dfs in [("cases", cases_dfs), ("cases.deleted", deleted_dfs)]:
+        with stage("write_" + col_name.replace(".", "_")) as metrics:
+            metrics["rows"] = load_collection(
+                mongo_db,
+                col_name,
+                dfs,
+                indexes=INDEXES[col_name],
+                batch_size=batch_size,
+                workers=write_workers,
+                queue_depth=queue_depth,
+            )
+
+    finish_run(metrics_path)
+    mongo_client.close()
+    print("Connection closed...")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the cases collections from the change journal."
+    )
+    parser.add_argument(
+        "--until",
+        type=lambda s: pd.Timestamp(s).tz_localize(TZ),
+        help="rebuild the collections as of this date, e.g. 20210601,"
+        " defaults to the last journaled day",
+    )
+    parser.add_argument(
+        "--init",
+        type=Path,
+        help="start an empty journal with this snapshot, the last one applied"
+        " to the database, instead of replaying",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(config.get("BATCH_SIZE", BATCH_SIZE)),
+        help="cases per bulk write",
+    )
+    parser.add_argument(
+        "--write-workers",
+        type=int,
+        default=int(config.get("WRITE_WORKERS", WRITE_WORKERS)),
+        help="threads sending bulk writes concurrently",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=int(config.get("WRITE_QUEUE_DEPTH", WRITE_QUEUE_DEPTH)),
+        help="bulk writes in flight at most",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(config.get("READ_WORKERS", 0)) or READ_WORKERS,
+        help="with --init, processes parsing the parts of a split snapshot",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="save the run metrics to this json file, defaults to METRICS_DIR",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help="save a cProfile dump of each stage to this directory",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=float(config.get("MEMORY_BUDGET_MB", 0)) or MEMORY_BUDGET_MB,
+        help="peak MB of memory each stage may use before a warning",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(
+        until=args.until,
+        batch_size=args.batch_size,
+        write_workers=args.write_workers,
+        queue_depth=args.queue_depth,
+        init=args.init,
+        workers=args.workers,
+        metrics_path=args.metrics,
+        profile_dir=args.profile_dir,
+        memory_budget_mb=args.memory_budget,
+    )
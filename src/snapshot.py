@@ -0,0 +1,391 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import pandas as pd
+from numpy import nan
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from constants import CASE_INFO_CSV_DIR, SNAPSHOT_CACHE_DIR, TZ
+from models import (
+    CASE_FIELD_DROP,
+    CASE_FIELD_MAP,
+    CASE_SCHEMA,
+    COMPACT_SKIP,
+    compact_cases_df,
+    prep_cases_df,
+    prep_column_names,
+    raw_column_dtypes,
+    record_unparsed,
+)
+
+# bump when the on-disk encoding of the cached frames or the output of the
+# prep kernels changes, e.g. the dtype of a parsed Date column
+CACHE_FORMAT = 2
+
+
+def list_snapshots():
+    """List the daily case_info files, oldest first.
+
+    Returns:
+        list: Paths of the `<date>_case_info.csv` files.
+    """
+    in_csvs = list(CASE_INFO_CSV_DIR.glob("*case_info.csv"))
+    in_csvs.sort()
+    return in_csvs
+
+
+def snapshot_date(in_csv):
+    """Get the date of a snapshot from its file name.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+
+    Returns:
+        pandas.Timestamp: The localized snapshot date.
+    """
+    date_str = in_csv.name.split("_")[0]
+    return pd.to_datetime(date_str).tz_localize(TZ)
+
+
+def snapshot_parts(in_csv):
+    """List the files making up a snapshot.
+
+    A day's drop may be split into several csv files saved under
+    `CASE_INFO_CSV_DIR/<date>_case_info/`.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+
+    Returns:
+        list: Paths of the csv parts, in reading order.
+    """
+    part_dir = CASE_INFO_CSV_DIR / in_csv.name.split(".")[0]
+    if part_dir.is_dir():
+        parts = list(part_dir.glob("*.csv"))
+        parts.sort()
+        return parts
+    return [in_csv]
+
+
+def snapshot_columns(in_csv):
+    """Get the prepared column names of a snapshot without reading its rows.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+
+    Returns:
+        list: The prepared column names.
+    """
+    columns = pd.read_csv(snapshot_parts(in_csv)[0], nrows=0).columns
+    return prep_column_names(columns)
+
+
+def snapshot_cache_file(in_csv):
+    """Get the cache file of a prepared snapshot.
+
+    The file name carries a key over the checksums of the source csv parts,
+    CASE_SCHEMA and the cache format, so an edited drop or a schema change
+    never loads a stale frame.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+
+    Returns:
+        pathlib.Path: The parquet file, which may not exist yet.
+    """
+    key = hashlib.sha1()
+    key.update(
+        json.dumps(
+            [CACHE_FORMAT, CASE_SCHEMA, CASE_FIELD_MAP, CASE_FIELD_DROP],
+            sort_keys=True,
+        ).encode()
+    )
+    for part in snapshot_parts(in_csv):
+        key.update(part.name.encode())
+        with open(part, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+    return SNAPSHOT_CACHE_DIR / "{}.{}.parquet".format(
+        in_csv.name.split(".")[0], key.hexdigest()[:16]
+    )
+
+
+def encode_frame(df):
+    """Convert prepared data to columns parquet can store.
+
+    Date and Bool columns mix values with the 0 / NaN fillers, they are
+    stored as proper nullable columns instead. Compact columns are stored
+    in their regular dtypes, so the files do not depend on the mode they
+    were written in.
+
+    Args:
+        df (pandas.DataFrame): Prepared data.
+
+    Returns:
+        pandas.DataFrame: A converted copy, see decode_frame.
+    """
+    df = df.copy()
+    for col_name in df.columns:
+        dtype = CASE_SCHEMA.get(col_name, {}).get("dtype")
+        if dtype == "Date":
+            df[col_name] = pd.to_datetime(
+                df[col_name].where(df[col_name].ne(0)), utc=True
+            )
+        elif dtype == "Bool":
+            df[col_name] = df[col_name].astype("boolean")
+        elif dtype == "Integer":
+            df[col_name] = df[col_name].astype("int64")
+        elif isinstance(df[col_name].dtype, pd.CategoricalDtype):
+            df[col_name] = df[col_name].astype(object)
+    return df
+
+
+def decode_frame(df, compact=False):
+    """Convert data read from parquet back to prepared data, in place.
+
+    Args:
+        df (pandas.DataFrame): Output of encode_frame, as read back.
+        compact (bool, optional): Return the data in compact dtypes, see
+            models.compact_cases_df.
+
+    Returns:
+        pandas.DataFrame: The prepared data.
+    """
+    for col_name in df.columns:
+        dtype = CASE_SCHEMA.get(col_name, {}).get("dtype")
+        if dtype == "Date":
+            col = df[col_name].dt.tz_convert(TZ)
+            df[col_name] = col.astype(object).where(col.notna(), 0)
+        elif dtype == "Bool" and not compact:
+            col = df[col_name].astype("boolean")
+            if col.isna().any():
+                col = col.astype(object).where(col.notna(), nan)
+            else:
+                col = col.astype(bool)
+            df[col_name] = col
+        elif isinstance(df[col_name].dtype, pd.CategoricalDtype) and not compact:
+            df[col_name] = df[col_name].astype(object)
+    if compact:
+        return compact_cases_df(df)
+    return df
+
+
+def _iter_cache(cache_file, chunk_size=None, compact=False):
+    read_dictionary = None
+    if compact:
+        # text columns are read straight into categoricals
+        read_dictionary = [
+            field.name
+            for field in pq.read_schema(cache_file)
+            if CASE_SCHEMA.get(field.name, {}).get("dtype") == "String"
+            and field.name not in COMPACT_SKIP
+        ]
+    if chunk_size is None:
+        df = pd.read_parquet(cache_file, read_dictionary=read_dictionary)
+        yield decode_frame(df, compact)
+        return
+    cache = pq.ParquetFile(cache_file, read_dictionary=read_dictionary)
+    for batch in cache.iter_batches(batch_size=chunk_size):
+        yield decode_frame(batch.to_pandas(), compact)
+
+
+def _write_cache(cache_file, chunks):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(".tmp")
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(encode_frame(chunk), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_file, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            yield chunk
+        # only reached once every chunk prepared; a SchemaError raised by prep
+        # or a consumer stopping early leaves the old cache in place
+        if writer is not None:
+            writer.close()
+            writer = None
+            tmp_file.replace(cache_file)
+            for stale_file in cache_file.parent.glob(
+                "{}.*.parquet".format(cache_file.name.split(".")[0])
+            ):
+                if stale_file != cache_file:
+                    stale_file.unlink()
+    finally:
+        if writer is not None:
+            writer.close()
+        if tmp_file.is_file():
+            tmp_file.unlink()
+
+
+def _iter_part(part, chunk_size=None, timings=None, compact=False, unparsed=None):
+    dtypes = raw_column_dtypes(pd.read_csv(part, nrows=0).columns)
+    chunks = pd.read_csv(part, low_memory=False, dtype=dtypes, chunksize=chunk_size)
+    if chunk_size is None:
+        chunks = [chunks]
+    for chunk in chunks:
+        chunk = prep_cases_df(
+            chunk, timings=timings, compact=compact, unparsed=unparsed
+        )
+        chunk.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
+        yield chunk
+
+
+def _prep_part(part, chunk_size=None, compact=False):
+    # runs in a worker process
+    timings, unparsed = {}, {}
+    chunks = list(_iter_part(part, chunk_size, timings, compact, unparsed))
+    return chunks, timings, unparsed
+
+
+def _iter_csv(
+    in_csv, chunk_size=None, timings=None, workers=1, compact=False, unparsed=None
+):
+    parts = snapshot_parts(in_csv)
+    if workers is None:
+        workers = os.cpu_count()
+    workers = min(workers, len(parts))
+    if workers <= 1:
+        for part in parts:
+            yield from _iter_part(part, chunk_size, timings, compact, unparsed)
+        return
+
+    # keep at most `workers` parts in flight so memory stays bounded, and
+    # yield them back in file order
+    parts = iter(parts)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(
+            executor.submit(_prep_part, part, chunk_size, compact)
+            for part in islice(parts, workers)
+        )
+        while len(pending) > 0:
+            chunks, part_timings, part_unparsed = pending.popleft().result()
+            for part in islice(parts, 1):
+                pending.append(executor.submit(_prep_part, part, chunk_size, compact))
+            if timings is not None:
+                for col_name, t in part_timings.items():
+                    timings[col_name] = timings.get(col_name, 0.0) + t
+            if unparsed is not None:
+                for col_name, record in part_unparsed.items():
+                    record_unparsed(
+                        unparsed, col_name, record["count"], record["values"]
+                    )
+            while len(chunks) > 0:
+                yield chunks.pop(0)
+
+
+def iter_snapshot(
+    in_csv,
+    chunk_size=None,
+    use_cache=False,
+    timings=None,
+    workers=1,
+    compact=False,
+    unparsed=None,
+):
+    """Read and prepare a snapshot in bounded chunks.
+
+    Duplicated case codes are only removed within a chunk, deduplication
+    across chunks is left to the consumer.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+        chunk_size (int, optional): Number of rows per chunk. Reads each
+            part whole if not set.
+        use_cache (bool, optional): Load the prepared snapshot from the cache,
+            or save it there while reading the csv. Ignored without pyarrow.
+        timings (dict, optional): Collects the per-column prep timings, see
+            prep_cases_df.
+        workers (int, optional): Number of processes parsing the parts of a
+            split snapshot in parallel, all cores if None. At most this many
+            parts are held in memory at once.
+        compact (bool, optional): Yield the chunks in compact dtypes, see
+            models.compact_cases_df.
+        unparsed (dict, optional): Collects the unparseable dates, see
+            prep_cases_df. Only found while parsing the csv, the cache holds
+            them as missing.
+
+    Yields:
+        pandas.DataFrame: The prepared chunks.
+    """
+    if use_cache and pq is None:
+        print("Warning: pyarrow not installed, snapshot cache disabled")
+        use_cache = False
+    if not use_cache:
+        yield from _iter_csv(in_csv, chunk_size, timings, workers, compact, unparsed)
+        return
+    cache_file = snapshot_cache_file(in_csv)
+    if cache_file.is_file():
+        print("Loading {} from cache...".format(in_csv.name))
+        yield from _iter_cache(cache_file, chunk_size, compact)
+    else:
+        yield from _write_cache(
+            cache_file,
+            _iter_csv(in_csv, chunk_size, timings, workers, compact, unparsed),
+        )
+
+
+def merge_chunks(chunks):
+    """Concatenate prepared chunks one column at a time.
+
+    Each column is released from the chunks as soon as it is merged, so the
+    peak memory is the snapshot plus a single column rather than two full
+    copies. Categorical columns stay categorical, their categories are
+    merged.
+
+    Args:
+        chunks (list): Prepared chunks, emptied in place.
+
+    Returns:
+        pandas.DataFrame: The merged frame.
+    """
+    columns = list(dict.fromkeys(c for chunk in chunks for c in chunk.columns))
+    data = {}
+    for col_name in columns:
+        pieces = [
+            (
+                chunk.pop(col_name)
+                if col_name in chunk
+                else pd.Series(nan, index=chunk.index, dtype=object)
+            )
+            for chunk in chunks
+        ]
+        if all(isinstance(p.dtype, pd.CategoricalDtype) for p in pieces):
+            data[col_name] = pd.Series(union_categoricals(pieces), copy=False)
+        else:
+            data[col_name] = pd.concat(pieces, ignore_index=True)
+        del pieces
+    chunks.clear()
+    return pd.DataFrame(data, copy=False)
+
+
+def read_snapshot(in_csv, use_cache=False, workers=1, compact=False):
+    """Read and prepare a whole snapshot.
+
+    Args:
+        in_csv (pathlib.Path): The snapshot file.
+        use_cache (bool, optional): See iter_snapshot.
+        workers (int, optional): See iter_snapshot.
+        compact (bool, optional): See iter_snapshot.
+
+    Returns:
+        pandas.DataFrame: The prepared snapshot, one row per case code.
+    """
+    df = merge_chunks(
+        list(
+            iter_snapshot(in_csv, use_cache=use_cache, workers=workers, compact=compact)
+        )
+    )
+    df.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
+    return df
@@ -1,16 +1,390 @@
 import sys
+import argparse
+from pathlib import Path
 from dotenv import dotenv_values
 from pymongo import MongoClient
-import math
 import pandas as pd
 
-from constants import CASE_INFO_CSV_DIR, TZ
-from models import CASE_SCHEMA, prep_cases_df
+from changeset import (
+    changeset_dir,
+    changeset_summary,
+    compute_changeset,
+    diff_files,
+    print_changeset,
+    read_changeset,
+    write_changeset,
+)
+from constants import (
+    BATCH_SIZE,
+    CHUNK_SIZE,
+    MEMORY_BUDGET_MB,
+    READ_WORKERS,
+    TZ,
+    WRITE_QUEUE_DEPTH,
+    WRITE_WORKERS,
+)
+from create_cube import CUBE_COLS, update_cube
+from create_summary import SUMMARY_COLS, fetch_summary_rows, update_summaries
+from instrument import finish_run, stage, start_run
+from journal import append_segment, check_segment
+from diff import diff_chunks, fingerprint_cols, index_snapshot, merge_index
+from models import CASE_SCHEMA
+from query_shapes import check_query_shapes
+from snapshot import (
+    iter_snapshot,
+    list_snapshots,
+    pq,
+    snapshot_columns,
+    snapshot_date,
+)
+from writer import delete_cases, parse_write_concern, upsert_cases
 
 config = dotenv_values()
 
+# last snapshot applied to the cases collection, see save_checkpoint
+CHECKPOINT_COL = "cases.checkpoint"
+
+
+def read_checkpoint(mongo_db):
+    """Get the date of the last snapshot applied to the cases collection.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+
+    Returns:
+        pandas.Timestamp: The localized date, None before the first update.
+    """
+    doc = mongo_db[CHECKPOINT_COL].find_one({"_id": "cases"})
+    if doc is None:
+        return None
+    return pd.to_datetime(doc["date"], utc=True).tz_convert(TZ)
+
+
+def save_checkpoint(mongo_db, summary):
+    """Record the snapshot last applied to the cases collection.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        summary (dict): Summary of the applied changes, see
+            changeset.changeset_summary.
+    """
+    mongo_db[CHECKPOINT_COL].update_one(
+        {"_id": "cases"},
+        {
+            "$set": {
+                "date": pd.Timestamp(summary["date"]),
+                "snapshots": summary["snapshots"],
+            }
+        },
+        upsert=True,
+    )
+
+
+def check_new_columns(prev_cols, curr_cols):
+    """Exit if a snapshot brings columns missing from CASE_SCHEMA.
+
+    Args:
+        prev_cols (list): Prepared columns of the previous snapshot.
+        curr_cols (list): Prepared columns of the current snapshot.
+    """
+    new_cols = list(set(curr_cols) - set(prev_cols))
+    if not all([col_name in CASE_SCHEMA.keys() for col_name in new_cols]):
+        print("New columns found, please update")
+        sys.exit()
+
+
+def apply_changes(
+    mongo_db,
+    snap_diff,
+    summary,
+    batch_size=BATCH_SIZE,
+    write_concern=None,
+    update_summary=False,
+    write_workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+    journal=True,
+    cube=False,
+):
+    """Write a day's changes to the cases collections.
+
+    Deleted cases are moved to cases.deleted, changed and new cases are
+    upserted, all stamped with the date of the changes. The summaries and
+    the cube are updated next, so a day applied again after a failed journal
+    append leaves them unchanged, one interrupted during the case writes
+    leaves them to be rebuilt with create_summary and create_cube. The day
+    is then journaled and checkpointed. The journal is checked before the
+    first write, a day it would refuse is not applied.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        snap_diff (SnapshotDiff): The changes.
+        summary (dict): Their summary, see changeset.changeset_summary.
+        batch_size (int, optional): Number of cases per bulk write.
+        write_concern (pymongo.write_concern.WriteConcern, optional): Write
+            concern of the bulk writes.
+        update_summary (bool, optional): Also apply the changes to
+            cases.stats and cases.summary.
+        write_workers (int, optional): See writer.iter_writes.
+        queue_depth (int, optional): See writer.iter_writes.
+        journal (bool, optional): Append the changes to the journal.
+        cube (bool, optional): Also apply the changes to the case cube, see
+            create_cube.
+    """
+    mongo_col = mongo_db["cases"]
+    new_date = pd.Timestamp(summary["date"]).tz_convert(TZ)
+    new_df = snap_diff.new
+    changed_df = snap_diff.changed
+    del_case_code = snap_diff.deleted
+    print("Unchanged entries: {}".format(snap_diff.unchanged))
+
+    if journal and pq is None:
+        print("Warning: pyarrow not installed, the changes are not journaled")
+        journal = False
+    if journal:
+        # raises before the database is touched
+        check_segment(summary)
+
+    if update_summary or cube:
+        # stored version of the cases about to be replaced or removed, new
+        # cases included: they are already stored when the day is applied
+        # again, and are then replaced rather than counted twice
+        with stage("read_summary_rows") as metrics:
+            old_summary_df = fetch_summary_rows(
+                mongo_col,
+                del_case_code
+                + changed_df["caseCode"].to_list()
+                + new_df["caseCode"].to_list(),
+                CUBE_COLS if cube else SUMMARY_COLS,
+            )
+            metrics["rows"] = old_summary_df.shape[0]
+
+    # region deleted entries
+    with stage("delete") as metrics:
+        metrics["rows"] = delete_cases(mongo_db, del_case_code, new_date)
+        if metrics["rows"] > 0:
+            print("Deleted entries: {}".format(len(del_case_code)))
+    # endregion deleted entries
+
+    # region updated entries
+    if changed_df.shape[0] > 0:
+        with stage("write_changed") as metrics:
+            counts = upsert_cases(
+                mongo_col,
+                changed_df,
+                new_date,
+                is_update=True,
+                batch_size=batch_size,
+                write_concern=write_concern,
+                workers=write_workers,
+                queue_depth=queue_depth,
+            )
+            metrics["rows"] = changed_df.shape[0]
+        print("Updated entries: {}".format(counts["matched"]))
+        if counts["upserted"] > 0:
+            print(
+                "Changed entries missing from database: {}".format(counts["upserted"])
+            )
+    # endregion updated entries
+
+    # region new entries
+    if new_df.shape[0] > 0:
+        with stage("write_new") as metrics:
+            counts = upsert_cases(
+                mongo_col,
+                new_df,
+                new_date,
+                is_update=False,
+                batch_size=batch_size,
+                write_concern=write_concern,
+                workers=write_workers,
+                queue_depth=queue_depth,
+            )
+            metrics["rows"] = new_df.shape[0]
+        print("New entries: {}".format(counts["upserted"]))
+    # endregion new entries
+
+    if update_summary:
+        print("Updating summaries...")
+        with stage("summary") as metrics:
+            update_summaries(
+                mongo_db,
+                old_summary_df[SUMMARY_COLS],
+                pd.concat([changed_df[SUMMARY_COLS], new_df[SUMMARY_COLS]]),
+                new_date,
+            )
+            metrics["rows"] = old_summary_df.shape[0] + changed_df.shape[0]
+            metrics["rows"] += new_df.shape[0]
+
+    if cube:
+        print("Updating cube...")
+        with stage("cube") as metrics:
+            update_cube(
+                mongo_db,
+                old_summary_df,
+                pd.concat([changed_df[CUBE_COLS], new_df[CUBE_COLS]]),
+                new_date,
+            )
+            metrics["rows"] = old_summary_df.shape[0] + changed_df.shape[0]
+            metrics["rows"] += new_df.shape[0]
+
+    if journal:
+        with stage("journal") as metrics:
+            try:
+                append_segment(snap_diff, summary)
+            except Exception:
+                print(
+                    "Error: the changes of {} are in the database but not in the"
+                    " journal, the checkpoint is not saved".format(new_date.date())
+                )
+                raise
+            metrics["rows"] = new_df.shape[0] + changed_df.shape[0]
+
+    save_checkpoint(mongo_db, summary)
+
+
+def backfill(
+    mongo_db,
+    in_csvs,
+    chunk_size=CHUNK_SIZE,
+    use_cache=True,
+    workers=READ_WORKERS,
+    compact=False,
+    **write_options,
+):
+    """Apply a run of snapshots in order, one day at a time.
+
+    Each snapshot is parsed once: the fingerprints of the current snapshot
+    are collected while it is diffed, and become the previous snapshot of
+    the next day. Each day is applied with its own date and checkpointed,
+    so an interrupted backfill resumes from the last applied day.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        in_csvs (list): The snapshots, oldest first, starting with the one
+            already applied.
+        chunk_size (int, optional): See snapshot.iter_snapshot.
+        use_cache (bool, optional): See snapshot.iter_snapshot.
+        workers (int, optional): See snapshot.iter_snapshot.
+        compact (bool, optional): See snapshot.iter_snapshot.
+        **write_options: Passed to apply_changes.
+    """
+    prev_csv = in_csvs[0]
+    prev_cols = snapshot_columns(prev_csv)
+    prev_index = None
+    index_cols = None
+    for in_csv in in_csvs[1:]:
+        new_date = snapshot_date(in_csv)
+        print("Date: {}".format(new_date))
+        curr_cols = snapshot_columns(in_csv)
+        check_new_columns(prev_cols, curr_cols)
+        cols = fingerprint_cols(prev_cols, curr_cols)
+        with stage(new_date.strftime("%Y%m%d")):
+            if cols != index_cols:
+                # first day, or the compared columns changed
+                print("Indexing previous snapshot...")
+                with stage("index_prev") as metrics:
+                    prev_index = index_snapshot(
+                        iter_snapshot(
+                            prev_csv,
+                            chunk_size,
+                            use_cache=use_cache,
+                            workers=workers,
+                            compact=compact,
+                        ),
+                        cols,
+                    )
+                    metrics["rows"] = prev_index.shape[0]
+            print("Comparing current snapshot...")
+            with stage("diff") as metrics:
+                curr_index, unparsed = [], {}
+                snap_diff = diff_chunks(
+                    prev_index,
+                    iter_snapshot(
+                        in_csv,
+                        chunk_size,
+                        use_cache=use_cache,
+                        workers=workers,
+                        compact=compact,
+                        unparsed=unparsed,
+                    ),
+                    cols,
+                    curr_index,
+                )
+                prev_index = merge_index(curr_index)
+                index_cols = cols
+                metrics["rows"] = prev_index.shape[0]
+                metrics["unparsed_dates"] = sum(r["count"] for r in unparsed.values())
+            summary = changeset_summary(
+                snap_diff,
+                new_date,
+                snapshot_date(prev_csv),
+                [prev_csv.name, in_csv.name],
+                cols,
+            )
+            apply_changes(mongo_db, snap_diff, summary, **write_options)
+        prev_csv, prev_cols = in_csv, curr_cols
+
+
+def main(
+    chunk_size=CHUNK_SIZE,
+    batch_size=BATCH_SIZE,
+    write_concern=None,
+    use_cache=True,
+    workers=READ_WORKERS,
+    update_summary=False,
+    write_workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+    metrics_path=None,
+    profile_dir=None,
+    dry_run=False,
+    changeset=None,
+    journal=True,
+    backfill_days=False,
+    since=None,
+    compact=False,
+    memory_budget_mb=MEMORY_BUDGET_MB,
+    cube=False,
+    force=False,
+):
+    start_run("update_db", profile_dir, memory_budget_mb)
+
+    if changeset is not None:
+        print("Loading changeset {}...".format(changeset))
+        with stage("read_changeset") as metrics:
+            snap_diff, summary = read_changeset(changeset)
+            metrics["rows"] = summary["counts"]["new"] + summary["counts"]["changed"]
+        new_date = pd.Timestamp(summary["date"]).tz_convert(TZ)
+        prev_date = pd.Timestamp(summary["prevDate"]).tz_convert(TZ)
+        print_changeset(summary)
+    elif not backfill_days:
+        in_csvs = list_snapshots()
+        in_csv = in_csvs[-1]
+        in_csv0 = in_csvs[-2]
+
+        new_date = snapshot_date(in_csv)
+        prev_date = snapshot_date(in_csv0)
+        print("Date: {}".format(new_date))
+        check_new_columns(snapshot_columns(in_csv0), snapshot_columns(in_csv))
+
+    if dry_run:
+        if pq is None:
+            print("pyarrow not installed, changesets are not available... exiting...")
+            sys.exit()
+        snap_diff, summary = compute_changeset(
+            in_csv0,
+            in_csv,
+            chunk_size,
+            use_cache=use_cache,
+            workers=workers,
+            compact=compact,
+        )
+        print_changeset(summary)
+        with stage("write_changeset") as metrics:
+            write_changeset(changeset_dir(new_date), snap_diff, summary)
+            metrics["rows"] = summary["counts"]["new"] + summary["counts"]["changed"]
+        finish_run(metrics_path)
+        return
 
-def main():
     # region mongodb
     print("Connecting to mongodb...")
     mongo_client = MongoClient(config["MONGO_DB_URL"])
@@ -25,141 +399,215 @@ def main():
         sys.exit()
     mongo_col = mongo_db["cases"]
     print("Connection successful...")
+    check_query_shapes(mongo_db)
     # endregion mongodb
 
-    in_csvs = list(CASE_INFO_CSV_DIR.glob("*case_info.csv"))
-    in_csvs.sort()
-    in_csv = in_csvs[-1]
+    # from the collection metadata, not a scan of the cases
+    print("Current count: {}".format(mongo_col.estimated_document_count()))
+    checkpoint = read_checkpoint(mongo_db)
+    write_options = dict(
+        batch_size=batch_size,
+        write_concern=write_concern,
+        update_summary=update_summary,
+        write_workers=write_workers,
+        queue_depth=queue_depth,
+        journal=journal,
+        cube=cube,
+    )
 
-    if (CASE_INFO_CSV_DIR / in_csv.name.split(".")[0]).is_dir():
-        _in_csvs = list((CASE_INFO_CSV_DIR / in_csv.name.split(".")[0]).glob("*.csv"))
-        _in_csvs.sort()
-        curr_df = pd.concat(
-            [pd.read_csv(_in_csv, low_memory=False) for _in_csv in _in_csvs],
-            ignore_index=True,
-        )
-    else:
-        curr_df = pd.read_csv(in_csv, low_memory=False)
-    curr_df = prep_cases_df(curr_df)
-    curr_df.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
-
-    date_str = in_csv.name.split("_")[0]
-    new_date = pd.to_datetime(date_str).tz_localize(TZ)
-    print("Date: {}".format(new_date))
-
-    in_csv0 = in_csvs[-2]
-    if (CASE_INFO_CSV_DIR / in_csv0.name.split(".")[0]).is_dir():
-        _in_csvs = list((CASE_INFO_CSV_DIR / in_csv0.name.split(".")[0]).glob("*.csv"))
-        _in_csvs.sort()
-        prev_df = pd.concat(
-            [pd.read_csv(_in_csv, low_memory=False) for _in_csv in _in_csvs],
-            ignore_index=True,
+    if backfill_days:
+        start = checkpoint if checkpoint is not None else since
+        if start is None:
+            print("No checkpoint found, set the applied snapshot with --since...")
+            mongo_client.close()
+            sys.exit()
+        in_csvs = [f for f in list_snapshots() if snapshot_date(f) >= start]
+        if len(in_csvs) == 0 or snapshot_date(in_csvs[0]) != start:
+            print("Snapshot of {} not found... exiting...".format(start.date()))
+            mongo_client.close()
+            sys.exit()
+        print("Backfilling {} days from {}...".format(len(in_csvs) - 1, start.date()))
+        backfill(
+            mongo_db,
+            in_csvs,
+            chunk_size,
+            use_cache,
+            workers,
+            compact,
+            **write_options,
         )
     else:
-        prev_df = pd.read_csv(in_csv0, low_memory=False)
-    prev_df = prep_cases_df(prev_df)
-    prev_df.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
-
-    new_cols = list(set(curr_df.columns) - set(prev_df.columns))
-    if not all([col_name in CASE_SCHEMA.keys() for col_name in new_cols]):
-        print("New columns found, please update")
-        mongo_client.close()
-        sys.exit()
-
-    curr_cnt = mongo_col.aggregate(
-        [{"$group": {"_id": 1, "count": {"$sum": 1}}}]
-    ).next()["count"]
-    print("Current count: {}".format(curr_cnt))
-
-    common_cols = list(set(prev_df.columns) & set(curr_df.columns))
-    new_df = pd.concat(
-        [prev_df[common_cols], prev_df[common_cols], curr_df[common_cols]]
-    ).drop_duplicates(keep=False)
-    new_df = curr_df.loc[curr_df["caseCode"].isin(new_df["caseCode"])].copy()
-
-    # region deleted entries
-    del_case_code = list(set(prev_df["caseCode"]) - set(curr_df["caseCode"]))
-    del_df = pd.DataFrame(
-        list(mongo_col.find({"caseCode": {"$in": del_case_code}}))
-    ).drop(columns=["_id"], errors="ignore")
-    if del_df.shape[0] > 0:
-        mongo_col.delete_many({"caseCode": {"$in": del_case_code}})
-        del_df["deletedAt"] = new_date
-        for col_name in del_df.select_dtypes(include=["datetime64"]).columns:
-            del_df[col_name] = del_df[col_name].fillna(0)
-        data_dict = del_df.to_dict("records")
-        mongo_col_del = mongo_db["cases.deleted"]
-        mongo_col_del.insert_many(data_dict)
-        print("Deleted entries: {}".format(len(del_case_code)))
-    # endregion deleted entries
-
-    # region updated entries
-    exist_df = []
-    if new_df.shape[0] > 0:
-        n = 20000
-        tot_iter = math.ceil(new_df.shape[0] / n)
-        n_loop = 1
-        for i in range(0, new_df.shape[0], n):
-            print(f"Processing {100.*n_loop/tot_iter:.2f}%...")
-            _new_df = new_df[i : i + n].copy()
-            _exist_df = pd.DataFrame(
-                mongo_col.find(
-                    {"caseCode": {"$in": _new_df["caseCode"].to_list()}},
-                    {"caseCode": 1, "createdAt": 1},
-                )
+        if checkpoint is not None and checkpoint >= new_date and not force:
+            # an older day would roll the cases back, the same day is a no-op
+            print(
+                "Snapshot of {} already applied, run with --force to apply it"
+                " again... exiting...".format(new_date.date())
             )
-            n_loop += 1
-            if _exist_df.shape[0] > 0:
-                exist_df.append(_exist_df)
-    if len(exist_df) > 0:
-        exist_df = pd.concat(exist_df, ignore_index=True)
-    else:
-        exist_df = pd.DataFrame(columns=["_id", "caseCode", "createdAt"])
-
-    update_df = exist_df.merge(new_df, on=["caseCode"])
-    update_df.drop_duplicates(subset=["caseCode"], inplace=True, ignore_index=True)
-    if update_df.shape[0] > 0:
-        n = 20000
-        tot_iter = math.ceil(new_df.shape[0] / n)
-        n_loop = 1
-        for i in range(0, update_df.shape[0], n):
-            print(f"Processing {100.*n_loop/tot_iter:.2f}%...")
-            _update_df = update_df[i : i + n].copy()
-            update_ids = _update_df["_id"].to_list()
-            mongo_col.delete_many({"_id": {"$in": update_ids}})
-            _update_df["updatedAt"] = new_date
-            _update_df = _update_df.drop(columns=["_id"], errors="ignore")
-            data_dict = _update_df.to_dict("records")
-            mongo_col.insert_many(data_dict)
-            n_loop += 1
-        print("Updated entries: {}".format(update_df.shape[0]))
-    # endregion updated entries
-
-    # region new entries
-    if update_df.shape[0] > 0:
-        new_df = new_df.loc[~new_df["caseCode"].isin(update_df["caseCode"])].copy()
+            mongo_client.close()
+            sys.exit()
+        if checkpoint is not None and checkpoint < prev_date:
+            print(
+                "Warning: the last applied snapshot is {}, run with --backfill to"
+                " apply the days in between".format(checkpoint.date())
+            )
+        if changeset is None:
+            snap_diff, cols = diff_files(
+                in_csv0,
+                in_csv,
+                chunk_size,
+                use_cache=use_cache,
+                workers=workers,
+                compact=compact,
+            )
+            summary = changeset_summary(
+                snap_diff, new_date, prev_date, [in_csv0.name, in_csv.name], cols
+            )
+        apply_changes(mongo_db, snap_diff, summary, **write_options)
 
-    if new_df.shape[0] > 0:
-        n = 20000
-        tot_iter = math.ceil(new_df.shape[0] / n)
-        n_loop = 1
-        for i in range(0, new_df.shape[0], n):
-            print(f"Processing {100.*n_loop/tot_iter:.2f}%...")
-            _new_df = new_df[i : i + n].copy()
-            _new_df["createdAt"] = new_date
-            data_dict = _new_df.to_dict("records")
-            mongo_col.insert_many(data_dict)
-            n_loop += 1
-        print("New entries: {}".format(new_df.shape[0]))
-    # endregion new entries
+    print("New count: {}".format(mongo_col.estimated_document_count()))
+    finish_run(metrics_path)
+    mongo_client.close()
 
-    new_cnt = mongo_col.aggregate(
-        [{"$group": {"_id": 1, "count": {"$sum": 1}}}]
-    ).next()["count"]
-    print("New count: {}".format(new_cnt))
 
-    mongo_client.close()
+def parse_args():
+    parser = argparse.ArgumentParser(description="Update the cases collection.")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=int(config.get("CHUNK_SIZE", CHUNK_SIZE)),
+        help="csv rows read at a time, 0 reads each file whole",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(config.get("BATCH_SIZE", BATCH_SIZE)),
+        help="cases per bulk write",
+    )
+    parser.add_argument(
+        "--write-concern",
+        default=config.get("WRITE_CONCERN"),
+        help='write concern "w" of the bulk writes, e.g. 1 or majority',
+    )
+    parser.add_argument(
+        "--write-journal",
+        action="store_true",
+        default=None,
+        help="wait for the journal commit of the bulk writes",
+    )
+    parser.add_argument(
+        "--write-workers",
+        type=int,
+        default=int(config.get("WRITE_WORKERS", WRITE_WORKERS)),
+        help="threads sending bulk writes concurrently",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=int(config.get("WRITE_QUEUE_DEPTH", WRITE_QUEUE_DEPTH)),
+        help="bulk writes in flight at most",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(config.get("READ_WORKERS", 0)) or READ_WORKERS,
+        help="processes parsing the parts of a split snapshot, defaults to all cores",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="always parse the csv files, skipping the prepared snapshot cache",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold the prepared snapshots in compact dtypes, e.g. categoricals",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=float(config.get("MEMORY_BUDGET_MB", 0)) or MEMORY_BUDGET_MB,
+        help="peak MB of memory each stage may use before a warning",
+    )
+    parser.add_argument(
+        "--update-summary",
+        action="store_true",
+        help="apply the day's changes to cases.stats and cases.summary",
+    )
+    parser.add_argument(
+        "--update-cube",
+        dest="cube",
+        action="store_true",
+        help="apply the day's changes to the case counts cube",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="save the run metrics to this json file, defaults to METRICS_DIR",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        help="save a cProfile dump of each stage to this directory",
+    )
+    parser.add_argument(
+        "--no-journal",
+        dest="journal",
+        action="store_false",
+        help="do not save the applied changes to JOURNAL_DIR",
+    )
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument(
+        "--backfill",
+        dest="backfill_days",
+        action="store_true",
+        help="apply every snapshot after the last applied one, day by day",
+    )
+    changes.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="save the day's changes to CHANGESET_DIR without connecting to mongodb",
+    )
+    changes.add_argument(
+        "--apply",
+        dest="changeset",
+        type=Path,
+        help="write the changes of a changeset saved by --dry-run",
+    )
+    parser.add_argument(
+        "--since",
+        type=lambda s: pd.Timestamp(s).tz_localize(TZ),
+        help="with --backfill and no checkpoint yet, date of the snapshot"
+        " currently in the database, e.g. 20210601",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="apply the day even if the checkpoint is already at or past it",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(
+        chunk_size=args.chunk_size or None,
+        batch_size=args.batch_size,
+        write_concern=parse_write_concern(args.write_concern, args.write_journal),
+        use_cache=args.use_cache,
+        workers=args.workers,
+        update_summary=args.update_summary,
+        write_workers=args.write_workers,
+        queue_depth=args.queue_depth,
+        metrics_path=args.metrics,
+        profile_dir=args.profile_dir,
+        dry_run=args.dry_run,
+        changeset=args.changeset,
+        journal=args.journal,
+        backfill_days=args.backfill_days,
+        since=args.since,
+        compact=args.compact,
+        memory_budget_mb=args.memory_budget,
+        cube=args.cube,
+        force=args.force,
+    )
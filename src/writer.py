@@ -0,0 +1,164 @@
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.write_concern import WriteConcern
+
+from constants import BATCH_SIZE, WRITE_QUEUE_DEPTH, WRITE_WORKERS
+from encoder import embed_document, iter_encoded, raw_document
+
+
+def parse_write_concern(w=None, j=None):
+    """Build a write concern from command line values.
+
+    Args:
+        w (str, optional): Number of acknowledging members or a tag such as
+            "majority". Uses the connection default if not set.
+        j (bool, optional): Wait for the journal commit.
+
+    Returns:
+        pymongo.write_concern.WriteConcern: The write concern, or None to keep
+            the collection default.
+    """
+    if w is None and j is None:
+        return None
+    if w is not None and w.isdigit():
+        w = int(w)
+    return WriteConcern(w=w, j=j)
+
+
+def _timed(write, batch):
+    # runs in a writer thread
+    t_start = time.perf_counter()
+    res = write(batch)
+    return res, time.perf_counter() - t_start
+
+
+def iter_writes(batches, write, workers=WRITE_WORKERS, queue_depth=WRITE_QUEUE_DEPTH):
+    """Write batches from a pool of threads while the next ones are prepared.
+
+    Batches are pulled from `batches` in the calling thread, so preparing
+    them overlaps with the writes in flight. At most `queue_depth` batches
+    are pending at once: when the queue is full the producer waits for the
+    oldest write, which keeps memory bounded.
+
+    Args:
+        batches (iterable): The batches, prepared lazily.
+        write (callable): Writes a batch, e.g. an unordered bulk write.
+        workers (int, optional): Number of writer threads, sharing the
+            connection pool of the client.
+        queue_depth (int, optional): Maximum number of batches in flight.
+
+    Yields:
+        tuple: The batch, the result of its write and the write time in
+            seconds, in batch order.
+    """
+    queue_depth = max(queue_depth, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches:
+            if len(pending) >= queue_depth:
+                batch0, future = pending.popleft()
+                yield (batch0, *future.result())
+            pending.append((batch, executor.submit(_timed, write, batch)))
+        while len(pending) > 0:
+            batch0, future = pending.popleft()
+            yield (batch0, *future.result())
+
+
+def upsert_cases(
+    mongo_col,
+    df,
+    stamp_date,
+    is_update,
+    batch_size=BATCH_SIZE,
+    write_concern=None,
+    workers=WRITE_WORKERS,
+    queue_depth=WRITE_QUEUE_DEPTH,
+):
+    """Write cases with unordered bulk upserts keyed on caseCode.
+
+    Each batch is a single round trip: missing cases are inserted with
+    `createdAt`, existing ones are updated in place so they never disappear
+    from the collection and keep their `createdAt`.
+
+    Args:
+        mongo_col (pymongo.Collection): The cases collection, with the unique
+            caseCode index.
+        df (pandas.DataFrame): Prepared case data.
+        stamp_date (pandas.Timestamp): Date of the snapshot.
+        is_update (bool): Also stamp `updatedAt`, for cases that changed.
+        batch_size (int, optional): Number of cases per bulk write.
+        write_concern (pymongo.write_concern.WriteConcern, optional): Write
+            concern of the bulk writes.
+        workers (int, optional): See iter_writes.
+        queue_depth (int, optional): See iter_writes.
+
+    Returns:
+        dict: Number of matched, modified and upserted cases.
+    """
+    if write_concern is not None:
+        mongo_col = mongo_col.with_options(write_concern=write_concern)
+    counts = dict(matched=0, modified=0, upserted=0)
+    tot_iter = math.ceil(df.shape[0] / batch_size)
+    set_on_insert = embed_document(
+        "$setOnInsert", bson.encode({"createdAt": stamp_date})
+    )
+    extra = {"updatedAt": stamp_date} if is_update else None
+    case_codes = df["caseCode"].to_numpy()
+
+    def _requests():
+        # the update documents are encoded straight from the columns
+        batches = iter_encoded(df, batch_size, extra=extra)
+        for i, docs in zip(range(0, df.shape[0], batch_size), batches):
+            yield [
+                UpdateOne(
+                    {"caseCode": case_code},
+                    raw_document(embed_document("$set", doc), set_on_insert),
+                    upsert=True,
+                )
+                for case_code, doc in zip(case_codes[i : i + batch_size].tolist(), docs)
+            ]
+
+    def _write(requests):
+        return mongo_col.bulk_write(requests, ordered=False)
+
+    for n_loop, (requests, res, t_elapsed) in enumerate(
+        iter_writes(_requests(), _write, workers, queue_depth), 1
+    ):
+        counts["matched"] += res.matched_count
+        counts["modified"] += res.modified_count
+        counts["upserted"] += res.upserted_count
+        print(
+            f"Batch {n_loop}/{tot_iter}: {len(requests)} cases in {t_elapsed:.2f}s"
+            f" ({len(requests) / max(t_elapsed, 1e-9):.0f} cases/s)"
+        )
+    return counts
+
+
+def delete_cases(mongo_db, case_codes, stamp_date):
+    """Move cases from the cases collection to cases.deleted.
+
+    Args:
+        mongo_db (pymongo.Database): The database.
+        case_codes (list): Case codes to remove.
+        stamp_date (pandas.Timestamp): Date of the snapshot, saved as
+            `deletedAt`.
+
+    Returns:
+        int: Number of cases moved.
+    """
+    mongo_col = mongo_db["cases"]
+    del_df = pd.DataFrame(list(mongo_col.find({"caseCode": {"$in": case_codes}})))
+    del_df = del_df.drop(columns=["_id"], errors="ignore")
+    if del_df.shape[0] > 0:
+        mongo_col.delete_many({"caseCode": {"$in": case_codes}})
+        del_df["deletedAt"] = stamp_date
+        for col_name in del_df.select_dtypes(include=["datetime64"]).columns:
+            del_df[col_name] = del_df[col_name].fillna(0)
+        mongo_db["cases.deleted"].insert_many(del_df.to_dict("records"))
+    return del_df.shape[0]
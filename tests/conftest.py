@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+# the scripts import each other as top-level modules, as when run from src
+sys.path.insert(0, str(REPO_DIR / "src"))
+# run against this server instead of mongomock, e.g. mongodb://127.0.0.1:27017
+TEST_MONGO_URL = os.environ.get("TEST_MONGO_URL")
+
+
+def _mock_pipeline(value):
+    # mongomock has no $merge nor $substrCP, they are swapped for the $out
+    # and $substr equivalents of these pipelines
+    if isinstance(value, list):
+        return [_mock_pipeline(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "$merge" in value:
+        return {"$out": value["$merge"]["into"]}
+    return {
+        ("$substr" if k == "$substrCP" else k): _mock_pipeline(v)
+        for k, v in value.items()
+    }
+
+
+@pytest.fixture
+def mongo_db():
+    if TEST_MONGO_URL is not None:
+        from pymongo import MongoClient
+
+        mongo_client = MongoClient(TEST_MONGO_URL)
+        mongo_client.drop_database("casesTestDb")
+        yield mongo_client["casesTestDb"]
+        mongo_client.drop_database("casesTestDb")
+        mongo_client.close()
+        return
+    mongomock = pytest.importorskip("mongomock")
+    aggregate = mongomock.collection.Collection.aggregate
+    mongomock.collection.Collection.aggregate = (
+        lambda self, pipeline, *args, **kwargs: aggregate(
+            self, _mock_pipeline(pipeline), *args, **kwargs
+        )
+    )
+    try:
+        yield mongomock.MongoClient()["casesTestDb"]
+    finally:
+        mongomock.collection.Collection.aggregate = aggregate
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    import boundaries
+    from benchmarks.generate_case_info import lookup_boundaries
+    from make_mappable import LOC_CITY_MUN_SAV
+
+    # every pipeline path is relative to the working directory
+    shutil.copytree(
+        REPO_DIR / LOC_CITY_MUN_SAV.parent, tmp_path / LOC_CITY_MUN_SAV.parent
+    )
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(boundaries, "_BOUNDARIES", lookup_boundaries())
+    return tmp_path
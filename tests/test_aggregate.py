@@ -0,0 +1,46 @@
+import bson
+import pandas as pd
+import pytest
+
+from aggregate import run_summaries
+from benchmarks.generate_case_info import generate
+from create_summary import map_cases, national_summary, province_stats
+from encoder import iter_raw_batches
+from snapshot import list_snapshots, read_snapshot, snapshot_date
+
+
+@pytest.fixture
+def snapshot(workdir):
+    generate(workdir, 2000, days=1, dirty=0.2)
+    in_csv = list_snapshots()[-1]
+    return read_snapshot(in_csv), snapshot_date(in_csv)
+
+
+def _documents(docs, keys):
+    # comparable documents, with the dates as UTC timestamps
+    docs_df = pd.DataFrame(list(docs)).drop(columns=["_id"], errors="ignore")
+    docs_df["createdAt"] = pd.to_datetime(docs_df["createdAt"], utc=True)
+    docs_df["count"] = docs_df["count"].astype("int64")
+    docs_df = docs_df[keys + ["count", "createdAt"]]
+    return docs_df.sort_values(keys, ignore_index=True)
+
+
+def test_engines_give_identical_documents(mongo_db, snapshot):
+    curr_df, new_date = snapshot
+    for docs in iter_raw_batches(curr_df.assign(createdAt=new_date), 500):
+        mongo_db["cases"].insert_many([bson.decode(doc.raw) for doc in docs])
+
+    run_summaries(mongo_db, new_date)
+
+    for col_name, stats_df, keys in [
+        (
+            "cases.stats",
+            province_stats(map_cases(curr_df), new_date),
+            ["provincePSGC", "healthStatus"],
+        ),
+        ("cases.summary", national_summary(curr_df, new_date), ["healthStatus"]),
+    ]:
+        pd.testing.assert_frame_equal(
+            _documents(mongo_db[col_name].find(), keys),
+            _documents(stats_df.to_dict("records"), keys),
+        )
@@ -0,0 +1,33 @@
+import bson
+import numpy as np
+from bson.raw_bson import RawBSONDocument
+
+import instrument
+from instrument import finish_run, stage, start_run
+
+
+def test_parent_peak_kept_across_nested_stages(tmp_path):
+    run = start_run("test")
+    with stage("parent"):
+        values = np.ones(25_000_000)
+        peak = values.nbytes / 2**20
+        del values
+        with stage("child"):
+            pass
+    finish_run(tmp_path / "metrics.json")
+
+    child, parent = run.stages
+    assert child["peak_rss_mb"] < peak
+    assert parent["peak_rss_mb"] > peak
+
+
+def test_only_raw_documents_measured():
+    doc = RawBSONDocument(bson.encode({"caseCode": "C1", "age": 30}))
+    command = {
+        "update": "cases",
+        "updates": [{"q": {"caseCode": "C1"}, "u": doc, "upsert": True}] * 2,
+        "filter": {"caseCode": {"$in": ["C{}".format(i) for i in range(1000)]}},
+    }
+
+    assert instrument._raw_size(command) == 2 * len(doc.raw)
+    assert instrument._raw_size({"insert": "cases", "documents": [doc]}) == len(doc.raw)
@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+from numpy import nan
+
+from constants import TZ
+from models import CASE_SCHEMA, compile_schema, prep_cases_df
+
+
+@pytest.fixture
+def date_kernel():
+    # a fresh kernel, without a format cached by an earlier test
+    return compile_schema(dict(dateRepConf=CASE_SCHEMA["dateRepConf"]))["dateRepConf"]
+
+
+def _dates(*values):
+    return [pd.Timestamp(v, tz=TZ) if v != 0 else 0 for v in values]
+
+
+def test_date_format_detected(date_kernel):
+    col = pd.Series(["01/02/2021", " 06/13/2021", nan, ""], dtype=object)
+
+    prepared = date_kernel(col)
+
+    assert prepared.dtype == object
+    assert prepared.tolist() == _dates("2021-01-02", "2021-06-13", 0, 0)
+
+
+def test_date_format_cached_across_chunks(date_kernel):
+    # day first, only told apart by the first chunk
+    date_kernel(pd.Series(["13/06/2021"], dtype=object))
+
+    prepared = date_kernel(pd.Series(["01/02/2021"], dtype=object))
+
+    assert prepared.tolist() == _dates("2021-02-01")
+
+
+def test_date_mixed_fallback_and_unparsed(date_kernel):
+    col = pd.Series(
+        ["2021-06-13", "June 14, 2021", "not a date", "not a date", "2021-13-45"],
+        dtype=object,
+    )
+    unparsed = {}
+
+    prepared = date_kernel(col, unparsed)
+
+    assert prepared.tolist() == _dates("2021-06-13", "2021-06-14", 0, 0, 0)
+    assert unparsed["dateRepConf"]["count"] == 3
+    assert sorted(unparsed["dateRepConf"]["values"]) == ["2021-13-45", "not a date"]
+
+
+def test_prep_records_unparsed_over_chunks():
+    unparsed = {}
+    for values in [["2021-06-13", "bad"], ["bad", "worse", "2021-06-14"]]:
+        prep_cases_df(
+            pd.DataFrame({"DateRepConf": values}, dtype=object), unparsed=unparsed
+        )
+
+    assert unparsed == dict(dateRepConf=dict(count=3, values=["bad", "worse"]))
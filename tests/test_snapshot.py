@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from benchmarks.generate_case_info import generate
+from constants import SNAPSHOT_CACHE_DIR
+from models import SchemaError
+from snapshot import iter_snapshot, list_snapshots, snapshot_cache_file
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def in_csv(workdir):
+    generate(workdir, 500, days=1)
+    return list_snapshots()[-1]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 100])
+def test_cache_written_once_prepared(in_csv, chunk_size):
+    chunks = list(iter_snapshot(in_csv, chunk_size, use_cache=True))
+
+    assert snapshot_cache_file(in_csv).is_file()
+    cached = list(iter_snapshot(in_csv, chunk_size, use_cache=True))
+    pd.testing.assert_frame_equal(
+        pd.concat(cached, ignore_index=True), pd.concat(chunks, ignore_index=True)
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [None, 100])
+def test_failed_prep_is_not_cached(in_csv, chunk_size):
+    raw_df = pd.read_csv(in_csv, dtype=str, keep_default_na=False)
+    raw_df.loc[len(raw_df) - 1, "Sex"] = "unknown"
+    raw_df.to_csv(in_csv, index=False)
+
+    with pytest.raises(SchemaError):
+        list(iter_snapshot(in_csv, chunk_size, use_cache=True))
+
+    assert list(SNAPSHOT_CACHE_DIR.glob("*")) == []
@@ -0,0 +1,82 @@
+import bson
+import pytest
+
+import update_db
+from aggregate import run_summaries
+from benchmarks.generate_case_info import generate
+from changeset import changeset_summary, diff_files
+from create_cube import CUBE_COL, count_cube, cube_docs, load_cube, verify_cube
+from create_summary import map_cases, national_summary, province_stats, verify_counts
+from encoder import iter_raw_batches
+from snapshot import list_snapshots, read_snapshot, snapshot_date
+from update_db import apply_changes, read_checkpoint
+
+
+@pytest.fixture
+def day(mongo_db, workdir):
+    # the cases, summaries and cube of the first day, and the changes of the
+    # second
+    generate(workdir, 500, days=2, churn=0.2, new_rate=0.05, delete_rate=0.02)
+    prev_csv, in_csv = list_snapshots()
+    prev_date, new_date = snapshot_date(prev_csv), snapshot_date(in_csv)
+    prev_df = read_snapshot(prev_csv)
+    mongo_db["cases"].create_index("caseCode", unique=True)
+    for docs in iter_raw_batches(prev_df.assign(createdAt=prev_date), 500):
+        mongo_db["cases"].insert_many([bson.decode(doc.raw) for doc in docs])
+    run_summaries(mongo_db, prev_date)
+    load_cube(mongo_db, cube_docs(count_cube(prev_df), prev_date))
+    snap_diff, cols = diff_files(prev_csv, in_csv, use_cache=False)
+    summary = changeset_summary(
+        snap_diff, new_date, prev_date, [prev_csv.name, in_csv.name], cols
+    )
+    return snap_diff, summary, in_csv
+
+
+def _count_diffs(mongo_db, in_csv):
+    # counters that differ from a full recompute of the snapshot
+    curr_df = read_snapshot(in_csv)
+    new_date = snapshot_date(in_csv)
+    assert mongo_db["cases"].count_documents({}) == curr_df.shape[0]
+    return (
+        verify_counts(
+            mongo_db["cases.stats"],
+            province_stats(map_cases(curr_df), new_date),
+            ["provincePSGC", "healthStatus"],
+        ),
+        verify_counts(
+            mongo_db["cases.summary"],
+            national_summary(curr_df, new_date),
+            ["healthStatus"],
+        ),
+        verify_cube(mongo_db[CUBE_COL], count_cube(curr_df)),
+    )
+
+
+def test_day_applied_twice_matches_recompute(mongo_db, day):
+    snap_diff, summary, in_csv = day
+    assert snap_diff.new.shape[0] > 0
+
+    for _ in range(2):
+        apply_changes(
+            mongo_db, snap_diff, summary, update_summary=True, journal=False, cube=True
+        )
+
+    assert _count_diffs(mongo_db, in_csv) == (0, 0, 0)
+
+
+def test_day_applied_again_after_failed_journal(mongo_db, day, monkeypatch):
+    snap_diff, summary, in_csv = day
+
+    def append_segment(snap_diff, summary):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(update_db, "append_segment", append_segment)
+        with pytest.raises(OSError):
+            apply_changes(mongo_db, snap_diff, summary, update_summary=True, cube=True)
+    assert read_checkpoint(mongo_db) is None
+    apply_changes(
+        mongo_db, snap_diff, summary, update_summary=True, journal=False, cube=True
+    )
+
+    assert _count_diffs(mongo_db, in_csv) == (0, 0, 0)